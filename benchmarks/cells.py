@@ -0,0 +1,111 @@
+"""
+Forward and backward time per batch for each cell_type, and a parity check
+of the LSTM variants: the block and fused cells are given the weights of an
+LSTMCell model and must produce the same outputs, else the exit status is 1.
+
+python benchmarks/cells.py --cells LSTMCell,LSTMBlockCell,LSTMBlockFusedCell
+"""
+import sys
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from helper import MiniData
+from enc_dec import EncDecClass
+from training import feed_dict
+
+# Same weight layout (gates i, j, f, o) and forget bias as LSTMCell
+LSTM_VARIANTS = ["LSTMCell", "LSTMBlockCell", "LSTMBlockFusedCell"]
+
+def build(cell_type, overrides):
+  """ Returns graph, session, model, batch and hparams for cell_type """
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                          synthetic_setup(cell_type=cell_type, **overrides)
+  batch = MiniData(dataset_dict['training_set'], list(range(hparams.batch_size)))
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.set_random_seed(1)
+    model = EncDecClass(hparams, embedding, emb_dim)
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+  return graph, sess, model, batch, hparams
+
+def time_cell(cell_type, steps, overrides):
+  """ Seconds per batch for the forward pass, and forward plus backward """
+  graph, sess, model, batch, hparams = build(cell_type, overrides)
+  times = {}
+  with graph.as_default():
+    for name, fetch, keep_prob, mode in [
+        ("forward", model.class_logits, 1., 0),
+        ("forward_backward", model.optimize, hparams.keep_prob, 1)]:
+      feed = feed_dict(model, batch, keep_prob, mode)
+      sess.run(fetch, feed) # warmup
+      start = datetime.now()
+      for _ in range(steps):
+        sess.run(fetch, feed)
+      times[name] = (datetime.now() - start).total_seconds() / steps
+  sess.close()
+  return times
+
+def outputs(sess, model, batch):
+  feed = feed_dict(model, batch, 1., 0)
+  return sess.run([model.encoded_outputs, model.class_logits], feed)
+
+def parity(cell_type, overrides, tolerance=1e-4):
+  """ Max absolute difference of encoder outputs and logits with LSTMCell """
+  ref_graph, ref_sess, ref_model, batch, _ = build("LSTMCell", overrides)
+  with ref_graph.as_default():
+    ref_vars = tf.trainable_variables()
+    ref_values = ref_sess.run(ref_vars)
+    ref_out = outputs(ref_sess, ref_model, batch)
+
+  graph, sess, model, batch, _ = build(cell_type, overrides)
+  with graph.as_default():
+    # Both graphs create their variables in the same order
+    variables = tf.trainable_variables()
+    assert len(variables) == len(ref_vars)
+    for var, value in zip(variables, ref_values):
+      assert var.get_shape().as_list() == list(value.shape), var.name
+      var.load(value, sess)
+    out = outputs(sess, model, batch)
+
+  diff = [float(np.max(np.abs(a - b))) for a, b in zip(ref_out, out)]
+  ref_sess.close()
+  sess.close()
+  return {"encoder_outputs": diff[0], "class_logits": diff[1],
+          "match": max(diff) < tolerance}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--cells', default=",".join(LSTM_VARIANTS + ["GRUCell"]))
+  parser.add_argument('--steps', type=int, default=20)
+  parser.add_argument('--bidirectional', default="True")
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  overrides = dict(train_size=256, eval_size=32,
+                   bidirectional=args.bidirectional == "True")
+  results = []
+  print('{:>20} {:>10} {:>10} {:>8}'.format('cell', 'fwd ms', 'fwd+bwd ms',
+                                             'parity'))
+  for cell_type in args.cells.split(','):
+    r = dict(cell_type=cell_type, **time_cell(cell_type, args.steps, overrides))
+    if cell_type in LSTM_VARIANTS and cell_type != "LSTMCell":
+      r["parity"] = parity(cell_type, overrides)
+    results.append(r)
+    match = r["parity"]["match"] if "parity" in r else '-'
+    print('{:>20} {:>10.1f} {:>10.1f} {:>8}'.format(cell_type,
+          r["forward"] * 1000, r["forward_backward"] * 1000, str(match)))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  diverged = [r["cell_type"] for r in results \
+              if "parity" in r and not r["parity"]["match"]]
+  if len(diverged) > 0:
+    print('Outputs differ from LSTMCell: {}'.format(', '.join(diverged)))
+    sys.exit(1)
@@ -0,0 +1,124 @@
+"""
+Encoder output cache, see cache.py
+
+Class scoring with a class conditioned EncDecGen: the encoder run for every
+candidate class, once per batch, or taken from a warm cache. Then an
+EncDecClass with a frozen encoder: head-only training epochs with and without
+the cache.
+
+python benchmarks/encoder_cache.py --num_classes 4 --epochs 3
+"""
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from helper import make_batches
+from utils import Progress
+from enc_dec import EncDecGen, EncDecClass
+from cache import EncoderCache
+from training import feed_dict, train_one_epoch, classification_f1, \
+                     language_model_class_loss, class_scores
+
+def seconds(fn):
+  start = datetime.now()
+  result = fn()
+  return (datetime.now() - start).total_seconds(), result
+
+def encode_every_class(sess, model, data, batch_size):
+  """ language_model_class_loss without reuse of the encoder outputs """
+  one_hots = sorted(data.sense_to_one_hot.values(), key=np.argmax)
+  loss = np.zeros((data.size(), len(one_hots)), dtype=np.float32)
+  start_id = 0
+  for batch in make_batches(data, batch_size, data.num_batches(batch_size),
+                            shuffle=False):
+    feed = feed_dict(model, batch, 1, 0)
+    size = len(batch.seq_len_encoder)
+    for class_id, one_hot in enumerate(one_hots):
+      feed[model.classes] = np.repeat([one_hot], size, axis=0)
+      loss[start_id:start_id+size, class_id] = sess.run(model.eval_loss, feed)
+    start_id += size
+  return class_scores(np.argmax(data.classes, axis=1), np.argmin(loss, axis=1),
+                      data.sense_to_one_hot)
+
+def class_scoring(num_classes, cache_mb):
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+      synthetic_setup(train_size=32, eval_size=1000, num_classes=num_classes,
+                      class_conditioned=True)
+  val_set = dataset_dict['validation_set']
+  bs = hparams.batch_size
+  num_batches = val_set.num_batches(bs)
+  results = {}
+  with tf.Graph().as_default(), tf.Session() as sess:
+    tf.set_random_seed(1)
+    model = EncDecGen(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    results["every_class"] = seconds(
+        lambda: encode_every_class(sess, model, val_set, bs))
+    results["once_per_batch"] = seconds(
+        lambda: language_model_class_loss(sess, model, val_set, bs, num_batches))
+    cache = EncoderCache(cache_mb * 2**20)
+    results["cold_cache"] = seconds(lambda: language_model_class_loss(
+        sess, model, val_set, bs, num_batches, cache))
+    results["warm_cache"] = seconds(lambda: language_model_class_loss(
+        sess, model, val_set, bs, num_batches, cache))
+  return {k: {"sec": t, "f1": float(r[0]), "acc": float(r[1])} \
+          for k, (t, r) in results.items()}, cache.stats()
+
+def head_only(epochs, cache_mb):
+  results = {}
+  for use_cache in [False, True]:
+    hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+        synthetic_setup(train_size=2000, eval_size=500, freeze_encoder=True)
+    train_set = dataset_dict['training_set']
+    val_set = dataset_dict['validation_set']
+    num_batches = train_set.num_batches(hparams.batch_size)
+    prog = Progress(batches=num_batches, progress_bar=False)
+    cache = EncoderCache(cache_mb * 2**20) if use_cache else None
+    np.random.seed(1)
+    with tf.Graph().as_default(), tf.Session() as sess:
+      tf.set_random_seed(1)
+      model = EncDecClass(hparams, embedding, emb_dim)
+      sess.run(tf.global_variables_initializer(), model.init_feed)
+      # First epoch fills the cache
+      train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                      hparams.batch_size, num_batches, prog, cache=cache)
+      sec, _ = seconds(lambda: [train_one_epoch(sess, train_set, model,
+                hparams.keep_prob, hparams.batch_size, num_batches, prog,
+                cache=cache) for _ in range(epochs)])
+      _, f1, acc, _ = classification_f1(sess, val_set, model,
+          hparams.batch_size, val_set.num_batches(hparams.batch_size), False,
+          cache)
+    results["cache" if use_cache else "no_cache"] = {
+        "epoch_sec": sec / epochs, "val_f1": float(f1), "val_acc": float(acc)}
+  return results
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--num_classes', type=int, default=4)
+  parser.add_argument('--epochs', type=int, default=3)
+  parser.add_argument('--cache_mb', type=int, default=256)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  scoring, stats = class_scoring(args.num_classes, args.cache_mb)
+  print('Class scoring, {} classes'.format(args.num_classes))
+  for name, r in scoring.items():
+    print('{:>16} {:>8.2f} sec  f1 {:.4f}  acc {:.4f}'.format(name, r["sec"],
+          r["f1"], r["acc"]))
+  print('Cache: {entries} entries, {bytes} bytes, {hits} hits, '
+        '{misses} misses'.format(**stats))
+
+  training = head_only(args.epochs, args.cache_mb)
+  print('Frozen encoder training')
+  for name, r in training.items():
+    print('{:>16} {:>8.2f} sec/epoch  val f1 {:.4f}'.format(name,
+          r["epoch_sec"], r["val_f1"]))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({"class_scoring": scoring, "cache": stats,
+                 "head_only": training}, f, indent=2)
@@ -0,0 +1,125 @@
+"""
+Numerical parity and speed of the numpy engine against the EncDecClass graph.
+For each configuration, a model is trained briefly on synthetic data and
+exported, then the class logits of both are compared on the validation set.
+Startup is timed in fresh processes: importing tensorflow and building the
+graph, against importing the engine and loading the exported model. The
+exit status is 1 if a configuration differs by more than --tolerance.
+
+python benchmarks/engine.py --epochs 1
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from synthetic import synthetic_setup, ROOT
+from utils import Progress
+from enc_dec import EncDecClass
+from training import train_one_epoch
+from export import model_weights, save_model
+from quantize import class_logits, quantize_weights
+from numpy_engine import Engine
+
+CONFIGS = [
+  dict(cell_type="LSTMCell"),
+  dict(cell_type="GRUCell"),
+  dict(cell_type="LSTMBlockCell"),
+  dict(cell_type="LSTMBlockFusedCell"),
+  dict(cell_type="LSTMCell", bidirectional=False),
+  dict(cell_type="LSTMCell", num_layers=2, residual=True),
+  dict(cell_type="GRUCell", num_layers=2),
+  dict(cell_type="LSTMCell", class_over_sequence=True)]
+
+def parity(config, epochs, model_dir):
+  """ Max absolute logit difference, and seconds per validation pass """
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                synthetic_setup(train_size=1000, eval_size=500, **config)
+  train_set = dataset_dict['training_set']
+  val_set = dataset_dict['validation_set']
+  num_batches = train_set.num_batches(hparams.batch_size)
+  prog = Progress(batches=num_batches, progress_bar=False)
+  with tf.Graph().as_default(), tf.Session() as sess:
+    tf.set_random_seed(1)
+    model = EncDecClass(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    for epoch in range(epochs):
+      train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                      hparams.batch_size, num_batches, prog)
+    start = datetime.now()
+    tf_logits = class_logits(sess, model, val_set, hparams.batch_size)
+    tf_seconds = (datetime.now() - start).total_seconds()
+    weights = model_weights(sess, model)
+  save_model(model_dir, weights, hparams, inv_vocab)
+
+  engine = Engine.from_dir(model_dir)
+  start = datetime.now()
+  np_logits = np.concatenate([engine.logits(
+      val_set.encoder_input[i:i+hparams.batch_size],
+      val_set.seq_len_encoder[i:i+hparams.batch_size],
+      val_set.decoder_input[i:i+hparams.batch_size],
+      val_set.seq_len_decoder[i:i+hparams.batch_size]) \
+      for i in range(0, val_set.size(), hparams.batch_size)])
+  np_seconds = (datetime.now() - start).total_seconds()
+
+  # The int8 engine, against the float graph
+  int8_engine = Engine(vars(hparams), quantize_weights(weights), inv_vocab)
+  int8_pred = int8_engine.predict_data(val_set)
+  return {"max_abs_diff": float(np.max(np.abs(tf_logits - np_logits))),
+          "prediction_match": float(np.mean(
+              np.argmax(tf_logits, 1) == np.argmax(np_logits, 1))),
+          "int8_prediction_match": float(np.mean(
+              np.argmax(tf_logits, 1) == int8_pred)),
+          "tf_seconds": tf_seconds, "numpy_seconds": np_seconds}
+
+def startup(code):
+  """ Seconds to run code in a fresh interpreter """
+  start = datetime.now()
+  subprocess.check_call([sys.executable, "-c", code], cwd=ROOT)
+  return (datetime.now() - start).total_seconds()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--epochs', type=int, default=1)
+  parser.add_argument('--tolerance', type=float, default=1e-4)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  results = []
+  print('{:>40} {:>10} {:>7} {:>7} {:>8} {:>8}'.format('config', 'max diff',
+        'match', 'int8', 'tf sec', 'np sec'))
+  with tempfile.TemporaryDirectory() as tmp:
+    for i, config in enumerate(CONFIGS):
+      model_dir = os.path.join(tmp, str(i))
+      r = dict(config=config, **parity(config, args.epochs, model_dir))
+      r["parity"] = r["max_abs_diff"] < args.tolerance
+      results.append(r)
+      print('{:>40} {:>10.2e} {:>7.4f} {:>7.4f} {:>8.3f} {:>8.3f}'.format(
+            json.dumps(config), r["max_abs_diff"], r["prediction_match"],
+            r["int8_prediction_match"], r["tf_seconds"], r["numpy_seconds"]))
+
+    load_tf = ("import sys; sys.path.insert(0, 'benchmarks');"
+               "import tensorflow as tf; from synthetic import synthetic_setup;"
+               "from enc_dec import EncDecClass;"
+               "h, s, d, v, iv, e, dim = synthetic_setup();"
+               "EncDecClass(h, e, dim)")
+    load_np = ("from numpy_engine import Engine;"
+               "Engine.from_dir({!r})".format(os.path.join(tmp, '0')))
+    startup_times = {"tensorflow": startup(load_tf), "numpy": startup(load_np)}
+  print('Startup seconds, tensorflow graph {tensorflow:.2f}, '
+        'numpy engine {numpy:.2f}'.format(**startup_times))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({"parity": results, "startup": startup_times}, f, indent=2)
+  failed = [r["config"] for r in results if not r["parity"]]
+  if len(failed) > 0:
+    print('Max abs diff over {} for {}'.format(args.tolerance,
+          ', '.join(json.dumps(c) for c in failed)))
+    sys.exit(1)
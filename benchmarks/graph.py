@@ -0,0 +1,59 @@
+"""
+GraphDef size, build and export time of EncDecClass against vocab size. The
+embedding is fed to its initializer, so the GraphDef should not grow with the
+vocab, while the checkpoint holds the embedding once.
+
+python benchmarks/graph.py --vocab_sizes 10000,100000,400000
+"""
+import os
+import json
+import argparse
+import tempfile
+from datetime import datetime
+
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from enc_dec import EncDecClass
+
+def measure(vocab_size, tmp):
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+      synthetic_setup(train_size=32, eval_size=32, vocab_size=vocab_size)
+  start = datetime.now()
+  with tf.Graph().as_default() as graph, tf.Session() as sess:
+    model = EncDecClass(hparams, embedding, emb_dim)
+    build = (datetime.now() - start).total_seconds()
+    start = datetime.now()
+    graph_bytes = len(graph.as_graph_def().SerializeToString())
+    serialize = (datetime.now() - start).total_seconds()
+    start = datetime.now()
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    init = (datetime.now() - start).total_seconds()
+    start = datetime.now()
+    tf.train.Saver().save(sess, os.path.join(tmp, 'model.ckpt'),
+                          write_meta_graph=True)
+    export = (datetime.now() - start).total_seconds()
+  return {"vocab_size": vocab_size, "embedding_bytes": embedding.nbytes,
+          "graph_bytes": graph_bytes, "build_sec": build,
+          "serialize_sec": serialize, "init_sec": init, "save_sec": export}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--vocab_sizes', default="10000,100000,400000")
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  results = []
+  print('{:>10} {:>12} {:>12} {:>8} {:>8} {:>8} {:>8}'.format('vocab',
+        'emb MB', 'graph KB', 'build', 'ser.', 'init', 'save'))
+  for vocab_size in [int(v) for v in args.vocab_sizes.split(',')]:
+    with tempfile.TemporaryDirectory() as tmp:
+      r = measure(vocab_size, tmp)
+    results.append(r)
+    print('{:>10} {:>12.1f} {:>12.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+          vocab_size, r["embedding_bytes"] / 2**20, r["graph_bytes"] / 2**10,
+          r["build_sec"], r["serialize_sec"], r["init_sec"], r["save_sec"]))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -0,0 +1,85 @@
+"""
+Head training on extracted features against full EncDecClass training, see
+features.py. A model is trained briefly, its features are extracted, then
+head configurations are trained on them. Reports seconds per epoch of each.
+
+python benchmarks/head_features.py --epochs 2
+"""
+import json
+import argparse
+import tempfile
+from datetime import datetime
+
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from utils import Progress
+from enc_dec import EncDecClass, HeadClass
+from training import train_one_epoch
+from features import extract_features, load_features, feature_batches, \
+                     head_feed, head_f1
+
+HEADS = [
+  dict(class_over_sequence=False),
+  dict(class_over_sequence=True, fc_num_layers=1, hidden_size=64),
+  dict(class_over_sequence=True, fc_num_layers=2, hidden_size=128)]
+
+def epoch_seconds(fn, epochs):
+  start = datetime.now()
+  for _ in range(epochs):
+    fn()
+  return (datetime.now() - start).total_seconds() / epochs
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--epochs', type=int, default=2)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+      synthetic_setup(train_size=2000, eval_size=500)
+  train_set = dataset_dict['training_set']
+  num_batches = train_set.num_batches(hparams.batch_size)
+  prog = Progress(batches=num_batches, progress_bar=False)
+  results = {}
+  with tempfile.TemporaryDirectory() as feature_dir:
+    with tf.Graph().as_default(), tf.Session() as sess:
+      tf.set_random_seed(1)
+      model = EncDecClass(hparams, embedding, emb_dim)
+      sess.run(tf.global_variables_initializer(), model.init_feed)
+      results["full_epoch_sec"] = epoch_seconds(lambda: train_one_epoch(sess,
+          train_set, model, hparams.keep_prob, hparams.batch_size,
+          num_batches, prog), args.epochs)
+      results["extract_sec"] = extract_features(sess, model, dataset_dict,
+          hparams.batch_size, hparams.max_seq_len, feature_dir)
+    feature_dict = load_features(feature_dir)
+
+    results["heads"] = []
+    for head in HEADS:
+      hparams.update(**head)
+      train_features = feature_dict['training_set']
+      with tf.Graph().as_default(), tf.Session() as sess:
+        tf.set_random_seed(1)
+        model = HeadClass(hparams)
+        sess.run(tf.global_variables_initializer())
+        def epoch():
+          for indices in feature_batches(train_features, hparams.batch_size,
+                                         shuffle=True):
+            sess.run(model.optimize, head_feed(model, train_features, indices,
+                                               hparams.keep_prob))
+        sec = epoch_seconds(epoch, args.epochs)
+        f1, acc = head_f1(sess, model, feature_dict['validation_set'],
+                          hparams.batch_size)
+      results["heads"].append(dict(head, epoch_sec=sec, val_f1=float(f1),
+                                   val_acc=float(acc)))
+
+  print('Full model: {:.2f} sec/epoch, feature extraction {:.2f} sec'.format(
+        results["full_epoch_sec"], results["extract_sec"]))
+  for r in results["heads"]:
+    print('{:>70} {:>8.3f} sec/epoch {:>6.1f}x  val f1 {:.4f}'.format(
+          json.dumps({k: r[k] for k in HEADS[-1] if k in r}), r["epoch_sec"],
+          results["full_epoch_sec"] / r["epoch_sec"], r["val_f1"]))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
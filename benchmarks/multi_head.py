@@ -0,0 +1,89 @@
+"""
+One EncDecClass per head, as the one_v_all dataset trains one model per
+relation, against a single EncDecMultiClass sharing the encoder and decoder.
+Reports the training time of all heads and the dev f1 of each head.
+
+python benchmarks/multi_head.py --heads 4 --epochs 3
+"""
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from utils import Progress
+from enc_dec import EncDecClass, EncDecMultiClass
+from training import train_one_epoch, classification_f1, multi_class_f1
+
+def head_data(data, i):
+  """ Dataset with only the output of head i, as for EncDecClass """
+  sub = data.subset(np.arange(data.size()))
+  sub.classes = data.classes[i]
+  sub.sense_to_one_hot = data.sense_to_one_hot[i]
+  return sub
+
+def train(Model, hparams, embedding, emb_dim, train_set, epochs):
+  """ Train a model, returns the session, the model and the seconds taken """
+  num_batches = train_set.num_batches(hparams.batch_size)
+  prog = Progress(batches=num_batches, progress_bar=False)
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.set_random_seed(1)
+    model = Model(hparams, embedding, emb_dim)
+    sess = tf.Session(graph=graph)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    start = datetime.now()
+    for epoch in range(epochs):
+      train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                      hparams.batch_size, num_batches, prog)
+    seconds = (datetime.now() - start).total_seconds()
+  return sess, model, seconds
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--heads', type=int, default=4)
+  parser.add_argument('--epochs', type=int, default=3)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+      synthetic_setup(train_size=2000, eval_size=500, num_heads=args.heads)
+  train_set = dataset_dict['training_set']
+  val_set = dataset_dict['validation_set']
+  np.random.seed(1)
+
+  # One model per head
+  separate = {"seconds": 0., "val_f1": []}
+  for i in range(args.heads):
+    hparams.update(num_classes=2)
+    sess, model, seconds = train(EncDecClass, hparams, embedding, emb_dim,
+                                 head_data(train_set, i), args.epochs)
+    val = head_data(val_set, i)
+    with sess.graph.as_default():
+      _, f1, _, _ = classification_f1(sess, val, model, hparams.batch_size,
+                        val.num_batches(hparams.batch_size), False)
+    sess.close()
+    separate["seconds"] += seconds
+    separate["val_f1"].append(f1)
+
+  # A single model with all heads
+  hparams.update(num_classes=[2] * args.heads)
+  sess, model, seconds = train(EncDecMultiClass, hparams, embedding, emb_dim,
+                               train_set, args.epochs)
+  with sess.graph.as_default():
+    f1s, _ = multi_class_f1(sess, val_set, model, hparams.batch_size,
+                            val_set.num_batches(hparams.batch_size))
+  sess.close()
+  shared = {"seconds": seconds, "val_f1": f1s}
+
+  print('{:>10} {:>10} {}'.format('model', 'train sec', 'val f1 per head'))
+  for name, r in [('separate', separate), ('shared', shared)]:
+    print('{:>10} {:>10.1f} {}'.format(name, r["seconds"],
+          ' '.join('{:.4f}'.format(f1) for f1 in r["val_f1"])))
+  print('Speedup: {:.2f}x'.format(separate["seconds"] / shared["seconds"]))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({"separate": separate, "shared": shared}, f, indent=2)
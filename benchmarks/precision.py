@@ -0,0 +1,71 @@
+"""
+Mixed precision against float32: training speed, size of the encoder
+activations, and an accuracy parity check on the dev set after training each
+model with the same seeds.
+
+python benchmarks/precision.py --precisions float32,float16 --epochs 3
+"""
+import json
+import argparse
+from datetime import datetime
+
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from utils import Progress
+from enc_dec import EncDecClass
+from training import train_one_epoch, classification_f1
+
+def run(precision, epochs, overrides):
+  """ Train and evaluate a model in the given precision """
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                          synthetic_setup(precision=precision, **overrides)
+  train_set = dataset_dict['training_set']
+  val_set = dataset_dict['validation_set']
+  num_batches = train_set.num_batches(hparams.batch_size)
+  prog = Progress(batches=num_batches, progress_bar=True, bar_length=10)
+  with tf.Graph().as_default(), tf.Session() as sess:
+    tf.set_random_seed(1)
+    model = EncDecClass(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    start = datetime.now()
+    for epoch in range(epochs):
+      prog.epoch_start()
+      train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                      hparams.batch_size, num_batches, prog)
+      prog.epoch_end()
+    seconds = (datetime.now() - start).total_seconds()
+    _, f1, acc, _ = classification_f1(sess, val_set, model, hparams.batch_size,
+                        val_set.num_batches(hparams.batch_size), False)
+    # Encoder outputs for a full batch of max length arguments
+    act_bytes = hparams.batch_size * hparams.max_seq_len * \
+                model.bi_encoder_hidden * model.floatX.size
+  return {"precision": precision, "steps_per_sec": epochs * num_batches / seconds,
+          "val_acc": acc, "val_f1": f1, "encoder_output_bytes": act_bytes}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--precisions', default="float32,float16,bfloat16")
+  parser.add_argument('--epochs', type=int, default=3)
+  parser.add_argument('--cell_type', default="LSTMCell")
+  parser.add_argument('--tolerance', type=float, default=0.01,
+                      help='max dev accuracy drop against float32')
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  overrides = dict(train_size=2000, eval_size=500, cell_type=args.cell_type)
+  results = [run(p, args.epochs, overrides) for p in args.precisions.split(',')]
+  base = results[0]
+  print('-' * 70)
+  print('{:>10} {:>10} {:>8} {:>8} {:>14} {:>8}'.format('precision',
+        'steps/sec', 'val acc', 'val f1', 'enc out bytes', 'parity'))
+  for r in results:
+    r["acc_drop"] = base["val_acc"] - r["val_acc"]
+    r["parity"] = r["acc_drop"] <= args.tolerance
+    print('{:>10} {:>10.2f} {:>8.4f} {:>8.4f} {:>14} {:>8}'.format(
+          r["precision"], r["steps_per_sec"], r["val_acc"], r["val_f1"],
+          r["encoder_output_bytes"], str(r["parity"])))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
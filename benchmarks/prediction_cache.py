@@ -0,0 +1,102 @@
+"""
+Prediction cache of the serving classifier, see serving.py
+
+A synthetic model is exported, then a stream of relations where a fraction
+are repeats of earlier ones is classified without cache, with a cold cache,
+a warm memory cache, and from the disk tier only in a new classifier.
+Repeated relations are also timed one at a time, as single requests.
+
+python benchmarks/prediction_cache.py --relations 2000 --repeat 0.5
+"""
+import os
+import json
+import argparse
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from enc_dec import EncDecClass
+from export import model_weights, save_model
+from serving import Classifier, PredictionCache
+
+def relation_stream(inv_vocab, size, repeat, max_arg_len, rng):
+  """ Raw text relations, a repeat fraction are copies of earlier ones with
+  another case and spacing, which clean_str normalizes """
+  words = inv_vocab[4:]
+  relations = []
+  for i in range(size):
+    if i > 0 and rng.rand() < repeat:
+      arg1, arg2 = relations[rng.randint(i)]
+      relations.append(("  " + arg1.upper(), arg2.replace(" ", "  ")))
+    else:
+      relations.append(tuple(" ".join(rng.choice(words,
+                       rng.randint(5, max_arg_len + 1))) for _ in range(2)))
+  return relations
+
+def seconds(fn):
+  start = datetime.now()
+  result = fn()
+  return (datetime.now() - start).total_seconds(), result
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--relations', type=int, default=2000)
+  parser.add_argument('--repeat', type=float, default=0.5,
+                      help='fraction of repeated relations')
+  parser.add_argument('--max_entries', type=int, default=100000)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+      synthetic_setup(train_size=32, eval_size=32)
+  relations = relation_stream(inv_vocab, args.relations, args.repeat,
+                              hparams.max_arg_len, np.random.RandomState(1))
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    with tf.Graph().as_default(), tf.Session() as sess:
+      tf.set_random_seed(1)
+      model = EncDecClass(hparams, embedding, emb_dim)
+      sess.run(tf.global_variables_initializer(), model.init_feed)
+      weights = model_weights(sess, model)
+    model_dir = os.path.join(tmp, 'model')
+    save_model(model_dir, weights, hparams, inv_vocab)
+    db_path = os.path.join(tmp, 'predictions.db')
+
+    classifier = Classifier.from_dir(model_dir, args.max_entries, db_path)
+    uncached = Classifier(classifier.engine, classifier.version)
+    results["no_cache"], expected = seconds(
+        lambda: uncached.probabilities(relations))
+    results["cold_cache"], probs = seconds(
+        lambda: classifier.probabilities(relations))
+    results["warm_cache"], _ = seconds(
+        lambda: classifier.probabilities(relations))
+    # Single requests of relations already cached
+    single, _ = seconds(lambda: [classifier.probabilities([r]) \
+                                 for r in relations])
+    stats = classifier.cache.stats()
+    classifier.cache.close()
+
+    disk = Classifier(classifier.engine, classifier.version,
+                      PredictionCache(args.max_entries, db_path))
+    results["disk_cache"], _ = seconds(lambda: disk.probabilities(relations))
+    disk_stats = disk.cache.stats()
+    disk.cache.close()
+
+  print('{} relations, {:.0%} repeated'.format(args.relations, args.repeat))
+  for name, sec in results.items():
+    print('{:>12} {:>8.3f} sec'.format(name, sec))
+  single_us = single / args.relations * 1e6
+  print('Cached single request: {:.1f} us'.format(single_us))
+  print('Max abs difference with the uncached path: {:.2e}'.format(
+        float(np.max(np.abs(probs - expected)))))
+  print('Cache: {entries} entries, {hits} hits, {misses} misses, '
+        '{evictions} evictions'.format(**stats))
+  print('Disk tier: {disk_hits} hits, {misses} misses'.format(**disk_stats))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump({"seconds": results, "single_request_us": single_us,
+                 "cache": stats, "disk_cache": disk_stats}, f, indent=2)
@@ -0,0 +1,103 @@
+"""
+Scaling benchmark for data-parallel training, on a single host. Each worker
+is a process standing in for a node, with its own thread limit. With --sync
+the gradients are aggregated with SyncReplicasOptimizer, and a worker still
+running --timeout seconds after the first one finished is an error.
+
+python benchmarks/scaling.py --workers 1,2,4 --threads 2 --epochs 2
+python benchmarks/scaling.py --workers 2 --sync
+"""
+import json
+import socket
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from synthetic import synthetic_setup
+
+def free_ports(count):
+  """ Ask the OS for unused local ports """
+  socks = [socket.socket() for _ in range(count)]
+  for s in socks:
+    s.bind(('localhost', 0))
+  ports = [s.getsockname()[1] for s in socks]
+  for s in socks:
+    s.close()
+  return ports
+
+def run_job(job_name, task_index, dist, threads, overrides, queue):
+  """ Process target, a parameter server or a worker """
+  from enc_dec import EncDecClass
+  from distributed import train_distributed
+  from utils import session_config
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                                  synthetic_setup(**overrides)
+  s = dict(s, distributed=dist, checkpoint_dir=None)
+  config = session_config(s, threads, threads)
+  start = datetime.now()
+  train_distributed(hparams, s, EncDecClass, embedding, emb_dim, dataset_dict,
+                    vocab, inv_vocab, job_name, task_index, config=config)
+  queue.put((job_name, task_index, (datetime.now() - start).total_seconds()))
+
+def run(num_workers, threads, overrides, sync=False, timeout=600):
+  """ Time a full training with num_workers, returns seconds """
+  ports = free_ports(num_workers + 1)
+  dist = {
+    "ps_hosts"      : "localhost:{}".format(ports[0]),
+    "worker_hosts"  : ",".join("localhost:{}".format(p) for p in ports[1:]),
+    "sync_replicas" : str(sync)}
+  overrides = dict(overrides, sync_replicas=sync)
+  ctx = multiprocessing.get_context('spawn')
+  queue = ctx.Queue()
+  ps = ctx.Process(target=run_job,
+                   args=("ps", 0, dist, threads, overrides, queue))
+  ps.start()
+  workers = [ctx.Process(target=run_job,
+                         args=("worker", i, dist, threads, overrides, queue))
+             for i in range(num_workers)]
+  for w in workers:
+    w.start()
+  workers[0].join()
+  for w in workers[1:]:
+    w.join(timeout)
+  hung = [i for i, w in enumerate(workers) if w.is_alive()]
+  for w in workers + [ps]:
+    w.terminate()
+  if len(hung) > 0:
+    raise RuntimeError("workers {} did not exit {} sec after the first "
+                       "one".format(hung, timeout))
+  times = [queue.get() for _ in range(num_workers)]
+  return max(t[2] for t in times)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--workers', default="1,2,4", help='worker counts to time')
+  parser.add_argument('--threads', type=int, default=2, help='threads per worker')
+  parser.add_argument('--epochs', type=int, default=2)
+  parser.add_argument('--train_size', type=int, default=4000)
+  parser.add_argument('--sync', action='store_true',
+                      help='synchronous replicas, SyncReplicasOptimizer')
+  parser.add_argument('--timeout', type=int, default=600,
+                      help='seconds to wait for the other workers')
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  overrides = dict(train_size=args.train_size, eval_size=200,
+                   nb_epochs=args.epochs, early_stop_epoch=args.epochs)
+  results = []
+  for n in [int(x) for x in args.workers.split(',')]:
+    seconds = run(n, args.threads, overrides, args.sync, args.timeout)
+    results.append({"workers": n, "threads": args.threads, "seconds": seconds,
+        "examples_per_sec": args.train_size * args.epochs / seconds})
+  base = results[0]["seconds"]
+  print('-' * 60)
+  print('{:>8} {:>10} {:>14} {:>8}'.format('workers', 'seconds', 'examples/sec',
+                                            'speedup'))
+  for r in results:
+    r["speedup"] = base / r["seconds"]
+    print('{:>8} {:>10.1f} {:>14.1f} {:>8.2f}'.format(r["workers"],
+            r["seconds"], r["examples_per_sec"], r["speedup"]))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -0,0 +1,62 @@
+"""
+EncDecGen training step time with the full and the sampled softmax, against
+vocab size
+
+python benchmarks/softmax.py --vocab_sizes 10000,50000 --num_sampled 512
+"""
+import json
+import argparse
+from datetime import datetime
+
+import tensorflow as tf
+
+from synthetic import synthetic_setup
+from helper import MiniData
+from enc_dec import EncDecGen
+from training import feed_dict
+
+def step_time(softmax, vocab_size, num_sampled, steps, warmup):
+  """ Seconds per training step, and the exact loss after the steps """
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+      synthetic_setup(train_size=256, eval_size=32, vocab_size=vocab_size,
+                      softmax=softmax, num_sampled=num_sampled)
+  batch = MiniData(dataset_dict['training_set'], list(range(hparams.batch_size)))
+  with tf.Graph().as_default(), tf.Session() as sess:
+    tf.set_random_seed(1)
+    model = EncDecGen(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    feed = feed_dict(model, batch, hparams.keep_prob, 1)
+    for _ in range(warmup):
+      sess.run(model.optimize, feed)
+    start = datetime.now()
+    for _ in range(steps):
+      sess.run(model.optimize, feed)
+    seconds = (datetime.now() - start).total_seconds() / steps
+    eval_cost = sess.run(model.eval_cost, feed_dict(model, batch, 1., 0))
+  return seconds, float(eval_cost)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--vocab_sizes', default="10000,50000")
+  parser.add_argument('--num_sampled', type=int, default=512)
+  parser.add_argument('--steps', type=int, default=20)
+  parser.add_argument('--warmup', type=int, default=3)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  results = []
+  print('{:>8} {:>8} {:>10} {:>10}'.format('vocab', 'softmax', 'step ms',
+                                            'eval loss'))
+  for vocab_size in [int(v) for v in args.vocab_sizes.split(',')]:
+    for softmax in ["full", "sampled"]:
+      seconds, loss = step_time(softmax, vocab_size, args.num_sampled,
+                                args.steps, args.warmup)
+      results.append({"vocab_size": vocab_size, "softmax": softmax,
+                      "num_sampled": args.num_sampled, "step_sec": seconds,
+                      "eval_cost": loss})
+      print('{:>8} {:>8} {:>10.1f} {:>10.3f}'.format(vocab_size, softmax,
+            seconds * 1000, loss))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -0,0 +1,164 @@
+"""
+End-to-end benchmark suite on synthetic CoNLL files, see synthetic.conll_setup
+
+Times clean_str, get_data (Preprocess), embedding loading from the text file
+and then from its json cache, make_batches, training steps for each cell_type
+with a bidirectional or one way encoder, and inference. Results are saved as
+json and compared with a baseline of a previous run: timings slower than the
+baseline by more than --tolerance are regressions, and the exit status is 1.
+
+python benchmarks/suite.py --output baseline.json
+python benchmarks/suite.py --baseline baseline.json --output results.json
+"""
+import sys
+import copy
+import json
+import codecs
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+import tensorflow as tf
+
+from synthetic import conll_setup
+from helper import clean_str, get_data, make_batches
+from embeddings import get_embeddings
+from enc_dec import EncDecClass
+from training import feed_dict
+from quantize import class_logits
+
+CELLS = ["LSTMCell", "GRUCell", "LSTMBlockCell", "LSTMBlockFusedCell",
+         "BNLSTMCell"]
+
+def seconds(fn):
+  start = datetime.now()
+  result = fn()
+  return (datetime.now() - start).total_seconds(), result
+
+def bench_clean_str(path):
+  texts = []
+  with codecs.open(path, encoding='utf8') as f:
+    for line in f:
+      j = json.loads(line)
+      texts += [j['Arg1']['RawText'], j['Arg2']['RawText']]
+  sec, _ = seconds(lambda: [clean_str(t) for t in texts])
+  return {"sec": sec, "relations_per_sec": len(texts) / 2 / sec}
+
+def bench_pipeline(hparams, s):
+  """ Data and embeddings as main.py prepares them
+  Returns:
+    results, dataset_dict, embedding, emb_dim
+  """
+  results = {"clean_str": bench_clean_str(
+      s[s['use_dataset']]['datasets']['training_set']['path'])}
+  sec, (dataset_dict, vocab, inv_vocab) = seconds(lambda: get_data(hparams, s))
+  results["get_data"] = {"sec": sec}
+  # The text file is parsed and cached as json, then loaded from the cache
+  for name in ["embedding_txt", "embedding_json"]:
+    sec, (embedding, emb_dim) = seconds(lambda: get_embeddings(hparams, vocab,
+                                                              inv_vocab, s))
+    results[name] = {"sec": sec}
+  train_set = dataset_dict['training_set']
+  num_batches = train_set.num_batches(hparams.batch_size)
+  for bucket in [False, True]:
+    sec, _ = seconds(lambda: [feed_dict_arrays(b) for b in make_batches(
+        train_set, hparams.batch_size, num_batches, bucket=bucket)])
+    results["make_batches" + ("_bucket" if bucket else "")] = {"sec": sec}
+  return results, dataset_dict, embedding, emb_dim
+
+def feed_dict_arrays(batch):
+  """ The batch arrays feed_dict reads """
+  return (batch.encoder_input, batch.decoder_input, batch.decoder_target,
+          batch.seq_len_encoder, batch.seq_len_decoder, batch.classes)
+
+def bench_model(hparams, dataset_dict, embedding, emb_dim, steps):
+  """ Seconds per training step, and inference on the validation set """
+  train_set = dataset_dict['training_set']
+  val_set = dataset_dict['validation_set']
+  batches = list(make_batches(train_set, hparams.batch_size, steps + 2))
+  with tf.Graph().as_default(), tf.Session() as sess:
+    tf.set_random_seed(1)
+    model = EncDecClass(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    feeds = [feed_dict(model, b, hparams.keep_prob, 1) for b in batches]
+    for feed in feeds[:2]: # warmup
+      sess.run(model.optimize, feed)
+    sec, _ = seconds(lambda: [sess.run(model.optimize, f) for f in feeds[2:]])
+    step = {"sec": sec / len(feeds[2:]),
+            "examples_per_sec": hparams.batch_size * len(feeds[2:]) / sec}
+    sec, _ = seconds(lambda: class_logits(sess, model, val_set,
+                                          hparams.batch_size))
+    inference = {"sec": sec, "relations_per_sec": val_set.size() / sec}
+  return step, inference
+
+def run(train_size, eval_size, steps, cells):
+  results = {}
+  with tempfile.TemporaryDirectory() as data_dir:
+    hparams, s = conll_setup(data_dir, train_size, eval_size)
+    pipeline, dataset_dict, embedding, emb_dim = bench_pipeline(hparams, s)
+    results.update(pipeline)
+  for cell_type in cells:
+    for bidirectional in [True, False]:
+      name = '{}_{}'.format(cell_type, "bi" if bidirectional else "uni")
+      h = copy.copy(hparams)
+      h.update(cell_type=cell_type, bidirectional=bidirectional)
+      step, inference = bench_model(h, dataset_dict, embedding, emb_dim, steps)
+      results["train_step/" + name] = step
+      results["inference/" + name] = inference
+      print('{:>32} {:>8.4f} sec/step {:>8.0f} relations/sec'.format(name,
+            step["sec"], inference["relations_per_sec"]))
+  return results
+
+def compare(results, baseline, tolerance):
+  """ Rows (name, baseline sec, sec, ratio, regression) of common results """
+  rows = []
+  for name, r in results.items():
+    if name not in baseline:
+      continue
+    base = baseline[name]["sec"]
+    ratio = r["sec"] / max(base, 1e-9)
+    rows.append((name, base, r["sec"], ratio, ratio > 1 + tolerance))
+  return rows
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--train_size', type=int, default=5000)
+  parser.add_argument('--eval_size', type=int, default=1000)
+  parser.add_argument('--steps', type=int, default=20,
+                      help='timed training steps per model')
+  parser.add_argument('--cells', default=','.join(CELLS))
+  parser.add_argument('--baseline', help='results json of a previous run')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='slowdown over the baseline reported as regression')
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  results = run(args.train_size, args.eval_size, args.steps,
+                args.cells.split(','))
+  report = {"meta": {"time": datetime.now().isoformat(),
+                     "platform": platform.platform(),
+                     "python": platform.python_version(),
+                     "tensorflow": tf.__version__,
+                     "train_size": args.train_size,
+                     "eval_size": args.eval_size, "steps": args.steps},
+            "results": results}
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  print('{:>32} {:>10}'.format('benchmark', 'sec'))
+  for name, r in results.items():
+    print('{:>32} {:>10.4f}'.format(name, r["sec"]))
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f)["results"]
+    rows = compare(results, baseline, args.tolerance)
+    print('{:>32} {:>10} {:>10} {:>7}'.format('against baseline', 'base sec',
+          'sec', 'ratio'))
+    for name, base, sec, ratio, regression in rows:
+      print('{:>32} {:>10.4f} {:>10.4f} {:>7.2f} {}'.format(name, base, sec,
+            ratio, 'REGRESSION' if regression else ''))
+    if any(row[-1] for row in rows):
+      sys.exit(1)
@@ -0,0 +1,180 @@
+"""
+Synthetic datasets for the benchmarks, no data files or embeddings needed:
+random Data objects, or CoNLL format files to run the whole pipeline on
+"""
+import os
+import sys
+import json
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+  sys.path.insert(0, ROOT)
+
+from helper import Data, settings
+
+def synthetic_data(short_name, size, max_arg_len, vocab_size, num_classes, rng):
+  """ Data object of random token ids, already padded and split """
+  data = Data(short_name, None)
+  seq_len = rng.randint(5, max_arg_len + 1, size=(size, 2)).astype('int32')
+  x = rng.randint(4, vocab_size, size=(2, size, max_arg_len)).astype('int32')
+  pad = np.arange(max_arg_len)[None, :]
+  for i in range(2):
+    x[i][pad >= seq_len[:, i:i+1]] = 1 # pad id
+  dec_target = np.roll(x[1], -1, axis=1)
+  dec_target[np.arange(size), seq_len[:, 1] - 1] = 3 # eos id
+  # Learnable labels, so accuracy can be compared between models
+  labels = x[0][:, 0] % num_classes
+
+  data.x = [x[0], x[1]]
+  data.seq_len = seq_len
+  data.decoder_target = dec_target
+  data.classes = np.eye(num_classes, dtype='int32')[labels]
+  if num_classes == 2:
+    data.sense_to_one_hot = {'positive': [1, 0], 'negative': [0, 1]}
+  else:
+    data.sense_to_one_hot = {'class_{}'.format(i): list(row) \
+                    for i, row in enumerate(np.eye(num_classes, dtype=int))}
+  return data
+
+def split_heads(data, num_heads):
+  """ Replace the classes by a binary output per head, as from a dataset with
+  heads in settings.json. Each head learns from a different token of arg1 """
+  labels = data.encoder_input[:, :num_heads] % 2
+  data.classes = [np.eye(2, dtype='int32')[labels[:, i]] \
+                  for i in range(num_heads)]
+  data.sense_to_one_hot = [{'positive': [1, 0], 'negative': [0, 1]}] * num_heads
+  return data
+
+def synthetic_setup(train_size=2000, eval_size=500, vocab_size=5000,
+                    num_classes=2, emb_dim=300, seed=1, num_heads=None,
+                    **overrides):
+  """ Everything main.py prepares, but random
+  Args:
+    num_heads: if given, binary outputs for EncDecMultiClass, see split_heads
+    overrides: HParams values to change from settings.json
+  Returns:
+    hparams, settings, dataset_dict, vocab, inv_vocab, embedding, emb_dim
+  """
+  hparams, s = settings(os.path.join(ROOT, 'settings.json'))
+  hparams.update(cell_type="LSTMCell", nb_epochs=1)
+  hparams.update(**overrides)
+  rng = np.random.RandomState(seed)
+
+  inv_vocab = [hparams.unknown_tag, hparams.pad_tag, hparams.bos_tag,
+               hparams.eos_tag]
+  inv_vocab += ['w{}'.format(i) for i in range(len(inv_vocab), vocab_size)]
+  vocab = {w: i for i, w in enumerate(inv_vocab)}
+  hparams.update(num_classes=num_classes, start_token=vocab[hparams.bos_tag],
+                 end_token=vocab[hparams.eos_tag])
+
+  dataset_dict = {}
+  for name, short_name, size in [('training_set', 'train', train_size),
+                                 ('validation_set', 'val', eval_size),
+                                 ('test_set', 'test', eval_size)]:
+    dataset_dict[name] = synthetic_data(short_name, size, hparams.max_arg_len,
+                                        vocab_size, num_classes, rng)
+    if num_heads is not None:
+      split_heads(dataset_dict[name], num_heads)
+  if num_heads is not None:
+    hparams.update(num_classes=[2] * num_heads,
+                   head_names=['head{}'.format(i) for i in range(num_heads)])
+  embedding = rng.uniform(-0.1, 0.1, (vocab_size, emb_dim)).astype(np.float32)
+  return hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim
+
+###############################################################################
+# CoNLL format files
+###############################################################################
+# Second level senses and their approximate share of the CoNLL 2016 implicit
+# and EntRel training relations
+SENSES = [("EntRel", 0.225), ("Expansion.Conjunction", 0.17),
+          ("Expansion.Restatement", 0.13), ("Contingency.Cause.Reason", 0.12),
+          ("Contingency.Cause.Result", 0.09), ("Expansion.Instantiation", 0.07),
+          ("Comparison.Contrast", 0.055), ("Comparison", 0.03),
+          ("Temporal.Asynchronous.Precedence", 0.03),
+          ("Comparison.Concession", 0.02), ("Temporal.Synchrony", 0.02),
+          ("Temporal.Asynchronous.Succession", 0.01),
+          ("Expansion.Alternative.Chosen alternative", 0.01),
+          ("Contingency.Condition", 0.01), ("Expansion.Alternative", 0.01)]
+
+def arg_length(rng, median, size):
+  """ Token counts of arguments, log-normal as in the PDTB with a long tail """
+  return np.clip(np.round(rng.lognormal(np.log(median), 0.6, size)), 1, 200) \
+           .astype(int)
+
+def raw_text(rng, words, word_cdf, length):
+  """ Raw text of length words drawn from word_cdf, with the capitals,
+  punctuation and clitics that clean_str splits and lowers """
+  ids = np.minimum(np.searchsorted(word_cdf, rng.rand(length)), len(words) - 1)
+  tokens = [words[i] for i in ids]
+  tokens[0] = tokens[0].capitalize()
+  for i in range(1, length):
+    r = rng.rand()
+    if r < 0.06: tokens[i] += ","
+    elif r < 0.08: tokens[i] += "'s"
+    elif r < 0.09: tokens[i] += "n't"
+  return " ".join(tokens) + "."
+
+def conll_relations(size, rng, vocab_size=20000, arg1_median=18,
+                    arg2_median=15):
+  """ CoNLL json relations with PDTB-like argument lengths and senses """
+  words = ['w{}'.format(i) for i in range(vocab_size)]
+  # Zipf-Mandelbrot word frequencies, as in English text
+  word_cdf = np.cumsum(1. / (np.arange(vocab_size) + 2.7))
+  word_cdf /= word_cdf[-1]
+  senses, probs = zip(*SENSES)
+  probs = np.array(probs) / np.sum(probs)
+  len1 = arg_length(rng, arg1_median, size)
+  len2 = arg_length(rng, arg2_median, size)
+  sense_ids = rng.choice(len(senses), size=size, p=probs)
+  for i in range(size):
+    sense = senses[sense_ids[i]]
+    yield {"ID": i, "DocID": "wsj_{:04d}".format(i // 40),
+           "Type": "EntRel" if sense == "EntRel" else "Implicit",
+           "Sense": [sense], "Connective": {"RawText": ""},
+           "Arg1": {"RawText": raw_text(rng, words, word_cdf, len1[i])},
+           "Arg2": {"RawText": raw_text(rng, words, word_cdf, len2[i])}}
+
+def conll_setup(data_dir, train_size=10000, eval_size=1000, vocab_size=20000,
+                emb_dim=300, seed=1):
+  """ Write a CoNLL dataset, its sense mapping and a text embedding file to
+  data_dir, and point the settings to them. get_data and get_embeddings
+  then run on the files as on the real data
+  Returns:
+    hparams, settings
+  """
+  hparams, s = settings(os.path.join(ROOT, 'settings.json'))
+  hparams.update(cell_type="LSTMCell", nb_epochs=1)
+  rng = np.random.RandomState(seed)
+  if not os.path.exists(data_dir):
+    os.makedirs(data_dir)
+  datasets = {}
+  for name, short_name, size in [('training_set', 'train', train_size),
+                                 ('validation_set', 'val', eval_size),
+                                 ('test_set', 'test', eval_size)]:
+    path = os.path.join(data_dir, short_name + '.json')
+    with open(path, 'w') as f:
+      for relation in conll_relations(size, rng, vocab_size):
+        f.write(json.dumps(relation) + '\n')
+    datasets[name] = {"short_name": short_name, "path": path}
+
+  # Top level senses as classes
+  mapping_path = os.path.join(data_dir, 'map_top.json')
+  with open(mapping_path, 'w') as f:
+    json.dump({sense: sense.split('.')[0] for sense, _ in SENSES}, f)
+
+  # word2vec text format of Embeddings, word, tab, space separated values
+  emb_path = os.path.join(data_dir, 'embedding.txt')
+  with open(emb_path, 'w') as f:
+    for i in range(vocab_size):
+      values = rng.uniform(-0.1, 0.1, emb_dim)
+      f.write('w{}\t{}\n'.format(i, ' '.join('{:.5f}'.format(v) \
+                                             for v in values)))
+
+  s['use_dataset'] = 'synthetic_conll'
+  s['synthetic_conll'] = {"datasets": datasets, "this_relation": "all",
+                          "label_key": "Sense", "mapping": mapping_path}
+  s['embedding'] = {"model_path": emb_path,
+                    "small_model_path": os.path.join(data_dir, 'embedding.json')}
+  return hparams, s
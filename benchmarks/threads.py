@@ -0,0 +1,69 @@
+"""
+Training steps per second against session thread configuration. Each
+configuration runs in a fresh process, since tensorflow creates its thread
+pools once per process.
+
+python benchmarks/threads.py --configs 1x1,2x1,4x1,4x2 --cpus 0-3
+"""
+import json
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from synthetic import synthetic_setup
+
+def steps_per_sec(intra, inter, cpus, steps, warmup, overrides, queue):
+  """ Process target, time training steps on a fixed batch """
+  import tensorflow as tf
+  from helper import MiniData
+  from enc_dec import EncDecClass
+  from training import feed_dict
+  from utils import session_config, set_cpu_affinity
+  if cpus is not None:
+    set_cpu_affinity(cpus)
+  hparams, s, dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                                  synthetic_setup(**overrides)
+  batch = MiniData(dataset_dict['training_set'], list(range(hparams.batch_size)))
+  with tf.Graph().as_default(), \
+        tf.Session(config=session_config(s, intra, inter)) as sess:
+    model = EncDecClass(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+    feed = feed_dict(model, batch, hparams.keep_prob, 1)
+    for _ in range(warmup):
+      sess.run(model.optimize, feed)
+    start = datetime.now()
+    for _ in range(steps):
+      sess.run(model.optimize, feed)
+    seconds = (datetime.now() - start).total_seconds()
+  queue.put(steps / seconds)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--configs', default="1x1,2x1,2x2,4x1,4x2,0x0",
+                      help='intra x inter op threads, 0 lets tensorflow decide')
+  parser.add_argument('--cpus', help='pin each run to these cpus, such as 0-3')
+  parser.add_argument('--cell_type', default="BNLSTMCell")
+  parser.add_argument('--steps', type=int, default=50)
+  parser.add_argument('--warmup', type=int, default=5)
+  parser.add_argument('--output', help='save results to this json file')
+  args = parser.parse_args()
+
+  overrides = dict(train_size=256, eval_size=32, cell_type=args.cell_type)
+  ctx = multiprocessing.get_context('spawn')
+  results = []
+  print('{:>6} {:>6} {:>10}'.format('intra', 'inter', 'steps/sec'))
+  for conf in args.configs.split(','):
+    intra, inter = [int(x) for x in conf.split('x')]
+    queue = ctx.Queue()
+    p = ctx.Process(target=steps_per_sec, args=(intra, inter, args.cpus,
+                              args.steps, args.warmup, overrides, queue))
+    p.start()
+    rate = queue.get()
+    p.join()
+    results.append({"intra": intra, "inter": inter, "cpus": args.cpus,
+                    "cell_type": args.cell_type, "steps_per_sec": rate})
+    print('{:>6} {:>6} {:>10.2f}'.format(intra, inter, rate))
+  if args.output is not None:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
@@ -0,0 +1,118 @@
+"""
+Encoder output cache
+
+The encoder outputs and final state of each sample are kept in float16,
+trimmed to the sample encoder length, in an LRU bounded in bytes. Entries are
+keyed by dataset name, sample index and a version of the encoder weights.
+The decoder and classifier are then fed the cached tensors instead of running
+the encoder, such as when scoring each candidate class with a class
+conditioned EncDecGen, or training the head of a model with a frozen encoder.
+
+Cached outputs are computed without dropout.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from tensorflow.contrib.framework import nest
+
+class EncoderCache():
+  """ LRU of encoder outputs and states, at most max_bytes of arrays """
+  def __init__(self, max_bytes, dtype=np.float16):
+    self.max_bytes = max_bytes
+    self.dtype = dtype
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """ (outputs, state) of key, or None """
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._entries.move_to_end(key)
+    return entry
+
+  def put(self, key, outputs, state):
+    """ Store the encoder outputs [seq_len, units] and list of state arrays
+    of a sample, returns the stored (outputs, state) """
+    entry = (outputs.astype(self.dtype), [s.astype(self.dtype) for s in state])
+    size = entry_bytes(entry)
+    if key in self._entries:
+      self.nbytes -= entry_bytes(self._entries.pop(key))
+    while self._entries and self.nbytes + size > self.max_bytes:
+      _, old = self._entries.popitem(last=False)
+      self.nbytes -= entry_bytes(old)
+      self.evictions += 1
+    if size <= self.max_bytes:
+      self._entries[key] = entry
+      self.nbytes += size
+    return entry
+
+  def clear(self):
+    self._entries.clear()
+    self.nbytes = 0
+
+  def stats(self):
+    return {"entries": len(self), "bytes": self.nbytes, "hits": self.hits,
+            "misses": self.misses, "evictions": self.evictions}
+
+def entry_bytes(entry):
+  outputs, state = entry
+  return outputs.nbytes + sum(s.nbytes for s in state)
+
+def weight_version(sess, model, frozen):
+  """ Version of the encoder weights for cache keys: constant if the encoder
+  is frozen, else the global step. Clear the cache after a restore """
+  if frozen == True:
+    return 0
+  return int(sess.run(model.global_step))
+
+def encoder_tensors(model):
+  """ Encoder outputs, then the leaves of the encoder state """
+  return [model.encoded_outputs] + nest.flatten(model.encoded_state)
+
+def encoder_feed(sess, model, batch, cache=None, version=0, name=None):
+  """ Feed of the encoder tensors for a batch of make_batches. The encoder
+  runs only for the samples not in cache, once if no cache is given
+  Args:
+    name: dataset name for the cache keys, as samples are keyed by index
+  """
+  tensors = encoder_tensors(model)
+  enc_len = batch.seq_len_encoder
+  enc_input = batch.encoder_input
+  max_len = max(enc_len)
+
+  def run_encoder(rows):
+    length = enc_len[rows]
+    return sess.run(tensors, {model.enc_input: enc_input[rows, :max(length)],
+                              model.enc_input_len: length,
+                              model.keep_prob: 1, model.mode: 0})
+
+  if cache is None:
+    values = run_encoder(np.arange(len(enc_len)))
+    return dict(zip(tensors, values))
+
+  keys = [(name, int(i), version) for i in batch.indices]
+  entries = [cache.get(k) for k in keys]
+  missing = np.array([j for j, e in enumerate(entries) if e is None], dtype=int)
+  if len(missing) > 0:
+    values = run_encoder(missing)
+    for r, j in enumerate(missing):
+      entries[j] = cache.put(keys[j], values[0][r, :enc_len[j]],
+                             [v[r] for v in values[1:]])
+
+  # Pad the outputs to the batch longest sequence, as the encoder does
+  units = entries[0][0].shape[1]
+  outputs = np.zeros((len(keys), max_len, units), dtype=np.float32)
+  for j, (out, _) in enumerate(entries):
+    outputs[j, :len(out)] = out
+  states = [np.stack([e[1][i] for e in entries]).astype(np.float32) \
+            for i in range(len(tensors) - 1)]
+  return dict(zip(tensors, [outputs] + states))
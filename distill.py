@@ -0,0 +1,147 @@
+"""
+Distill a trained EncDecClass into a small student classifier, see student.py
+
+The teacher labels a corpus of relations, unlabeled or not, with its class
+probabilities at settings["distill"]["temperature"]. The student is trained
+on these soft labels with the same vocab and embeddings, and evaluated on the
+gold labels of the validation set, where its best checkpoint is kept.
+Teacher and student are then compared on the validation and test sets:
+f1, accuracy, agreement with the teacher and relations per second.
+
+python distill.py --checkpoint_dir ckpt --corpus data/unlabeled.json
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from export import restore
+from quantize import class_logits, softmax, compare, evaluate
+from training import train_classification
+from utils import Progress
+from student import Student
+
+def soft_labels(logits, temperature):
+  """ Class probabilities of logits at temperature """
+  return softmax(logits / temperature).astype(np.float32)
+
+def timed_logits(sess, model, data, batch_size):
+  """ Class logits of data, and relations per second """
+  start = datetime.now()
+  logits = class_logits(sess, model, data, batch_size)
+  seconds = (datetime.now() - start).total_seconds()
+  return logits, data.size() / seconds
+
+def num_params():
+  """ Trainable values of the current graph """
+  return int(sum(np.prod(v.get_shape().as_list()) \
+                 for v in tf.trainable_variables()))
+
+def distill(Teacher, hparams, embedding, emb_dim, dataset_dict, vocab,
+            inv_vocab, checkpoint_dir, corpus, output_dir, config=None):
+  """ Label corpus with the teacher of checkpoint_dir, train the student and
+  save its best checkpoint to output_dir
+  Args:
+    corpus: Data object to distill on, its classes are replaced
+  Returns:
+    report dictionary
+  """
+  batch_size = hparams.batch_size
+  datasets = [(name, dataset_dict[name]) for name in \
+              ['validation_set', 'test_set'] if name in dataset_dict]
+  report = {"temperature": hparams.temperature, "corpus_size": corpus.size(),
+            "teacher": {}, "student": {}}
+
+  # Teacher soft labels, classes are fed but not used for the logits
+  corpus.classes = np.zeros((corpus.size(), hparams.num_classes), dtype='int32')
+  teacher_logits = {}
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
+    teacher = Teacher(hparams, embedding, emb_dim)
+    restore(sess, checkpoint_dir)
+    report["teacher"]["params"] = num_params()
+    logits, _ = timed_logits(sess, teacher, corpus, batch_size)
+    corpus.classes = soft_labels(logits, hparams.temperature)
+    report["teacher"]["scores"] = evaluate(sess, teacher, datasets, batch_size)
+    for name, data in datasets:
+      teacher_logits[name], speed = timed_logits(sess, teacher, data,
+                                                 batch_size)
+      report["teacher"]["scores"][name]["relations_per_sec"] = speed
+
+  # Student, trained on the soft labels and validated on the gold labels
+  distill_dict = dict(dataset_dict, training_set=corpus)
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+  ckpt_path = os.path.join(output_dir, 'student.ckpt')
+  prog = Progress(batches=corpus.num_batches(batch_size), progress_bar=True,
+                  bar_length=10)
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
+    tf.set_random_seed(1)
+    student = Student(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), student.init_feed)
+    saver = tf.train.Saver(max_to_keep=1)
+    checkpoint = lambda: saver.save(sess, ckpt_path)
+    train_classification(sess, hparams, prog, student, distill_dict, vocab,
+                         inv_vocab, checkpoint)
+    saver.restore(sess, ckpt_path)
+    report["student"]["params"] = num_params()
+    report["student"]["scores"] = evaluate(sess, student, datasets, batch_size)
+    for name, data in datasets:
+      logits, speed = timed_logits(sess, student, data, batch_size)
+      scores = report["student"]["scores"][name]
+      scores["relations_per_sec"] = speed
+      _, scores["agreement"] = compare(teacher_logits[name], logits)
+
+  with open(os.path.join(output_dir, 'distillation.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+  return report
+
+def print_report(report):
+  print('Distilled on {} relations at temperature {}'.format(
+        report["corpus_size"], report["temperature"]))
+  print('Parameters: teacher {}, student {}'.format(
+        report["teacher"]["params"], report["student"]["params"]))
+  print('{:>16} {:>8} {:>8} {:>8} {:>8} {:>9} {:>12} {:>12}'.format('dataset',
+        'f1', 'stu f1', 'acc', 'stu acc', 'agreement', 'teacher r/s',
+        'student r/s'))
+  for name, t in report["teacher"]["scores"].items():
+    s = report["student"]["scores"][name]
+    print('{:>16} {:>8.4f} {:>8.4f} {:>8.4f} {:>8.4f} {:>9.4f} {:>12.0f} '
+          '{:>12.0f}'.format(name, t["f1"], s["f1"], t["acc"], s["acc"],
+          s["agreement"], t["relations_per_sec"], s["relations_per_sec"]))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--settings', default='settings.json')
+  parser.add_argument('--checkpoint_dir',
+                      help='trained teacher, default settings checkpoint_dir')
+  parser.add_argument('--corpus',
+                      help='relations json, default settings distill corpus')
+  parser.add_argument('--output', help='default checkpoint_dir/student')
+  args = parser.parse_args()
+
+  from helper import settings, get_data_embeddings, get_unlabeled
+  from enc_dec import EncDecClass
+  from utils import session_config
+  hparams, s = settings(args.settings)
+  hparams.update(**{k: v for k, v in s['distill'].items() if k != 'corpus'})
+  checkpoint_dir = args.checkpoint_dir or s['checkpoint_dir']
+  if checkpoint_dir is None:
+    parser.error('no checkpoint_dir given or in settings')
+  output_dir = args.output or os.path.join(checkpoint_dir, 'student')
+
+  dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                        get_data_embeddings(hparams, s)
+  corpus_path = args.corpus or s['distill']['corpus']
+  if corpus_path is None:
+    corpus = dataset_dict['training_set'].subset(
+                        np.arange(dataset_dict['training_set'].size()))
+  else:
+    corpus = get_unlabeled(corpus_path, hparams, vocab)
+  report = distill(EncDecClass, hparams, embedding, emb_dim, dataset_dict,
+                   vocab, inv_vocab, checkpoint_dir, corpus, output_dir,
+                   config=session_config(s))
+  print_report(report)
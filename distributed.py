@@ -0,0 +1,123 @@
+"""
+Data-parallel training with between-graph replication.
+
+Each worker builds the same graph, variables are placed on the parameter
+servers and each worker trains on its own shard of the training set. The
+chief (worker 0) also evaluates, early stops and saves checkpoints. With
+sync_replicas every step waits for a batch of each worker, so all workers run
+the same number of steps and early stopping is not allowed. Start one
+process per host in settings["distributed"], for example:
+
+python main.py --task classification --job_name ps --task_index 0
+python main.py --task classification --job_name worker --task_index 0
+python main.py --task classification --job_name worker --task_index 1
+"""
+import tensorflow as tf
+from pprint import pprint
+from utils import Progress
+from helper import epoch_rng
+from training import train_classification, train_one_epoch
+
+# Steps between two reads of the stop flag by the asynchronous workers, each
+# read is a round trip to the parameter server
+STOP_POLL_STEPS = 20
+
+def cluster_spec(settings):
+  """ ClusterSpec from the comma separated hosts in settings """
+  dist = settings['distributed']
+  return tf.train.ClusterSpec({
+    "ps"     : dist['ps_hosts'].split(','),
+    "worker" : dist['worker_hosts'].split(',')})
+
+def train_distributed(hparams, settings, Model, embedding, emb_dim,
+        dataset_dict, vocab, inv_vocab, job_name, task_index, config=None):
+  """ Start a parameter server or train as one of the workers
+  Returns:
+    Metrics object for the chief, None otherwise
+  """
+  cluster = cluster_spec(settings)
+  server = tf.train.Server(cluster, job_name=job_name, task_index=task_index,
+                           config=config)
+  if job_name == "ps":
+    server.join() # serves variables until killed
+    return None
+
+  num_workers = cluster.num_tasks("worker")
+  is_chief = task_index == 0
+  hparams.update(num_workers=num_workers)
+  sync = hparams.sync_replicas == True and num_workers > 1
+  if sync and (hparams.early_stop_epoch < hparams.nb_epochs or \
+               hparams.early_stop_steps is not None):
+    # A worker that stops early would leave the others waiting for its
+    # gradients at every following step
+    raise ValueError("sync_replicas needs every worker to run all steps: set "
+                     "early_stop_epoch to at least nb_epochs and "
+                     "early_stop_steps to None")
+  train_set = dataset_dict['training_set']
+  num_batches = train_set.num_batches(hparams.batch_size, num_workers)
+  prog = Progress(batches=num_batches, progress_bar=True, bar_length=10,
+                  batch_size=hparams.batch_size)
+  print('Worker {} of {}, shard size: {}'.format(
+                  task_index, num_workers, num_batches * hparams.batch_size))
+  if is_chief:
+    pprint(vars(hparams))
+
+  with tf.Graph().as_default():
+    tf.set_random_seed(1)
+    device = tf.train.replica_device_setter(
+        worker_device="/job:worker/task:{}".format(task_index), cluster=cluster)
+    with tf.device(device):
+      model = Model(hparams, embedding, emb_dim)
+      # Set by the chief when training is over, read by the other workers
+      stop_flag = tf.Variable(False, name="stop_training", trainable=False)
+      set_stop = tf.assign(stop_flag, True)
+    if model.model_type != "classification":
+      raise ValueError("Distributed training only supports classification")
+
+    hooks = []
+    if model.sync_optimizer is not None:
+      hooks.append(model.sync_optimizer.make_session_run_hook(is_chief))
+
+    checkpoint_dir = settings['checkpoint_dir'] if is_chief else None
+    scaffold = tf.train.Scaffold(init_feed_dict=model.init_feed)
+    met = None
+    with tf.train.MonitoredTrainingSession(master=server.target,
+        is_chief=is_chief, checkpoint_dir=checkpoint_dir, hooks=hooks,
+        scaffold=scaffold, config=config, save_summaries_steps=None) as sess:
+      if is_chief:
+        met = train_classification(sess, hparams, prog, model, dataset_dict,
+                  vocab, inv_vocab, shard_index=task_index,
+                  num_shards=num_workers)
+        sess.run(set_stop)
+      elif sync:
+        # Each global step takes a batch from every worker: all workers run
+        # the chief's nb_epochs * num_batches steps, a smaller shard repeats.
+        # Pass i of the shard is shuffled as the chief's epoch i
+        steps = [0]
+        def step_hook(step):
+          steps[0] += 1
+          return steps[0] >= hparams.nb_epochs * num_batches
+        stop = False
+        epoch = 0
+        while stop == False:
+          prog.epoch_start()
+          stop = train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                hparams.batch_size, num_batches, prog, step_hook=step_hook,
+                shard_index=task_index, num_shards=num_workers,
+                bucket=hparams.bucket, rng=epoch_rng(epoch))
+          prog.epoch_end()
+          epoch += 1
+      else:
+        steps = [0]
+        def step_hook(step):
+          steps[0] += 1
+          return steps[0] % STOP_POLL_STEPS == 0 and sess.run(stop_flag)
+        for epoch in range(hparams.nb_epochs):
+          prog.epoch_start()
+          stop = train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                hparams.batch_size, num_batches, prog, step_hook=step_hook,
+                shard_index=task_index, num_shards=num_workers,
+                bucket=hparams.bucket, rng=epoch_rng(epoch))
+          prog.epoch_end()
+          if stop == True: break
+  return met
@@ -7,6 +7,7 @@ import os.path
 import codecs
 import json
 import numpy as np
+from profiling import stage, timed
 
 class Embeddings():
   def __init__(self, vocab, inverse_vocab, random_init_unknown, unknown_tag):
@@ -38,18 +39,21 @@ class Embeddings():
     if model_path == None:
       assert load_saved == True
     if load_saved and os.path.isfile(embedding_file):
-      return self._load_embedding_from_json(embedding_file, self.vocab)
+      with stage("load_json"):
+        return self._load_embedding_from_json(embedding_file, self.vocab)
     # Load large file
     else:
       ext = model_path.split('.')[-1]
-      if ext == "bin":
-        embedding = self._load_embedding_from_binary(model_path, self.vocab)
-      elif ext == "txt":
-        embedding = self._load_embedding_from_txt(model_path, self.vocab)
+      with stage("load_" + ext):
+        if ext == "bin":
+          embedding = self._load_embedding_from_binary(model_path, self.vocab)
+        elif ext == "txt":
+          embedding = self._load_embedding_from_txt(model_path, self.vocab)
 
     # Save embedding for future faster load
     if save:
-      self._save_embedding(embedding_file, embedding, self.inv_vocab)
+      with stage("save_json"):
+        self._save_embedding(embedding_file, embedding, self.inv_vocab)
 
     return embedding
 
@@ -131,6 +135,7 @@ class Embeddings():
       print("words randomly initialized: {}".format(out_of_model))
     return emb_matrix
 
+@timed("get_embeddings")
 def get_embeddings(hparams, vocab, inv_vocab, settings):
   """ Returns embedding numpy array """
   # Word embeddings
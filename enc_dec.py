@@ -1,11 +1,83 @@
 import tensorflow as tf
 
 from tensorflow.contrib.rnn import DropoutWrapper
+from tensorflow.contrib.framework import nest
 from tensorflow.contrib.layers import xavier_initializer as glorot
 from utils import dense
 from pydoc import locate
 from bnlstm import BNLSTMCell
 
+def float32_variable_getter(getter, name, shape=None, dtype=None, *args,
+                            trainable=True, **kwargs):
+  """ Custom getter for mixed precision: trainable variables are created in
+  float32 and cast to the requested dtype, so updates keep full precision
+  """
+  storage_dtype = tf.float32 if trainable else dtype
+  variable = getter(name, shape, storage_dtype, *args, trainable=trainable,
+                    **kwargs)
+  if trainable and dtype is not None and dtype != tf.float32:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+class SkipNonFiniteOptimizer(tf.train.Optimizer):
+  """ Wraps an optimizer for mixed precision: an update with an inf or NaN
+  gradient, from a float16 overflow, is skipped. The global step is still
+  incremented, so synchronous replicas keep their step count
+  """
+  def __init__(self, optimizer, name="SkipNonFinite"):
+    super(SkipNonFiniteOptimizer, self).__init__(False, name)
+    self._opt = optimizer
+
+  def compute_gradients(self, *args, **kwargs):
+    return self._opt.compute_gradients(*args, **kwargs)
+
+  def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+    grads_and_vars = list(grads_and_vars)
+    finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) \
+                            for g, _ in grads_and_vars if g is not None])
+    def skip():
+      if global_step is None:
+        return tf.no_op()
+      return tf.assign_add(global_step, 1).op
+    return tf.cond(finite, lambda: self._opt.apply_gradients(grads_and_vars,
+                   global_step, name), skip)
+
+  def get_slot(self, *args, **kwargs):
+    return self._opt.get_slot(*args, **kwargs)
+
+  def get_slot_names(self, *args, **kwargs):
+    return self._opt.get_slot_names(*args, **kwargs)
+
+class OutputProjection(tf.layers.Layer):
+  """ Projection to the vocab, without bias. The kernel is stored as
+  [vocab_size, units], the layout of tf.nn.sampled_softmax_loss weights, so
+  the sampled loss and the full projection share it without a transpose
+  """
+  def __init__(self, vocab_size, name="output_projection", **kwargs):
+    super().__init__(name=name, **kwargs)
+    self.vocab_size = vocab_size
+
+  def build(self, input_shape):
+    units = tf.TensorShape(input_shape)[-1].value
+    self.kernel = self.add_variable("kernel", [self.vocab_size, units],
+                                    dtype=self.dtype, initializer=glorot())
+    self.built = True
+
+  def call(self, inputs):
+    if inputs.get_shape().ndims == 2:
+      return tf.matmul(inputs, self.kernel, transpose_b=True)
+    # Outputs over time
+    shape = tf.shape(inputs)
+    outputs = tf.matmul(tf.reshape(inputs, [-1, shape[-1]]), self.kernel,
+                        transpose_b=True)
+    return tf.reshape(outputs, tf.concat([shape[:-1], [self.vocab_size]], 0))
+
+  def compute_output_shape(self, input_shape):
+    return tf.TensorShape(input_shape)[:-1].concatenate([self.vocab_size])
+
+  # Name of the method in earlier tensorflow versions
+  _compute_output_shape = compute_output_shape
+
 class EncDec():
   """ Encoder Decoder """
   def __init__(self,params, embedding,emb_dim, num_classes=None, output_layer=None):
@@ -18,7 +90,7 @@ class EncDec():
     global hparams
     hparams = params
     self.num_classes = num_classes
-    self.floatX = tf.float32
+    self.floatX = tf.as_dtype(hparams.precision) # compute precision
     self.intX = tf.int32
 
     # self.final_emb_dim = emb_dim + num_classes
@@ -28,8 +100,7 @@ class EncDec():
     else:
       decoder_num_units = hparams.cell_units
 
-    # helper variable to keep track of steps
-    self.global_step = tf.Variable(0, name='global_step', trainable=False)
+    self.step_setup()
 
     ############################
     # Inputs
@@ -41,9 +112,9 @@ class EncDec():
     # Embedding tensor is of shape [vocab_size x embedding_size]
     self.embedding_tensor = self.embedding_setup(embedding, hparams.emb_trainable)
 
-    # Encoder inputs
+    # Encoder inputs, batches may be trimmed to their longest sequence
     with tf.name_scope("encoder_input"):
-      self.enc_input = tf.placeholder(self.intX, shape=[None, hparams.max_seq_len])
+      self.enc_input = tf.placeholder(self.intX, shape=[None, None])
       self.enc_embedded = self.embedded(self.enc_input, self.embedding_tensor)
       # self.enc_embedded = tf.layers.batch_normalization(enc_embedded, training=self.mode)
       self.enc_input_len = tf.placeholder(self.intX, shape=[None,])
@@ -53,11 +124,14 @@ class EncDec():
 
     # Decoder inputs and targets
     with tf.name_scope("decoder_input"):
-      self.dec_targets = tf.placeholder(self.intX, shape=[None, hparams.max_seq_len])
-      self.dec_input = tf.placeholder(self.intX, shape=[None, hparams.max_seq_len])
+      self.dec_targets = tf.placeholder(self.intX, shape=[None, None])
+      self.dec_input = tf.placeholder(self.intX, shape=[None, None])
       self.dec_embedded = self.embedded(self.dec_input, self.embedding_tensor)
       # self.dec_embedded = tf.layers.batch_normalization(dec_embedded, training=self.mode)
-      # self.dec_embedded = self.emb_add_class(self.dec_embedded, self.classes)
+      if num_classes is not None:
+        # Condition the decoder on the class, the encoder does not see it
+        self.classes = tf.placeholder(self.intX, shape=[None, num_classes])
+        self.dec_embedded = self.emb_add_class(self.dec_embedded, self.classes)
       self.dec_input_len = tf.placeholder(self.intX, shape=[None,])
 
     self.batch_size = tf.shape(self.enc_input)[0]
@@ -65,67 +139,126 @@ class EncDec():
     ############################
     # Build Model
     ############################
-    # Setup cells
-    cell_enc_fw, cell_enc_bw, cell_enc, cell_dec = \
-        self.build_cell(hparams.cell_units, decoder_num_units, cell_type=hparams.cell_type)
-
-    # Get encoder data
-    with tf.name_scope("encoder"):
-      if hparams.bidirectional == True:
-        self.encoded_outputs, self.encoded_state = self.encoder_bi(cell_enc_fw, \
-                              cell_enc_bw, self.enc_embedded, self.enc_input_len)
-      else:
-        self.encoded_outputs, self.encoded_state = self.encoder_one_way(\
-                              cell_enc, self.enc_embedded, self.enc_input_len)
-
-    # Get decoder data
-    with tf.name_scope("decoder"):
-      # Get attention
-      self.attn_cell, self.initial_state = self.decoder_attn(
-                            self.batch_size,
-                            cell=cell_dec,
-                            mem_units=self.bi_encoder_hidden,
-                            attention_states=self.encoded_outputs,
-                            seq_len_enc=self.enc_input_len,
-                            attn_units=hparams.dec_out_units,
-                            encoder_state=self.encoded_state)
-
-      # Get decoder output hidden states
-      self.decoded_outputs, self.decoded_final_state, self.decoded_final_seq_len=\
-                      self.decoder_train(
-                            self.batch_size,
-                            attn_cell=self.attn_cell,
-                            initial_state=self.initial_state,
-                            decoder_inputs=self.dec_embedded,
-                            seq_len_dec=self.dec_input_len,
-                            output_layer=output_layer)
+    # Variables are stored in float32 and cast to the compute precision
+    self.custom_getter = None
+    if self.floatX != tf.float32:
+      self.custom_getter = float32_variable_getter
+    with tf.variable_scope(tf.get_variable_scope(),
+                           custom_getter=self.custom_getter):
+      # Setup cells
+      cell_enc_fw, cell_enc_bw, cell_enc, cell_dec = \
+          self.build_cell(hparams.cell_units, decoder_num_units,
+                          cell_type=hparams.cell_type,
+                          num_layers=hparams.num_layers,
+                          residual=hparams.residual)
+
+      # Get encoder data
+      trainable = set(tf.trainable_variables())
+      with tf.name_scope("encoder"):
+        if hparams.bidirectional == True:
+          self.encoded_outputs, self.encoded_state = self.encoder_bi(cell_enc_fw, \
+                                cell_enc_bw, self.enc_embedded, self.enc_input_len,
+                                residual=hparams.residual)
+        else:
+          self.encoded_outputs, self.encoded_state = self.encoder_one_way(\
+                                cell_enc, self.enc_embedded, self.enc_input_len,
+                                residual=hparams.residual)
+      self.encoder_variables = [v for v in tf.trainable_variables() \
+                                if v not in trainable]
+
+      # Get decoder data
+      with tf.name_scope("decoder"):
+        # Get attention
+        self.attn_cell, self.initial_state = self.decoder_attn(
+                              self.batch_size,
+                              cell=cell_dec,
+                              mem_units=self.bi_encoder_hidden,
+                              attention_states=self.encoded_outputs,
+                              seq_len_enc=self.enc_input_len,
+                              attn_units=hparams.dec_out_units,
+                              encoder_state=self.encoded_state)
+
+        # Get decoder output hidden states
+        self.decoded_outputs, self.decoded_final_state, self.decoded_final_seq_len=\
+                        self.decoder_train(
+                              self.batch_size,
+                              attn_cell=self.attn_cell,
+                              initial_state=self.initial_state,
+                              decoder_inputs=self.dec_embedded,
+                              seq_len_dec=self.dec_input_len,
+                              output_layer=output_layer)
 
     self.alignment_history = self.decoded_final_state.alignment_history.stack()
 
     # Merged summary ops
     self.merged_summary_ops = tf.summary.merge_all()
 
+  def step_setup(self):
+    """ Global step and learning rate variables """
+    # helper variable to keep track of steps
+    self.global_step = tf.Variable(0, name='global_step', trainable=False)
+
+    # Learning rate as variable, so it can be decayed during training
+    self.l_rate = tf.Variable(hparams.l_rate, name='l_rate', trainable=False,
+                              dtype=tf.float32)
+    self.new_l_rate = tf.placeholder(tf.float32, shape=[], name="new_l_rate")
+    self.l_rate_update = tf.assign(self.l_rate, self.new_l_rate)
+    self.sync_optimizer = None # set in optimize_step if synchronous replicas
+
   def optimize_step(self, loss, glbl_step):
     """ Locate optimizer from hparams, take a step """
     Opt = locate("tensorflow.train." + hparams.optimizer)
     if Opt is None:
       raise ValueError("Invalid optimizer: " + hparams.optimizer)
-    optimizer = Opt(hparams.l_rate)
-    grads_vars = optimizer.compute_gradients(loss)
-    capped_grads = [(None if grad is None else tf.clip_by_value(grad, -1., 1.), var)\
+    optimizer = Opt(self.l_rate)
+    var_list = None
+    if hparams.freeze_encoder == True:
+      # Only the decoder and heads are trained, encoder outputs may be cached
+      frozen = set(self.encoder_variables + [self.embedding_tensor])
+      var_list = [v for v in tf.trainable_variables() if v not in frozen]
+    mixed = self.floatX != tf.float32
+    if mixed:
+      optimizer = SkipNonFiniteOptimizer(optimizer)
+    if hparams.sync_replicas == True and hparams.num_workers > 1:
+      # Average gradients of all workers before each update
+      optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                          replicas_to_aggregate=hparams.num_workers,
+                          total_num_replicas=hparams.num_workers)
+      self.sync_optimizer = optimizer
+    # Scale the loss so small float16 gradients do not underflow
+    loss_scale = hparams.loss_scale if mixed else 1.
+    grads_vars = optimizer.compute_gradients(loss * loss_scale,
+                                             var_list=var_list)
+    def cap(grad):
+      grad = grad / loss_scale
+      capped = tf.clip_by_value(grad, -1., 1.)
+      if mixed:
+        # Clipping would turn an overflow into +-1, keep it to skip the update
+        capped = tf.where(tf.is_finite(grad), capped, grad)
+      return capped
+    capped_grads = [(None if grad is None else cap(grad), var) \
                                                   for grad, var in grads_vars]
     take_step = optimizer.apply_gradients(capped_grads, global_step=glbl_step)
     return take_step
 
+  def decay_l_rate(self, sess, factor, min_l_rate=0.):
+    """ Multiply the learning rate by factor, returns the new learning rate """
+    l_rate = max(sess.run(self.l_rate) * factor, min_l_rate)
+    sess.run(self.l_rate_update, feed_dict={self.new_l_rate: l_rate})
+    return l_rate
+
   def embedding_setup(self, embedding, emb_trainable):
-    """ If trainable, returns variable, otherwise the original embedding """
-    if emb_trainable == True:
-      emb_variable = tf.get_variable(
-          name="embedding_matrix", shape=embedding.shape,
-          initializer = tf.constant_initializer(embedding))
-      return emb_variable
-    else:
-      return embedding
+    """ Embedding variable, trained only if emb_trainable. The matrix is fed
+    to the initializer through a placeholder instead of a graph constant, so
+    run the variable initializers with self.init_feed
+    """
+    self.embedding_init = tf.placeholder(tf.float32, shape=embedding.shape,
+                                         name="embedding_init")
+    self.init_feed = {self.embedding_init: embedding}
+    emb_variable = tf.get_variable(name="embedding_matrix",
+                                   initializer=self.embedding_init,
+                                   trainable=emb_trainable == True)
+    return emb_variable
 
   def embedded(self, word_ids, embedding_tensor, scope="embedding"):
     """Swap ints for dense embeddings, on cpu.
@@ -141,39 +274,74 @@ class EncDec():
     with tf.variable_scope(scope):
       with tf.device("/cpu:0"):
         inputs = tf.nn.embedding_lookup(embedding_tensor, word_ids)
+      inputs = tf.cast(inputs, self.floatX)
     return inputs
 
-  def build_cell(self, num_units, decoder_num_units, cell_type="LSTMCell"):
-    if cell_type == "BNLSTMCell":
-      Cell = BNLSTMCell
-      cell_enc_fw = Cell(num_units, is_training=self.mode)
-      cell_enc_bw = Cell(num_units, is_training=self.mode)
-      cell_enc = Cell(num_units, is_training=self.mode)
-      cell_dec = Cell(decoder_num_units, is_training=self.mode)
-    else:
-      Cell = locate("tensorflow.contrib.rnn." + cell_type)
-      if Cell is None:
-        raise ValueError("Invalid cell type " + cell_type)
-      cell_enc_fw = Cell(num_units)
-      cell_enc_bw = Cell(num_units)
-      cell_enc = Cell(num_units)
-      cell_dec = Cell(decoder_num_units)
-
-    # Dropout wrapper
-    cell_enc_fw = DropoutWrapper(cell_enc_fw, output_keep_prob=self.keep_prob)
-    cell_enc_bw = DropoutWrapper(cell_enc_bw, output_keep_prob=self.keep_prob)
-    cell_enc = DropoutWrapper(cell_enc, output_keep_prob=self.keep_prob)
-    cell_dec = DropoutWrapper(cell_dec, output_keep_prob=self.keep_prob)
+  def build_cell(self, num_units, decoder_num_units, cell_type="LSTMCell",
+                 num_layers=1, residual=False):
+    """ Encoder cells (forward, backward, one way) and the decoder cell, each
+    a stack of num_layers cells. The decoder has as many layers as the
+    encoder, so that each encoder layer final state initializes a decoder layer
+    """
+    if cell_type == "LSTMBlockFusedCell":
+      # Fused cells run the whole sequence in a single op, for the encoder.
+      # The attention decoder steps one at a time, so it uses the block cell
+      Fused = tf.contrib.rnn.LSTMBlockFusedCell
+      cell_enc_fw = [Fused(num_units) for _ in range(num_layers)]
+      cell_enc_bw = [Fused(num_units) for _ in range(num_layers)]
+      cell_enc = [Fused(num_units) for _ in range(num_layers)]
+      cell_dec = self.stacked_cell(decoder_num_units, "LSTMBlockCell",
+                                   num_layers, residual)
+      return cell_enc_fw, cell_enc_bw, cell_enc, cell_dec
+
+    cell_enc_fw = self.stacked_cell(num_units, cell_type, num_layers, residual)
+    cell_enc_bw = self.stacked_cell(num_units, cell_type, num_layers, residual)
+    cell_enc = self.stacked_cell(num_units, cell_type, num_layers, residual)
+    cell_dec = self.stacked_cell(decoder_num_units, cell_type, num_layers,
+                                 residual)
     return cell_enc_fw, cell_enc_bw, cell_enc, cell_dec
 
-  def encoder_one_way(self, cell, x, seq_len, init_state=None):
+  def stacked_cell(self, num_units, cell_type, num_layers, residual=False):
+    """ Stack of num_layers cells, each with dropout on its outputs
+    Args:
+      residual: add each layer input to its output, from the second layer
+        since the first layer input is the embedding
+    """
+    cells = []
+    for i in range(num_layers):
+      if cell_type == "BNLSTMCell":
+        cell = BNLSTMCell(num_units, is_training=self.mode)
+      else:
+        Cell = locate("tensorflow.contrib.rnn." + cell_type)
+        if Cell is None:
+          raise ValueError("Invalid cell type " + cell_type)
+        cell = Cell(num_units)
+
+      # Dropout wrapper
+      cell = DropoutWrapper(cell, output_keep_prob=self.keep_prob)
+      if residual == True and i > 0:
+        cell = tf.contrib.rnn.ResidualWrapper(cell)
+      cells.append(cell)
+
+    # Single layer is not wrapped, to keep the variable names
+    if num_layers == 1:
+      return cells[0]
+    return tf.contrib.rnn.MultiRNNCell(cells)
+
+  def encoder_one_way(self, cell, x, seq_len, init_state=None, residual=False):
     """ Dynamic encoder for one direction
+    Args:
+      residual: for fused cells, see encoder_fused. The other cells are
+        wrapped by stacked_cell
     Returns:
       outputs: all sequence hidden states as Tensor of shape [batch,time,units]
       state: last hidden state
     """
     # Output is the outputs at all time steps, state is the last state
     with tf.variable_scope("dynamic_rnn"):
+      if type(cell) is list:
+        return self.encoder_fused(cell, x, seq_len, init_state,
+                                  residual=residual)
       outputs, state = tf.nn.dynamic_rnn(\
                   cell, x, sequence_length=seq_len, initial_state=init_state,
                   dtype=self.floatX)
@@ -181,8 +349,10 @@ class EncDec():
     return outputs, state
 
   def encoder_bi(self, cell_fw, cell_bw, x, seq_len, init_state_fw=None,
-                  init_state_bw=None):
+                  init_state_bw=None, residual=False):
     """ Dynamic encoder for two directions
+    Args:
+      residual: for fused cells, see encoder_one_way
     Returns:
       outputs: a tuple(output_fw, output_bw), all sequence hidden states, each
                as tensor of shape [batch,time,units]
@@ -191,7 +361,16 @@ class EncDec():
     """
     # Output is the outputs at all time steps, state is the last state
     with tf.variable_scope("bidirectional_dynamic_rnn"):
-      outputs, state = tf.nn.bidirectional_dynamic_rnn(\
+      if type(cell_fw) is list:
+        with tf.variable_scope("bidirectional_rnn"):
+          out_fw, state_fw = self.encoder_fused(cell_fw, x, seq_len,
+                                    init_state_fw, scope="fw", residual=residual)
+          out_bw, state_bw = self.encoder_fused(cell_bw, x, seq_len,
+                                    init_state_bw, scope="bw", reverse=True,
+                                    residual=residual)
+        outputs, state = (out_fw, out_bw), (state_fw, state_bw)
+      else:
+        outputs, state = tf.nn.bidirectional_dynamic_rnn(\
                   cell_fw=cell_fw,
                   cell_bw=cell_bw,
                   inputs=x,
@@ -204,33 +383,64 @@ class EncDec():
       # Since we don't need the outputs separate, we concat here
       outputs = tf.concat(outputs,2)
       outputs.set_shape([None, None, self.bi_encoder_hidden])
-      # If LSTM cell, then "state" is not a tuple of Tensors but an
-      # LSTMStateTuple of "c" and "h". Need to concat separately then new
-      if "LSTMStateTuple" in str(type(state[0])):
-        c = tf.concat([state[0][0],state[1][0]],axis=1)
-        h = tf.concat([state[0][1],state[1][1]],axis=1)
-        state = tf.contrib.rnn.LSTMStateTuple(c,h)
-      else:
-        state = tf.concat(state,1)
-        # Manually set shape to Tensor or all hell breaks loose
-        state.set_shape([None, self.bi_encoder_hidden])
+      # The state may be a Tensor, an LSTMStateTuple of "c" and "h", or a
+      # tuple of those for each layer. Concat each Tensor separately
+      state = nest.map_structure(self.concat_state, state[0], state[1])
+    return outputs, state
+
+  def concat_state(self, state_fw, state_bw):
+    """ Concat forward and backward state Tensors """
+    state = tf.concat([state_fw, state_bw], 1)
+    # Manually set shape to Tensor or all hell breaks loose
+    state.set_shape([None, self.bi_encoder_hidden])
+    return state
+
+  def encoder_fused(self, cells, x, seq_len, init_state=None, scope=None,
+                    reverse=False, residual=False):
+    """ Encoder with a stack of fused cells, each layer is a single op
+    Outputs are zero past seq_len and dropout is applied to each layer
+    outputs, as with DropoutWrapper for the other cells
+    Args:
+      cells: list of FusedRNNCell, one per layer
+      residual: add each layer input to its output, from the second layer,
+        as stacked_cell
+    Returns:
+      see encoder_one_way, the state is a tuple of layer states if more than
+      one layer
+    """
+    states = []
+    with tf.variable_scope(scope, default_name="fused_rnn"):
+      outputs = tf.transpose(x, [1, 0, 2]) # fused cells are time major
+      for i, cell in enumerate(cells):
+        if reverse:
+          cell = tf.contrib.rnn.TimeReversedFusedRNN(cell)
+        layer_init = init_state
+        if init_state is not None and len(cells) > 1:
+          layer_init = init_state[i]
+        inputs = outputs
+        if len(cells) > 1:
+          # Same scopes as MultiRNNCell layers
+          with tf.variable_scope("cell_{}".format(i)):
+            outputs, state = cell(inputs, initial_state=layer_init,
+                                  sequence_length=seq_len, dtype=self.floatX)
+        else:
+          outputs, state = cell(inputs, initial_state=layer_init,
+                                sequence_length=seq_len, dtype=self.floatX)
+        outputs = tf.nn.dropout(outputs, self.keep_prob)
+        if residual == True and i > 0:
+          outputs = outputs + inputs
+        states.append(state)
+      outputs = tf.transpose(outputs, [1, 0, 2])
+    state = states[0] if len(states) == 1 else tuple(states)
     return outputs, state
 
   def emb_add_class(self, enc_embedded, classes):
     """ Concatenate input and classes. Do not use for classification """
-
-    num_classes = tf.shape(classes)[1]
-    # final_emb_dim = tf.to_int32(tf.shape(enc_embedded)[2] + num_classes)
     time_steps = tf.shape(enc_embedded)[1]
-    classes = tf.tile(classes, [1, time_steps]) # copy along axis=1 only
-    classes = tf.reshape(classes, [-1, time_steps, num_classes]) # match input
-    classes = tf.cast(classes, self.floatX)
+    classes = tf.cast(tf.expand_dims(classes, 1), self.floatX)
+    # Copy along time, the static shape is kept for contrib.rnn
+    classes = tf.tile(classes, [1, time_steps, 1])
     concat = tf.concat([enc_embedded, classes], 2) # concat 3rd dimension
-
-    # Hardset the shape. This is hacky, but because of tf.reshape, it seems the
-    # tensor loses it's shape property which causes problems with contrib.rnn
-    # wich uses the shape property
-    concat.set_shape([None, None, self.final_emb_dim])
     return concat
 
   def add_classes_to_state(self, state_tuple, classes):
@@ -341,9 +551,9 @@ class EncDec():
     """
     with tf.variable_scope(scope):
       w = tf.get_variable("weights", [num_units, vocab_size],
-          dtype=self.floatX, initializer=glorot())
+          dtype=decoded_outputs.dtype, initializer=glorot())
       b = tf.get_variable("biases", [vocab_size],
-          dtype=self.floatX, initializer=tf.constant_initializer(0.0))
+          dtype=decoded_outputs.dtype, initializer=tf.constant_initializer(0.0))
 
       logits = tf.matmul(decoded_outputs, w) + b
     return logits
@@ -380,17 +590,11 @@ class EncDecClass(EncDec):
       self.classes = tf.placeholder(self.intX, shape=[None, hparams.num_classes])
 
     with tf.name_scope("classification"):
-      if hparams.class_over_sequence == True:
-        # Classification over entire sequence output
-        self.class_logits = self.sequence_class_logits(\
-            decoded_outputs=self.decoded_outputs,
-            pool_size=hparams.dec_out_units,
-            max_seq_len=hparams.max_seq_len,
-            num_classes=hparams.num_classes)
-      else:
-        # Classification input uses only sequence final state
-        self.class_logits = self.output_logits(self.decoded_final_state.attention,
-                  hparams.dec_out_units, hparams.num_classes, "class_softmax")
+      # The classification head always runs in float32
+      self.keep_prob_head = tf.cast(self.keep_prob, tf.float32)
+      self.class_logits = self.class_head(hparams.num_classes,
+                                          self.decoded_final_state.attention,
+                                          self.decoded_outputs.rnn_output)
 
     # Classification loss
     self.loss = self.classification_loss(self.classes, self.class_logits)
@@ -404,10 +608,32 @@ class EncDecClass(EncDec):
     # Loss ###################
     self.optimize = self.optimize_step(self.cost,self.global_step)
 
+  def class_head(self, num_classes, attention, rnn_output):
+    """ Class logits in float32
+    Args:
+      attention: decoder final attention, [batch_size, dec_out_units]
+      rnn_output: decoder outputs, [batch_size, dec_seq_len, dec_out_units]
+    """
+    if hparams.class_over_sequence == True:
+      # Classification over entire sequence output
+      return self.sequence_class_logits(\
+          decoded_outputs=tf.cast(rnn_output, tf.float32),
+          pool_size=hparams.dec_out_units,
+          max_seq_len=hparams.max_seq_len,
+          num_classes=num_classes)
+    else:
+      # Classification input uses only sequence final state
+      return self.output_logits(
+                tf.cast(attention, tf.float32),
+                hparams.dec_out_units, num_classes, "class_softmax")
+
   def sequence_class_logits(self, decoded_outputs, pool_size, max_seq_len, num_classes):
-    """ Logits for the sequence """
+    """ Logits for the sequence
+    Args:
+      decoded_outputs: decoder outputs, [batch_size, dec_seq_len, units]
+    """
     with tf.variable_scope("pooling"):
-      features = tf.expand_dims(self.decoded_outputs.rnn_output, axis=-1)
+      features = tf.expand_dims(decoded_outputs, axis=-1)
       pooled = tf.nn.max_pool(
           value=features, # [batch, height, width, channels]
           ksize=[1, 1, pool_size, 1],
@@ -425,10 +651,10 @@ class EncDecClass(EncDec):
       # FC layers
       out_dim = hparams.hidden_size
       in_dim=max_seq_len
-      for i in range(0,self.hparams.fc_num_layers):
+      for i in range(0,hparams.fc_num_layers):
         layer_name = "fc_{}".format(i+1)
         x = dense(x, in_dim, out_dim, act=tf.nn.relu, scope=layer_name)
-        x = tf.nn.dropout(x, self.keep_prob)
+        x = tf.nn.dropout(x, self.keep_prob_head)
         in_dim=out_dim
 
     # Logits
@@ -457,6 +683,103 @@ class EncDecClass(EncDec):
 
     return y_pred, y_true
 
+class EncDecMultiClass(EncDecClass):
+  """
+  EncDecClass with one classification head per output of the dataset, e.g. a
+  binary head per relation. The encoder and decoder are shared, and the heads
+  are trained jointly on the weighted sum of their costs.
+  To use, must provide encoder/decoder inputs + a list of class labels
+  """
+  def __init__(self, hparams, embedding, emb_dim):
+    # Shared encoder/decoder only, the heads replace the single EncDecClass head
+    EncDec.__init__(self, hparams, embedding, emb_dim, output_layer=None)
+
+    self.model_type = "classification"
+    if type(hparams.num_classes) is not list:
+      raise ValueError("EncDecMultiClass needs a dataset with heads")
+    self.num_heads = len(hparams.num_classes)
+    head_names = hparams.head_names
+    if head_names is None:
+      head_names = [str(i) for i in range(self.num_heads)]
+    head_weights = hparams.head_weights
+    if head_weights is None:
+      head_weights = [1.] * self.num_heads
+    if len(head_weights) != self.num_heads:
+      raise ValueError("head_weights has {} values for {} heads".format(
+                       len(head_weights), self.num_heads))
+
+    # Class labels, a list with one placeholder per head
+    with tf.name_scope("class_labels"):
+      self.classes = [tf.placeholder(self.intX, shape=[None, num_classes]) \
+                      for num_classes in hparams.num_classes]
+
+    self.class_logits = []
+    self.head_costs = []
+    self.y_pred = []
+    self.y_true = []
+    with tf.name_scope("classification"):
+      self.keep_prob_head = tf.cast(self.keep_prob, tf.float32)
+      for name, classes, num_classes in zip(head_names, self.classes,
+                                            hparams.num_classes):
+        with tf.variable_scope("head_" + name):
+          logits = self.class_head(num_classes,
+                                   self.decoded_final_state.attention,
+                                   self.decoded_outputs.rnn_output)
+        cost = tf.reduce_mean(self.classification_loss(classes, logits))
+        tf.summary.scalar("class_cost_" + name, cost)
+        y_pred, y_true = self.predict(logits, classes)
+        self.class_logits.append(logits)
+        self.head_costs.append(cost)
+        self.y_pred.append(y_pred)
+        self.y_true.append(y_true)
+
+    # Weighted sum of the head costs
+    self.cost = tf.add_n([w * c for w, c in zip(head_weights, self.head_costs)])
+
+    tf.summary.scalar("class_cost", self.cost)
+
+    # Loss ###################
+    self.optimize = self.optimize_step(self.cost,self.global_step)
+
+class HeadClass(EncDecClass):
+  """
+  Classification head of EncDecClass alone, fed with the decoder features of
+  a trained EncDecClass, see features.py. Variables have the names of the
+  EncDecClass head, so a trained head can replace it in a checkpoint
+  """
+  def __init__(self, params, embedding=None, emb_dim=None):
+    global hparams
+    hparams = params
+    self.model_type = "classification"
+    self.floatX = tf.float32
+    self.intX = tf.int32
+    self.class_over_sequence = hparams.class_over_sequence == True
+    # Nothing to freeze in optimize_step
+    self.encoder_variables = []
+    self.embedding_tensor = None
+    self.step_setup()
+
+    self.keep_prob = tf.placeholder(self.floatX)
+    with tf.name_scope("features"):
+      self.attention = tf.placeholder(self.floatX,
+                                      shape=[None, hparams.dec_out_units])
+      self.rnn_output = tf.placeholder(self.floatX,
+                                  shape=[None, None, hparams.dec_out_units])
+    with tf.name_scope("class_labels"):
+      self.classes = tf.placeholder(self.intX, shape=[None, hparams.num_classes])
+    self.batch_size = tf.shape(self.classes)[0]
+
+    with tf.name_scope("classification"):
+      self.keep_prob_head = self.keep_prob
+      self.class_logits = self.class_head(hparams.num_classes, self.attention,
+                                          self.rnn_output)
+
+    self.loss = self.classification_loss(self.classes, self.class_logits)
+    self.cost = tf.reduce_mean(self.loss)
+    tf.summary.scalar("class_cost", self.cost)
+    self.y_pred, self.y_true = self.predict(self.class_logits, self.classes)
+    self.optimize = self.optimize_step(self.cost,self.global_step)
+
 class EncDecGen(EncDec):
   """
   EncDec for text generation
@@ -464,22 +787,52 @@ class EncDecGen(EncDec):
   def __init__(self, hparams, embedding, emb_dim):
     # Must train output_layer and recycle later for inference
     vocab_size = embedding.shape[0]
-    output_layer = tf.contrib.keras.layers.Dense(vocab_size, use_bias=False)
-    super().__init__(hparams, embedding, emb_dim, output_layer=output_layer)
+    output_layer = OutputProjection(vocab_size)
+    # The training decoder outputs its hidden states, only the real tokens
+    # are projected for the loss
+    num_classes = None
+    if hparams.class_conditioned == True:
+      num_classes = hparams.num_classes
+    super().__init__(hparams, embedding, emb_dim, num_classes=num_classes,
+                     output_layer=None)
 
     self.model_type="generative"
-
-    # Sequence outputs over vocab, training
-    self.seq_logits = self.decoded_outputs.rnn_output
-
-    # Generator loss
-    self.loss = self.sequence_loss(\
-                        self.seq_logits, self.dec_targets, self.dec_input_len)
+    if num_classes is None:
+      # Fed with the batch, not used
+      self.classes = tf.placeholder(self.intX, shape=[None, None])
+
+    hidden = self.decoded_outputs.rnn_output
+    # Same scope as the projection in the inference decoder
+    with tf.variable_scope("decoder", custom_getter=self.custom_getter):
+      # Sequence outputs over vocab, only computed if fetched
+      self.seq_logits = tf.cast(output_layer(hidden), tf.float32)
+
+    # Generator loss, exact for evaluation. Loss is computed in float32
+    inputs, labels, batch_ids = self.real_tokens(hidden, self.dec_targets,
+                                                 self.dec_input_len)
+    weights = tf.cast(output_layer.kernel, tf.float32)
+    token_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                      labels=labels,
+                      logits=tf.matmul(inputs, weights, transpose_b=True))
+    self.eval_loss = self.sequence_loss(token_loss, batch_ids,
+                                        self.dec_input_len)
+    if hparams.softmax == "sampled":
+      # Only the target and sampled classes are projected
+      token_loss = tf.nn.sampled_softmax_loss(
+                      weights=weights,
+                      biases=tf.zeros([vocab_size]),
+                      labels=tf.expand_dims(tf.to_int64(labels), 1),
+                      inputs=inputs,
+                      num_sampled=hparams.num_sampled,
+                      num_classes=vocab_size)
+      self.loss = self.sequence_loss(token_loss, batch_ids, self.dec_input_len)
+    else:
+      self.loss = self.eval_loss
     self.cost = tf.reduce_mean(self.loss) # average across batch
+    self.eval_cost = tf.reduce_mean(self.eval_loss)
 
     # Optimize ###################
-    self.optimize = self.optimize_step(hparams.l_rate).minimize(\
-                                      self.cost, global_step=self.global_step)
+    self.optimize = self.optimize_step(self.cost, self.global_step)
 
     # Generated text ###################
     # Sequence outputs over vocab, inferred
@@ -487,27 +840,34 @@ class EncDecGen(EncDec):
         self.decoder_infer(self.batch_size, self.attn_cell, self.initial_state, output_layer)
     self.sample_id = self.infer_outputs.sample_id
 
-  def sequence_loss(self, logits, targets, seq_len):
-    """ Loss on sequence, given logits and one-hot targets
-    Default loss below is softmax cross ent on logits
+  def real_tokens(self, outputs, targets, seq_len):
+    """ Decoder outputs and targets of the tokens within seq_len
     Arguments:
-      logits : logits over predictions, [batch, seq_len, num_decoder_symb]
+      outputs : decoder hidden states, [batch, time, units]
       targets : the class id, shape is [batch_size, seq_len], dtype int
+    Returns:
+      outputs [num_tokens, units] as float32, targets [num_tokens] and the
+      batch index of each token
     """
-    # creates mask [batch_size, seq_len]
-    mask = tf.sequence_mask(seq_len, dtype=tf.float32)
-
-    # We need to delete zeroed elements in targets, beyond max sequence
-    max_seq = tf.reduce_max(seq_len)
-    max_seq = tf.to_int32(max_seq)
-    # Slice time dimension to max_seq
-    logits = tf.slice(logits, [0, 0, 0], [-1, max_seq, -1])
+    batch_size = tf.shape(outputs)[0]
+    max_seq = tf.shape(outputs)[1]
+    # Targets are longer than the outputs if the batch was not trimmed to its
+    # longest sequence, see training.feed_dict
     targets = tf.slice(targets, [0, 0], [-1, max_seq])
-    # weight_mask = tf.slice(weight_mask, [0,0], [-1, max_seq])
-
-    loss = tf.contrib.seq2seq.sequence_loss(logits, targets, mask,
-            average_across_batch=False)
-    return loss
+    mask = tf.sequence_mask(seq_len, max_seq)
+    batch_ids = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, max_seq])
+    return (tf.cast(tf.boolean_mask(outputs, mask), tf.float32),
+            tf.boolean_mask(targets, mask),
+            tf.boolean_mask(batch_ids, mask))
+
+  def sequence_loss(self, token_loss, batch_ids, seq_len):
+    """ Loss per sequence, average of its token losses
+    Arguments:
+      token_loss : loss of each real token, [num_tokens]
+      batch_ids : sequence index of each token
+    """
+    loss = tf.unsorted_segment_sum(token_loss, batch_ids, tf.shape(seq_len)[0])
+    return loss / tf.to_float(tf.maximum(seq_len, 1))
 
   def decoder_infer(self, batch_size, attn_cell, initial_state, output_layer):
     """
@@ -520,8 +880,14 @@ class EncDecGen(EncDec):
       see decoder_train() above
     """
     # Greedy decoder
+    embedding = self.embedding_tensor
+    if self.num_classes is not None:
+      # Inputs conditioned on the class, as in training
+      embedding = lambda ids: tf.concat([
+          self.embedded(ids, self.embedding_tensor),
+          tf.cast(self.classes, self.floatX)], 1)
     helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-        embedding=self.embedding_tensor,
+        embedding=embedding,
         start_tokens=tf.tile([hparams.start_token], [batch_size]),
         end_token=hparams.end_token)
 
@@ -543,24 +909,3 @@ class EncDecGen(EncDec):
               impute_finished=True,
               maximum_iterations=hparams.max_seq_len) # if None, decode till stop token
     return outputs, final_state, final_sequence_lengths
-
-  def sequence_output_logits(self, decoded_outputs, num_units, vocab_size):
-    """ Output projection over all timesteps
-    Returns:
-      logit tensor of shape [batch_size, timesteps, vocab_size]
-    """
-    # We need to get the sequence length for *this* batch, this will not be
-    # equal for each batch since the decoder is dynamic. Meaning length is
-    # equal to the longest sequence in the batch, not the max over data
-    max_seq_len = tf.shape(decoded_outputs)[1]
-
-    # Reshape to rank 2 tensor so timestep is no longer a dimension
-    output = tf.reshape(decoded_outputs, [-1, num_units])
-
-    # Get the logits
-    logits = self.output_logits(output, num_units, vocab_size, "seq_softmax")
-
-    # Reshape back to the original tensor shape
-    logits = tf.reshape(logits, [-1, max_seq_len, vocab_size])
-    return logits
-
@@ -0,0 +1,111 @@
+"""
+Export trained weights for serving without the training graph
+
+A model directory holds:
+  model.json: hparams and inv_vocab
+  weights.npz: arrays by variable name. Quantized weights are stored as
+    name + "_int8" and name + "_scale", see quantize.py
+
+Loading needs only numpy, tensorflow is imported to export
+
+python export.py --checkpoint_dir ckpt --output ckpt/export
+"""
+import os
+import json
+
+import numpy as np
+
+EMBEDDING_NAME = "embedding_matrix"
+
+def restore(sess, checkpoint_dir, var_list=None):
+  """ Restore the latest checkpoint in checkpoint_dir, returns its path """
+  import tensorflow as tf
+  ckpt_path = tf.train.latest_checkpoint(checkpoint_dir)
+  if ckpt_path is None:
+    raise ValueError("No checkpoint in " + checkpoint_dir)
+  tf.train.Saver(var_list=var_list).restore(sess, ckpt_path)
+  return ckpt_path
+
+def variable_name(var):
+  """ Variable name without the output index """
+  return var.name.split(':')[0]
+
+def model_weights(sess, model):
+  """ Trained weights {name: array}, and the embedding if not trained """
+  import tensorflow as tf
+  variables = tf.trainable_variables()
+  weights = dict(zip([variable_name(v) for v in variables], sess.run(variables)))
+  if EMBEDDING_NAME not in weights:
+    weights[EMBEDDING_NAME] = sess.run(model.embedding_tensor)
+  return weights
+
+def save_model(model_dir, weights, hparams, inv_vocab):
+  """ Write model.json and weights.npz to model_dir """
+  if not os.path.exists(model_dir):
+    os.makedirs(model_dir)
+  with open(os.path.join(model_dir, 'model.json'), 'w') as f:
+    json.dump({"hparams": vars(hparams), "inv_vocab": list(inv_vocab)}, f)
+  np.savez(os.path.join(model_dir, 'weights.npz'), **weights)
+
+def load_model(model_dir):
+  """ Returns hparams dict, inv_vocab and weights {name: array} """
+  with open(os.path.join(model_dir, 'model.json')) as f:
+    meta = json.load(f)
+  with np.load(os.path.join(model_dir, 'weights.npz')) as npz:
+    weights = {k: npz[k] for k in npz.files}
+  return meta["hparams"], meta["inv_vocab"], weights
+
+def channel_axis(name):
+  """ Axis with a scale per index: rows of the embedding, else output units """
+  return 0 if name == EMBEDDING_NAME else -1
+
+def channel_shape(shape, axis):
+  """ Shape to broadcast the scales of axis against a tensor of shape """
+  scale_shape = [1] * len(shape)
+  scale_shape[axis] = shape[axis]
+  return scale_shape
+
+def dequantize(q, scale, axis=-1):
+  """ Float32 weights from int8 values and their scales """
+  axis = axis % q.ndim
+  return q.astype(np.float32) * scale.reshape(channel_shape(q.shape, axis))
+
+def dequantize_weights(weights, keep=()):
+  """ Float32 weights from quantized weights, names in keep stay quantized """
+  float_weights = {}
+  for name, w in weights.items():
+    if name.endswith("_int8") and name[:-len("_int8")] not in keep:
+      name = name[:-len("_int8")]
+      float_weights[name] = dequantize(w, weights[name + "_scale"],
+                                       channel_axis(name))
+    elif name.endswith("_scale") and name[:-len("_scale")] not in keep:
+      continue
+    else:
+      float_weights[name] = w
+  return float_weights
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--settings', default='settings.json')
+  parser.add_argument('--checkpoint_dir',
+                      help='trained model, default settings checkpoint_dir')
+  parser.add_argument('--output', help='default checkpoint_dir/export')
+  args = parser.parse_args()
+
+  import tensorflow as tf
+  from helper import settings, get_data_embeddings
+  from enc_dec import EncDecClass
+  hparams, s = settings(args.settings)
+  checkpoint_dir = args.checkpoint_dir or s['checkpoint_dir']
+  if checkpoint_dir is None:
+    parser.error('no checkpoint_dir given or in settings')
+  dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                        get_data_embeddings(hparams, s)
+  with tf.Graph().as_default(), tf.Session() as sess:
+    model = EncDecClass(hparams, embedding, emb_dim)
+    restore(sess, checkpoint_dir)
+    weights = model_weights(sess, model)
+  save_model(args.output or os.path.join(checkpoint_dir, 'export'), weights,
+             hparams, inv_vocab)
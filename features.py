@@ -0,0 +1,271 @@
+"""
+Head fine-tuning on precomputed decoder features
+
+extract: a trained EncDecClass runs once over all datasets, and its decoder
+  final attention and outputs are saved as .npy files, with the labels
+train: a HeadClass is trained on the memory mapped features, with the head
+  hparams of the settings: hidden_size, fc_num_layers, class_over_sequence,
+  keep_prob, l_rate... The encoder and decoder are not run again
+merge: a full EncDecClass checkpoint, from the trained checkpoint with its
+  head replaced by a trained HeadClass
+
+Features are computed without dropout. For head sweeps, see
+search.py --task head
+
+python features.py extract --checkpoint_dir ckpt --output ckpt/features
+python features.py train --features ckpt/features --checkpoint_dir ckpt/head
+python features.py merge --checkpoint_dir ckpt --head ckpt/head --output ckpt/merged
+"""
+import os
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from utils import Progress, Metrics, Callback, session_config
+from training import call_model, class_scores
+from export import restore, variable_name
+from enc_dec import HeadClass
+
+###############################################################################
+# Features on disk
+###############################################################################
+def feature_path(feature_dir, short_name, kind):
+  return os.path.join(feature_dir, '{}_{}.npy'.format(short_name, kind))
+
+def extract_features(sess, model, dataset_dict, batch_size, max_seq_len,
+                     feature_dir, dtype='float32'):
+  """ Write the decoder features and labels of each dataset to feature_dir
+  Returns:
+    seconds taken
+  """
+  if not os.path.exists(feature_dir):
+    os.makedirs(feature_dir)
+  start = datetime.now()
+  fetch = [model.decoded_final_state.attention, model.decoded_outputs.rnn_output]
+  meta = {"sets": {}, "max_seq_len": max_seq_len}
+  for k, data in dataset_dict.items():
+    units = model.decoded_final_state.attention.get_shape().as_list()[1]
+    attention = np.lib.format.open_memmap(
+        feature_path(feature_dir, data.short_name, 'attention'), mode='w+',
+        dtype=dtype, shape=(data.size(), units))
+    # Outputs are padded to max_seq_len, as for sequence_class_logits
+    outputs = np.lib.format.open_memmap(
+        feature_path(feature_dir, data.short_name, 'outputs'), mode='w+',
+        dtype=dtype, shape=(data.size(), max_seq_len, units))
+    start_id = 0
+    for att, out in call_model(sess, model, data, fetch, batch_size,
+                  data.num_batches(batch_size), keep_prob=1, shuffle=False,
+                  mode=0):
+      end_id = start_id + len(att)
+      attention[start_id:end_id] = att
+      outputs[start_id:end_id, :out.shape[1]] = out
+      start_id = end_id
+    attention.flush()
+    outputs.flush()
+    del attention, outputs
+    np.save(feature_path(feature_dir, data.short_name, 'classes'), data.classes)
+    meta["sets"][k] = {"short_name": data.short_name,
+                       "sense_to_one_hot": data.sense_to_one_hot}
+  with open(os.path.join(feature_dir, 'features.json'), 'w') as f:
+    json.dump(meta, f, indent=2)
+  return (datetime.now() - start).total_seconds()
+
+class Features():
+  """ Decoder features and labels of a dataset, memory mapped """
+  def __init__(self, feature_dir, short_name, sense_to_one_hot):
+    self.short_name = short_name
+    self.sense_to_one_hot = sense_to_one_hot
+    self.attention = np.load(feature_path(feature_dir, short_name,
+                                          'attention'), mmap_mode='r')
+    self.outputs = np.load(feature_path(feature_dir, short_name, 'outputs'),
+                           mmap_mode='r')
+    self.classes = np.load(feature_path(feature_dir, short_name, 'classes'))
+
+  @property
+  def num_classes(self):
+    return self.classes.shape[1]
+
+  def size(self):
+    return len(self.classes)
+
+  def num_batches(self, batch_size):
+    return self.size()//batch_size+(self.size()%batch_size>0)
+
+def load_features(feature_dir):
+  """ Dictionary {dataset name: Features}, as get_data """
+  with open(os.path.join(feature_dir, 'features.json')) as f:
+    meta = json.load(f)
+  return {k: Features(feature_dir, v["short_name"], v["sense_to_one_hot"]) \
+          for k, v in meta["sets"].items()}
+
+###############################################################################
+# Head training
+###############################################################################
+def feature_batches(features, batch_size, shuffle):
+  """ Yields sample indices of each batch, sorted for memory mapped reads """
+  indices = np.arange(features.size())
+  if shuffle: np.random.shuffle(indices)
+  for start in range(0, len(indices), batch_size):
+    yield np.sort(indices[start:start + batch_size])
+
+def head_feed(model, features, indices, keep_prob):
+  """ Feed dictionary of HeadClass, only the features the head uses """
+  feed = {model.classes: features.classes[indices],
+          model.keep_prob: keep_prob}
+  if model.class_over_sequence:
+    feed[model.rnn_output] = features.outputs[indices]
+  else:
+    feed[model.attention] = features.attention[indices]
+  return feed
+
+def head_f1(sess, model, features, batch_size):
+  """ f1 and accuracy of the head on features """
+  y_pred = []
+  y_true = []
+  for indices in feature_batches(features, batch_size, shuffle=False):
+    pred, true = sess.run([model.y_pred, model.y_true],
+                          head_feed(model, features, indices, 1.))
+    y_pred.append(pred)
+    y_true.append(true)
+  return class_scores(np.concatenate(y_true), np.concatenate(y_pred),
+                      features.sense_to_one_hot)
+
+def train_head_epochs(sess, hparams, prog, model, feature_dict,
+                      checkpoint=None, epoch_hook=None):
+  """ As training.train_classification, on features
+  Returns:
+    Metrics object
+  """
+  train_set = feature_dict['training_set']
+  met = Metrics(monitor="val_f1")
+  cb = Callback(hparams.early_stop_epoch, met, prog)
+  for epoch in range(hparams.nb_epochs):
+    prog.epoch_start()
+    for indices in feature_batches(train_set, hparams.batch_size, shuffle=True):
+      _, cost = sess.run([model.optimize, model.cost],
+                  head_feed(model, train_set, indices, hparams.keep_prob))
+      prog.print_train(cost)
+
+    # Validation set first, it decides the best epoch
+    for k in ['validation_set'] + [k for k in feature_dict \
+                        if k not in ('training_set', 'validation_set')]:
+      data = feature_dict[k]
+      prog.print_cust('|| {} '.format(data.short_name))
+      f1, accuracy = head_f1(sess, model, data, hparams.batch_size)
+      met.update(data.short_name + '_f1', f1)
+      met.update(data.short_name + '_acc', accuracy)
+      prog.print_eval('acc', accuracy)
+      prog.print_eval('f1', f1)
+      if k == 'validation_set' and checkpoint is not None and met.improved:
+        checkpoint()
+
+    if cb.early_stop() == True: break
+    if epoch_hook is not None and epoch_hook(epoch, met) == True: break
+    prog.epoch_end()
+  return met
+
+def train_head(params, settings, feature_dict, config=None, epoch_hook=None):
+  """ Train a HeadClass on feature_dict, as training.train
+  Returns:
+    Metrics object
+  """
+  hparams = params
+  hparams.update(num_classes=feature_dict['training_set'].num_classes)
+  train_set = feature_dict['training_set']
+  prog = Progress(batches=train_set.num_batches(hparams.batch_size),
+                  progress_bar=True, bar_length=10)
+  if config is None:
+    config = session_config(settings)
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
+    tf.set_random_seed(1)
+    model = HeadClass(hparams)
+    sess.run(tf.global_variables_initializer())
+    checkpoint = None
+    if settings['checkpoint_dir'] is not None:
+      if not os.path.exists(settings['checkpoint_dir']):
+        os.makedirs(settings['checkpoint_dir'])
+      saver = tf.train.Saver(max_to_keep=1)
+      ckpt_path = os.path.join(settings['checkpoint_dir'], 'head.ckpt')
+      checkpoint = lambda: saver.save(sess, ckpt_path,
+                                      global_step=model.global_step)
+    met = train_head_epochs(sess, hparams, prog, model, feature_dict,
+                            checkpoint, epoch_hook)
+  return met
+
+def merge_head(Model, hparams, embedding, emb_dim, checkpoint_dir, head_dir,
+               output_dir, config=None):
+  """ Save the model of checkpoint_dir with the head of head_dir
+  Returns:
+    names of the replaced variables
+  """
+  head_ckpt = tf.train.latest_checkpoint(head_dir)
+  if head_ckpt is None:
+    raise ValueError("No checkpoint in " + head_dir)
+  head_names = set(name for name, _ in tf.train.list_variables(head_ckpt))
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
+    model = Model(hparams, embedding, emb_dim)
+    restore(sess, checkpoint_dir)
+    head_vars = [v for v in tf.trainable_variables() \
+                 if variable_name(v) in head_names]
+    tf.train.Saver(var_list=head_vars).restore(sess, head_ckpt)
+    if not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+    tf.train.Saver().save(sess, os.path.join(output_dir, 'model.ckpt'))
+  return sorted(variable_name(v) for v in head_vars)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('command', help='extract, train or merge')
+  parser.add_argument('--settings', default='settings.json')
+  parser.add_argument('--checkpoint_dir', help='extract and merge: trained '
+                      'EncDecClass, train: where to save the head. Default '
+                      'settings checkpoint_dir')
+  parser.add_argument('--features', help='features directory for train')
+  parser.add_argument('--head', help='trained head directory for merge')
+  parser.add_argument('--output', help='output directory for extract and merge')
+  parser.add_argument('--dtype', default='float32',
+                      help='storage dtype of extracted features')
+  args = parser.parse_args()
+
+  from helper import settings
+  hparams, s = settings(args.settings)
+  checkpoint_dir = args.checkpoint_dir or s['checkpoint_dir']
+
+  if args.command == 'train':
+    if args.features is None:
+      parser.error('train needs --features')
+    met = train_head(hparams, dict(s, checkpoint_dir=checkpoint_dir),
+                     load_features(args.features))
+    print()
+    print(met)
+  elif args.command in ('extract', 'merge'):
+    from helper import get_data_embeddings
+    from enc_dec import EncDecClass
+    if checkpoint_dir is None:
+      parser.error('no checkpoint_dir given or in settings')
+    dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                          get_data_embeddings(hparams, s)
+    config = session_config(s)
+    if args.command == 'extract':
+      output_dir = args.output or os.path.join(checkpoint_dir, 'features')
+      with tf.Graph().as_default(), tf.Session(config=config) as sess:
+        model = EncDecClass(hparams, embedding, emb_dim)
+        restore(sess, checkpoint_dir)
+        seconds = extract_features(sess, model, dataset_dict,
+                    hparams.batch_size, hparams.max_seq_len, output_dir,
+                    args.dtype)
+      print('Features saved to {} in {:.1f} sec'.format(output_dir, seconds))
+    else:
+      if args.head is None:
+        parser.error('merge needs --head')
+      output_dir = args.output or os.path.join(checkpoint_dir, 'merged')
+      names = merge_head(EncDecClass, hparams, embedding, emb_dim,
+                         checkpoint_dir, args.head, output_dir, config)
+      print('Replaced {} head variables, saved to {}'.format(len(names),
+                                                            output_dir))
+  else:
+    parser.error('unknown command ' + args.command)
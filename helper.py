@@ -9,6 +9,8 @@ import random
 import sys
 import os.path
 from conll_utils.scorer import f1_non_explicit
+from profiling import stage, timed
+from embeddings import get_embeddings
 
 dtype='int32' # default numpy int dtype
 np.random.seed(1)
@@ -22,7 +24,7 @@ class Data():
     self._classes = None
     self._seq_len = [] # list of tuple(len_arg1, len_arg2)
     self._decoder_target = []
-    self.orig_disc = [] # the original discourse, list from json to dict
+    self.orig_disc = [] # the original discourse dicts, list or LazyRecords
     self._sense_to_one_hot = {} # maps sense string to its encoding
 
   @property
@@ -96,17 +98,80 @@ class Data():
 
   @property
   def num_classes(self):
-    """ Number of unique classes """
+    """ Number of unique classes, a list if multiple outputs """
+    if type(self.classes) is list:
+      return [c.shape[1] for c in self.classes]
     return self.classes.shape[1]
 
   def size(self):
     """ Samples in dataset """
     return len(self.x[0])
 
-  def num_batches(self, batch_size):
-    return self.size()//batch_size+(self.size()%batch_size>0)
-
-
+  def num_batches(self, batch_size, num_shards=1):
+    """ Number of batches, per shard if the data is sharded across workers """
+    size = self.size()//num_shards+(self.size()%num_shards>0)
+    return size//batch_size+(size%batch_size>0)
+
+  def subset(self, indices, short_name=None):
+    """ Returns a new Data object with only the samples at indices """
+    if short_name is None:
+      short_name = self.short_name
+    sub = Data(short_name, self.path_source)
+    if type(self.x) is list:
+      sub.x = [x[indices] for x in self.x]
+    else:
+      sub.x = self.x[indices]
+    if type(self.classes) is list:
+      sub.classes = [c[indices] for c in self.classes]
+    else:
+      sub.classes = self.classes[indices]
+    sub.seq_len = self.seq_len[indices]
+    sub.decoder_target = self.decoder_target[indices]
+    if isinstance(self.orig_disc, LazyRecords):
+      sub.orig_disc = self.orig_disc[indices]
+    elif len(self.orig_disc) > 0:
+      sub.orig_disc = [self.orig_disc[i] for i in indices]
+    sub.sense_to_one_hot = self.sense_to_one_hot
+    return sub
+
+  def subsample(self, size, seed=1):
+    """ Fixed random subsample of the dataset, same samples for each call """
+    if size is None or size >= self.size():
+      return self
+    rng = np.random.RandomState(seed)
+    indices = np.sort(rng.choice(self.size(), size, replace=False))
+    return self.subset(indices, self.short_name + '_sub')
+
+
+
+class LazyRecords():
+  """ Sequence of the json lines of a file at byte offsets, each line is
+  read and parsed only when accessed """
+  def __init__(self, path, offsets):
+    self.path = path
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __sizeof__(self):
+    return object.__sizeof__(self) + self.offsets.nbytes
+
+  def __getitem__(self, index):
+    """ A dict for an int, else LazyRecords of a slice or of indices """
+    if isinstance(index, (int, np.integer)):
+      with open(self.path, 'rb') as f:
+        return self._read(f, self.offsets[index])
+    return LazyRecords(self.path, self.offsets[index])
+
+  def __iter__(self):
+    with open(self.path, 'rb') as f:
+      for offset in self.offsets:
+        yield self._read(f, offset)
+
+  def _read(self, f, offset):
+    f.seek(offset)
+    return json.loads(f.readline().decode('utf8'))
 
 class MiniData():
   """ Inherits Data properties indirectly.
@@ -119,18 +184,45 @@ class MiniData():
     self.indices = indices
 
   def __getattr__(self, name):
-    """ Returns sliced property from data object """
-    return self.data.__getattribute__(name)[self.indices]
-
-def make_batches(data, batch_size, num_batches, shuffle=True):
-  """ Yields the data object with all properties sliced """
-  data_size = len(data.encoder_input)
-  indices = np.arange(0, data_size)
-  if shuffle: np.random.shuffle(indices)
-  for batch_num in range(num_batches):
-    start_index = batch_num * batch_size
-    end_index = min((batch_num + 1) * batch_size, data_size)
-    new_indices = indices[start_index:end_index]
+    """ Returns sliced property from data object, each slice if a list """
+    value = self.data.__getattribute__(name)
+    if type(value) is list:
+      return [v[self.indices] for v in value]
+    return value[self.indices]
+
+def epoch_rng(epoch, seed=1):
+  """ Random state of the shuffles of an epoch, the same on every worker """
+  return np.random.RandomState(seed + epoch)
+
+def make_batches(data, batch_size, num_batches, shuffle=True, shard_index=0,
+                 num_shards=1, bucket=False, bucket_batches=50, rng=None):
+  """ Yields the data object with all properties sliced
+  If num_shards > 1, only the samples of shard shard_index are batched. The
+  shards are disjoint if the workers shuffle with the same rng, see epoch_rng,
+  which the global numpy state does not ensure once they batch different
+  numbers of times
+  If bucket and shuffle, samples of similar length are batched together, so
+  batches trimmed to their longest sequence have less padding. Samples are
+  sorted by length within windows of bucket_batches batches, and the order
+  of the batches is shuffled. Without shuffle, the data order is kept
+  rng: RandomState of the shuffles, the global numpy state if None
+  """
+  rng = rng or np.random
+  indices = np.arange(0, len(data.encoder_input))
+  if shuffle: rng.shuffle(indices)
+  indices = indices[shard_index::num_shards]
+  data_size = len(indices)
+  bucket = bucket and shuffle
+  if bucket:
+    lengths = np.max(data.seq_len[indices], axis=1)
+    window = batch_size * bucket_batches
+    for start in range(0, data_size, window):
+      order = np.argsort(lengths[start:start + window], kind='mergesort')
+      indices[start:start + window] = indices[start:start + window][order]
+  batches = [indices[start:start + batch_size] \
+                              for start in range(0, data_size, batch_size)]
+  if bucket: rng.shuffle(batches)
+  for new_indices in batches[:num_batches]:
     yield MiniData(data, new_indices)
 
 class Preprocess():
@@ -148,7 +240,8 @@ class Preprocess():
         bos_tag = None, # beginning of sequence tag
         eos_tag = None, # end of sequence tag
         vocab=None, # If none, will create the vocab
-        inv_vocab=None): # If none, generates inverse vocab
+        inv_vocab=None, # If none, generates inverse vocab
+        keep_orig_disc=False): # else orig_disc is read from file on access
 
     if relation == "all":
       self.relation = None
@@ -171,7 +264,8 @@ class Preprocess():
     self.split_input  = split_input
     # Sense mapping dict, or list of dicts
     mapping_path=dataset["mapping"]
-    self.mapping_sense    = self.get_output_mapping(mapping_path)
+    self.mapping_sense    = self.get_output_mapping(mapping_path,
+                                                    dataset.get("heads"))
     self.sense_to_one_hot = self.get_one_hot_dicts(self.mapping_sense)
     self.int_to_sense     = self.get_int_to_sense_dict(self.sense_to_one_hot)
     self.num_classes      = self.get_class_counts(self.mapping_sense)
@@ -188,15 +282,19 @@ class Preprocess():
     # If max vocab
     if max_vocab is not None:
       train_path = self.data_collect['training_set'].path_source
-      train_vocab = self.most_common_words(train_path, max_vocab, self.relation)
+      with stage("most_common_words"):
+        train_vocab = self.most_common_words(train_path, max_vocab,
+                                             self.relation)
     else:
       train_vocab = None
 
     # Tokenize and pad
     for data in self.data_collect.values():
-      data.x, data.classes, data.seq_len, data.decoder_target, data.orig_disc=\
-            self.load_from_file(data.path_source, self.max_arg_len, label_key,
-              self.relation, train_vocab)
+      with stage("load_from_file"):
+        data.x, data.classes, data.seq_len, data.decoder_target, \
+          data.orig_disc = self.load_from_file(data.path_source,
+              self.max_arg_len, label_key, self.relation, train_vocab,
+              keep_orig_disc)
 
       # Array with elements arg1 length, arg2 length
       data.seq_len = np.array(data.seq_len, dtype=dtype)
@@ -206,22 +304,26 @@ class Preprocess():
       data.classes = self.set_output_for_network(data.classes)
 
       # Pad input according to split
-      data.x = self.pad_input(data.x, data.seq_len, self.split_input)
-      data.decoder_target = self.pad_input(data.decoder_target, split=False)
+      with stage("pad_input"):
+        data.x = self.pad_input(data.x, data.seq_len, self.split_input)
+        data.decoder_target = self.pad_input(data.decoder_target, split=False)
 
       data.sense_to_one_hot = self.sense_to_one_hot
     # self.weights_cross_entropy = (np.sum(y_train, axis=0)/np.sum(y_train))
 
     # Create vocab for all data
     if self.vocab == None:
-      self.vocab, self.inv_vocab = self.create_vocab(self.data_collect, max_vocab)
+      with stage("create_vocab"):
+        self.vocab, self.inv_vocab = self.create_vocab(self.data_collect,
+                                                       max_vocab)
     self.total_tokens = len(self.vocab)
 
     # Integerize x and decoder targets, and make numpy arrays
     for k, data in self.data_collect.items():
       # Integerize
-      data.x = self.integerize(data.x, self.vocab)
-      data.decoder_target = self.integerize(data.decoder_target, self.vocab)
+      with stage("integerize"):
+        data.x = self.integerize(data.x, self.vocab)
+        data.decoder_target = self.integerize(data.decoder_target, self.vocab)
 
       # Make numpy
       data.x = np.array(data.x)
@@ -259,10 +361,16 @@ class Preprocess():
       outputs = np.array(outputs)
       return outputs
 
-  def get_output_mapping(self, mapping_path):
-    """ Returns single dict, or list of dicts of mapping"""
-
-    if type(mapping_path) is list:
+  def get_output_mapping(self, mapping_path, heads=None):
+    """ Returns single dict, or list of dicts of mapping
+    If heads, returns a binary mapping per head: senses mapped to the head are
+    positive, others negative
+    """
+    if heads is not None:
+      mapping = self.dict_from_json(mapping_path)
+      return [{k: 'positive' if v == head else 'negative' \
+               for k, v in mapping.items()} for head in heads]
+    elif type(mapping_path) is list:
       maps = []
       for path in mapping_path:
         maps.append(self.dict_from_json(path))
@@ -290,7 +398,10 @@ class Preprocess():
       return self.one_hot_dict(set(mapping_sense.values()))
 
   def get_int_to_sense_dict(self, sense_to_one_hot):
-    """ Return dict mapping integer to label based on one hot dict"""
+    """ Return dict mapping integer to label based on one hot dict, or list
+    of dicts """
+    if type(sense_to_one_hot) is list:
+      return [self.get_int_to_sense_dict(d) for d in sense_to_one_hot]
     int_to_sense = {}
     for k, v in sense_to_one_hot.items():
       key = np.argmax(v)
@@ -354,28 +465,33 @@ class Preprocess():
     return x_new
 
   def load_from_file(self, path, max_arg_len, label_name, relation=None,
-                    max_vocab=None):
+                    max_vocab=None, keep_records=False):
     """ Parse the input
     Args:
       max_vocab: if given, only these tokens considered
+      keep_records: return the discourse dicts as a list, instead of
+        LazyRecords reading them from file
     Returns:
       x : list of tokenized discourse text
       y : list of labels
       arg_len : list of tuples (arg1_length, arg2_length)
-      discourse_list : if !None, saves discourse info to this list
+      decoder_targets : list of tokenized decoder targets
+      discourse_list : discourse dict of each sample, list or LazyRecords
     """
     x = list(); y = list(); arg_len=list(); decoder_targets=list();
-    discourse_list = list()
-    with codecs.open(path, encoding='utf8') as pdfile:
+    discourse_list = list(); offsets = list()
+    with open(path, 'rb') as pdfile:
       invalid = 0
+      offset = 0
       for line in pdfile:
-        j = json.loads(line)
+        line_offset = offset
+        offset += len(line)
+        j = json.loads(line.decode('utf8'))
 
         # Maybe exclude this relation
         if relation is not None:
           if j['Relation'] != relation: continue
 
-        discourse_list.append(j)
         arg1 = clean_str(j['Arg1']['RawText'])
         arg2 = clean_str(j['Arg2']['RawText'])
 
@@ -390,7 +506,6 @@ class Preprocess():
         arg2 = arg2[:self.max_arg_len]
         dec_target = arg2[1:]
         dec_target.append(self.eos_tag)
-        decoder_targets.append(dec_target)
 
         l1 = len(arg1)
         l2 = len(arg2)
@@ -398,6 +513,12 @@ class Preprocess():
           invalid += 1
           continue
 
+        # Only samples kept, so that indices match x
+        decoder_targets.append(dec_target)
+        offsets.append(line_offset)
+        if keep_records:
+          discourse_list.append(j)
+
         arg1.extend(arg2)
         # Return original sense, mapping done later
         if type(j[label_name]) == list:
@@ -411,6 +532,8 @@ class Preprocess():
         arg_len.append((l1,l2))
     print("There were ", invalid, " invalid discourses in file:")
     print(path)
+    if not keep_records:
+      discourse_list = LazyRecords(path, offsets)
     return x, y, arg_len, decoder_targets, discourse_list
 
   def add_tags(self, seq_list):
@@ -525,6 +648,33 @@ def settings(path):
   s['tensorboard_write'] = parse_bool(s['tensorboard_write'])
   s['split_input'] = parse_bool(s['split_input'])
   s['save_alignment_history'] = parse_bool(s['save_alignment_history'])
+  s['checkpoint_dir'] = parse_str(s['checkpoint_dir'])
+  s['keep_orig_disc'] = parse_bool(s['keep_orig_disc'])
+  s['session'] = {
+    'intra_op_threads'     : parse_int(s['session']['intra_op_threads']),
+    'inter_op_threads'     : parse_int(s['session']['inter_op_threads']),
+    'allow_soft_placement' : parse_bool(s['session']['allow_soft_placement']),
+    'cpu_affinity'         : parse_str(s['session']['cpu_affinity'])
+  }
+  s['distill'] = {
+    'corpus'          : parse_str(s['distill']['corpus']),
+    'temperature'     : parse_float(s['distill']['temperature']),
+    'student_type'    : s['distill']['student_type'],
+    'student_filters' : parse_int(s['distill']['student_filters']),
+    'student_kernel'  : parse_int(s['distill']['student_kernel']),
+    'student_units'   : parse_int(s['distill']['student_units'])
+  }
+  s['step_stats'] = {
+    'log_path'    : parse_str(s['step_stats']['log_path']),
+    'every'       : parse_int(s['step_stats']['every']),
+    'window'      : parse_int(s['step_stats']['window']),
+    'trace_steps' : parse_ints(s['step_stats']['trace_steps']),
+    'trace_dir'   : parse_str(s['step_stats']['trace_dir'])
+  }
+  s['profile'] = {
+    'enabled' : parse_bool(s['profile']['enabled']),
+    'path'    : parse_str(s['profile']['path'])
+  }
 
   hparams = HParams(
     batch_size          = parse_int(s['hp']['batch_size']),
@@ -533,11 +683,17 @@ def settings(path):
     optimizer           = s['hp']['optimizer'],
     dec_out_units       = parse_int(s['hp']['dec_out_units']),
     num_layers          = parse_int(s['hp']['num_layers']),
+    residual            = parse_bool(s['hp']['residual']),
     keep_prob           = parse_float(s['hp']['keep_prob']),
     nb_epochs           = parse_int(s['hp']['nb_epochs']),
     early_stop_epoch    = parse_int(s['hp']['early_stop_epoch']),
     bidirectional       = parse_bool(s['hp']['bidirectional']),
     l_rate              = parse_float(s['hp']['l_rate']),
+    precision           = s['hp']['precision'],
+    loss_scale          = parse_float(s['hp']['loss_scale']),
+    softmax             = s['hp']['softmax'],
+    num_sampled         = parse_int(s['hp']['num_sampled']),
+    bucket              = parse_bool(s['hp']['bucket']),
     attention           = parse_bool(s['hp']['attention']),
     class_over_sequence = parse_bool(s['hp']['class_over_sequence']),
     hidden_size         = parse_int(s['hp']['hidden_size']),
@@ -549,7 +705,20 @@ def settings(path):
     pad_tag             = s['hp']['pad_tag'],
     bos_tag             = s['hp']['bos_tag'],
     eos_tag             = s['hp']['eos_tag'],
-    emb_trainable       = s['hp']['emb_trainable']
+    emb_trainable       = parse_bool(s['hp']['emb_trainable']),
+    emb_drop_unseen     = parse_bool(s['hp']['emb_drop_unseen']),
+    eval_every_steps    = parse_int(s['hp']['eval_every_steps']),
+    eval_subsample      = parse_int(s['hp']['eval_subsample']),
+    early_stop_steps    = parse_int(s['hp']['early_stop_steps']),
+    lr_plateau_evals    = parse_int(s['hp']['lr_plateau_evals']),
+    lr_decay            = parse_float(s['hp']['lr_decay']),
+    min_l_rate          = parse_float(s['hp']['min_l_rate']),
+    head_weights        = parse_floats(s['hp']['head_weights']),
+    class_conditioned   = parse_bool(s['hp']['class_conditioned']),
+    freeze_encoder      = parse_bool(s['hp']['freeze_encoder']),
+    encoder_cache_mb    = parse_int(s['hp']['encoder_cache_mb']),
+    num_workers         = 1,
+    sync_replicas       = parse_bool(s['distributed']['sync_replicas'])
   )
 
   return hparams, s
@@ -574,6 +743,26 @@ def parse_float(val):
   else:
     return float(val)
 
+def parse_floats(val):
+  """ Comma separated floats """
+  if val == "None":
+    return None
+  else:
+    return [float(v) for v in val.split(',')]
+
+def parse_ints(val):
+  """ Comma separated ints """
+  if val == "None":
+    return None
+  else:
+    return [int(v) for v in val.split(',')]
+
+def parse_str(val):
+  if val == "None":
+    return None
+  else:
+    return val
+
 class HParams():
   def __init__(self, **kwargs):
     for k, v in kwargs.items():
@@ -583,6 +772,7 @@ class HParams():
     for k, v in kwargs.items():
       setattr(self, k, v)
 
+@timed("get_data")
 def get_data(hparams, settings):
   """
   Convenience function to create the datasets needed
@@ -605,13 +795,15 @@ def get_data(hparams, settings):
               pad_tag = hparams.pad_tag,
               unknown_tag = hparams.unknown_tag,
               bos_tag = hparams.bos_tag,
-              eos_tag = hparams.eos_tag)
+              eos_tag = hparams.eos_tag,
+              keep_orig_disc = settings['keep_orig_disc'])
   vocab = data_class.vocab
   inv_vocab = data_class.inv_vocab
 
   # Once vocab and inv_vocab created, update hparams with their index values
   hparams.update(
     num_classes = data_class.num_classes,
+    head_names = settings[dataset_name].get('heads'),
     start_token = vocab[hparams.bos_tag],
     end_token = vocab[hparams.eos_tag],
   )
@@ -620,6 +812,107 @@ def get_data(hparams, settings):
   dataset_dict = data_class.data_collect
   return dataset_dict, vocab, inv_vocab
 
+def get_unlabeled(path, hparams, vocab, short_name="unlabeled"):
+  """
+  Data object of a json relations file without labels, tokenized and padded
+  as get_data does, with the given vocab. The input is always split. Words
+  outside the vocab are dropped, as load_from_file drops them. classes is
+  None until set, such as with soft labels
+  """
+  unk = vocab[hparams.unknown_tag]
+  pad = vocab[hparams.pad_tag]
+  args = [[], []]
+  seq_len = []
+  targets = []
+  offsets = []
+  with open(path, 'rb') as pdfile:
+    offset = 0
+    for line in pdfile:
+      line_offset = offset
+      offset += len(line)
+      j = json.loads(line.decode('utf8'))
+      arg1 = [w for w in clean_str(j['Arg1']['RawText']) if w in vocab]
+      arg1 = arg1[:hparams.max_arg_len]
+      arg2 = [w for w in clean_str(j['Arg2']['RawText']) if w in vocab]
+      if hparams.bos_tag:
+        arg2.insert(0, hparams.bos_tag)
+      arg2 = arg2[:hparams.max_arg_len]
+      if len(arg1) < 1 or len(arg2) < 1:
+        continue
+      target = arg2[1:] + [hparams.eos_tag]
+      for i, tokens in enumerate([arg1, arg2]):
+        args[i].append([vocab.get(w, unk) for w in tokens])
+      targets.append([vocab.get(w, unk) for w in target])
+      seq_len.append((len(arg1), len(arg2)))
+      offsets.append(line_offset)
+
+  def padded(seqs):
+    out = np.full((len(seqs), hparams.max_arg_len), pad, dtype=dtype)
+    for i, seq in enumerate(seqs):
+      out[i, :len(seq)] = seq
+    return out
+
+  data = Data(short_name, path)
+  data.x = [padded(args[0]), padded(args[1])]
+  data.seq_len = np.array(seq_len, dtype=dtype).reshape(-1, 2)
+  data.decoder_target = padded(targets)
+  data.orig_disc = LazyRecords(path, offsets)
+  return data
+
+@timed("trim_vocab")
+def trim_vocab(hparams, dataset_dict, vocab, inv_vocab, embedding):
+  """
+  Drop the words never seen in the training set from the vocab and the
+  embedding. In all datasets, their ids are replaced by the unknown tag id
+  Args:
+    hparams: HParam object, start and end tokens are updated
+  Returns:
+    vocab, inv_vocab and embedding with only the kept words
+  """
+  train_set = dataset_dict['training_set']
+  seen = np.zeros(len(inv_vocab), dtype=bool)
+  for x in (train_set.x if type(train_set.x) is list else [train_set.x]):
+    seen[np.unique(x)] = True
+  seen[np.unique(train_set.decoder_target)] = True
+  # Tags are always kept
+  for tag in [hparams.unknown_tag, hparams.pad_tag, hparams.bos_tag,
+              hparams.eos_tag]:
+    if tag in vocab:
+      seen[vocab[tag]] = True
+
+  # Old id to new id, unseen words to the unknown tag
+  new_ids = np.cumsum(seen) - 1
+  mapping = np.where(seen, new_ids, new_ids[vocab[hparams.unknown_tag]])
+  mapping = mapping.astype(dtype)
+  for data in dataset_dict.values():
+    if type(data.x) is list:
+      data.x = [mapping[x] for x in data.x]
+    else:
+      data.x = mapping[data.x]
+    data.decoder_target = mapping[data.decoder_target]
+
+  inv_vocab = [word for word, keep in zip(inv_vocab, seen) if keep]
+  vocab = {word: i for i, word in enumerate(inv_vocab)}
+  hparams.update(
+    start_token = vocab[hparams.bos_tag],
+    end_token = vocab[hparams.eos_tag],
+  )
+  return vocab, inv_vocab, embedding[seen]
+
+def get_data_embeddings(hparams, settings):
+  """
+  Datasets and embedding as every entry point trains on them: get_data,
+  get_embeddings, then trim_vocab if hparams.emb_drop_unseen
+  Returns:
+    dataset_dict, vocab, inv_vocab, embedding, emb_dim
+  """
+  dataset_dict, vocab, inv_vocab = get_data(hparams, settings)
+  embedding, emb_dim = get_embeddings(hparams, vocab, inv_vocab, settings)
+  if hparams.emb_drop_unseen == True:
+    vocab, inv_vocab, embedding = trim_vocab(hparams, dataset_dict, vocab,
+                                             inv_vocab, embedding)
+  return dataset_dict, vocab, inv_vocab, embedding, emb_dim
+
 def alignment(enc_in, dec_in, alignment, inv_vocab):
   """ process data and save alignments """
   # Alignment is time major, make batch major
@@ -9,10 +9,12 @@ For a single trial, call script without arguments
 
 -----------
 """
-from helper import settings, get_data
-from embeddings import get_embeddings
-from enc_dec import EncDecGen, EncDecClass
+from helper import settings, get_data_embeddings
+from enc_dec import EncDecGen, EncDecClass, EncDecMultiClass
 from training import train
+from distributed import train_distributed
+from utils import session_config, set_cpu_affinity
+from profiling import PROFILER, stage, report_at_exit
 import argparse
 
 ###############################################################################
@@ -20,12 +22,17 @@ import argparse
 ###############################################################################
 global hparams
 hparams, settings = settings('settings.json')
+PROFILER.enabled = settings['profile']['enabled']
+report_at_exit(settings['profile']['path'])
+# Pinned before loading the data, so the threads started from now on inherit it
+if settings['session']['cpu_affinity'] is not None:
+  set_cpu_affinity(settings['session']['cpu_affinity'])
 
-# Get data
+# Get data and embedding
 # dataset dictionary {k: v} is {dataset name: Data object}
-dataset_dict, vocab, inv_vocab = get_data(hparams, settings)
 # Embedding as numpy array, and embedding size
-embedding, emb_dim = get_embeddings(hparams, vocab, inv_vocab, settings)
+dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                      get_data_embeddings(hparams, settings)
 
 ###############################################################################
 # Main
@@ -33,13 +40,26 @@ embedding, emb_dim = get_embeddings(hparams, vocab, inv_vocab, settings)
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description=__doc__,
                           formatter_class=argparse.RawDescriptionHelpFormatter)
-  parser.add_argument('--task', default="generation", help='generation or classification')
+  parser.add_argument('--task', default="generation", help='generation, classification, or multi for a '
+                      'classification head per dataset head')
+  parser.add_argument('--job_name', help='ps or worker, for distributed training')
+  parser.add_argument('--task_index', type=int, default=0,
+                      help='index of this job in settings["distributed"] hosts')
   args = parser.parse_args()
 
   if args.task == 'generation':
     model = EncDecGen
+  elif args.task == 'multi':
+    model = EncDecMultiClass
   else:
     model = EncDecClass
 
-  train(hparams, settings, model, embedding, emb_dim, dataset_dict, vocab, inv_vocab)
+  with stage("train"):
+    if args.job_name is not None:
+      train_distributed(hparams, settings, model, embedding, emb_dim,
+          dataset_dict, vocab, inv_vocab, args.job_name, args.task_index,
+          config=session_config(settings))
+    else:
+      train(hparams, settings, model, embedding, emb_dim, dataset_dict, vocab,
+            inv_vocab)
 
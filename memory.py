@@ -0,0 +1,113 @@
+"""
+Memory footprint of the datasets and of the graph
+
+For each split, the bytes of each Data field: the integer arrays, and the
+original discourse dicts kept for the CoNLL output, or only their file
+offsets, see settings["keep_orig_disc"]. For the graph, the bytes of the variables, of the
+trainable variables, of the constants and of the serialized graph.
+
+python memory.py --task classification
+"""
+import sys
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from profiling import peak_rss_mb
+
+def deep_bytes(obj, seen=None):
+  """ Bytes of obj and of the objects it holds, numpy arrays by their data """
+  if seen is None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  if isinstance(obj, np.ndarray):
+    return obj.nbytes
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    size += sum(deep_bytes(k, seen) + deep_bytes(v, seen) \
+                for k, v in obj.items())
+  elif isinstance(obj, (list, tuple, set)):
+    size += sum(deep_bytes(v, seen) for v in obj)
+  return size
+
+def data_footprint(data):
+  """ Bytes of each field of a Data object """
+  fields = OrderedDict()
+  if type(data.x) is list:
+    fields["encoder_input"] = deep_bytes(data.x[0])
+    fields["decoder_input"] = deep_bytes(data.x[1])
+  else:
+    fields["x"] = deep_bytes(data.x)
+  fields["decoder_target"] = deep_bytes(data.decoder_target)
+  fields["seq_len"] = deep_bytes(data.seq_len)
+  fields["classes"] = deep_bytes(data.classes)
+  # LazyRecords count their file offsets, not the dicts read on access
+  fields["orig_disc"] = deep_bytes(data.orig_disc)
+  return fields
+
+def graph_footprint(graph=None):
+  """ Bytes of the variables, trainable variables, constants and graph def """
+  graph = graph or tf.get_default_graph()
+  def variable_bytes(variables):
+    return int(sum(np.prod(v.get_shape().as_list()) * v.dtype.base_dtype.size \
+                   for v in variables))
+  with graph.as_default():
+    footprint = OrderedDict([
+        ("variables", variable_bytes(tf.global_variables())),
+        ("trainable", variable_bytes(tf.trainable_variables()))])
+  footprint["constants"] = sum(tf.make_ndarray(op.get_attr('value')).nbytes \
+                               for op in graph.get_operations() \
+                               if op.type == 'Const')
+  footprint["graph_def"] = graph.as_graph_def().ByteSize()
+  return footprint
+
+def report(dataset_dict, embedding=None, graph=None):
+  """ Dictionary of the footprints, in bytes """
+  r = OrderedDict()
+  r["datasets"] = OrderedDict((k, data_footprint(v)) \
+                              for k, v in dataset_dict.items())
+  if embedding is not None:
+    r["embedding"] = embedding.nbytes
+  if graph is not None:
+    r["graph"] = graph_footprint(graph)
+  r["peak_rss_mb"] = peak_rss_mb()
+  return r
+
+def print_report(r):
+  mb = lambda b: b / 2**20
+  fields = list(next(iter(r["datasets"].values())).keys())
+  print('{:>16} '.format('MB') + ' '.join('{:>14}'.format(f) \
+        for f in fields + ['total']))
+  for name, footprint in r["datasets"].items():
+    values = [footprint[f] for f in fields] + [sum(footprint.values())]
+    print('{:>16} '.format(name) + ' '.join('{:>14.2f}'.format(mb(v)) \
+          for v in values))
+  if "embedding" in r:
+    print('{:>16} {:>14.2f}'.format('embedding', mb(r["embedding"])))
+  for name, value in r.get("graph", {}).items():
+    print('{:>16} {:>14.2f}'.format('graph ' + name, mb(value)))
+  if r["peak_rss_mb"] is not None:
+    print('{:>16} {:>14.2f}'.format('peak rss', r["peak_rss_mb"]))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--settings', default='settings.json')
+  parser.add_argument('--task', default='classification',
+                      help='generation, classification or multi')
+  args = parser.parse_args()
+
+  from helper import settings, get_data_embeddings
+  from enc_dec import EncDecGen, EncDecClass, EncDecMultiClass
+  hparams, s = settings(args.settings)
+  dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                        get_data_embeddings(hparams, s)
+  Model = {"generation": EncDecGen, "multi": EncDecMultiClass}.get(args.task,
+                                                                  EncDecClass)
+  with tf.Graph().as_default() as graph:
+    Model(hparams, embedding, emb_dim)
+    print_report(report(dataset_dict, embedding, graph))
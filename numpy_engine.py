@@ -0,0 +1,344 @@
+"""
+NumPy inference engine for EncDecClass
+
+Runs a model exported with export.py or quantize.py without tensorflow: the
+embedding lookup, the one way or bidirectional encoder, the Bahdanau
+attention decoder and the class head, with the same masking as the graph at
+inference (keep_prob of 1). Cells can be LSTMCell, LSTMBlockCell,
+LSTMBlockFusedCell or GRUCell, with stacked and residual layers.
+
+  engine = Engine.from_dir("checkpoints/int8")
+  predictions = engine.predict_data(dataset_dict['test_set'])
+"""
+import numpy as np
+
+from export import load_model, dequantize_weights, EMBEDDING_NAME
+
+LSTM_CELLS = ["LSTMCell", "LSTMBlockCell", "LSTMBlockFusedCell"]
+# Attention variables, under the decoder scope with the decoder cell
+ATTENTION_SCOPES = ["memory_layer", "query_layer", "attention_layer"]
+
+def sigmoid(x):
+  return .5 * (1. + np.tanh(.5 * x))
+
+def softmax(x, axis=-1):
+  e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+  return e / np.sum(e, axis=axis, keepdims=True)
+
+def map_state(fn, *states):
+  """ Apply fn to the arrays of states with the same nested tuple structure """
+  if isinstance(states[0], tuple):
+    return tuple(map_state(fn, *s) for s in zip(*states))
+  return fn(*states)
+
+def reverse_sequence(x, seq_len):
+  """ Reverse the first seq_len steps of each sequence of x [batch, time, ...]
+  """
+  batch, time = x.shape[:2]
+  steps = np.arange(time)[None, :]
+  seq_len = seq_len[:, None]
+  index = np.where(steps < seq_len, seq_len - 1 - steps, steps)
+  return x[np.arange(batch)[:, None], index]
+
+class Weights():
+  """ Exported weights, found by the scopes of their variable names, so the
+  engine does not depend on the exact scopes of each tensorflow version
+  """
+  def __init__(self, weights):
+    self.weights = weights
+
+  def find(self, *scopes, exclude=(), required=True):
+    """ The weight named scopes[-1] under all other scopes, in order, and
+    under none of the scopes in exclude
+    """
+    matches = []
+    for name in self.weights:
+      parts = name.split('/')
+      if parts[-1] != scopes[-1] or any(p in exclude for p in parts):
+        continue
+      # Each scope must follow the previous one
+      remaining = iter(parts[:-1])
+      if all(scope in remaining for scope in scopes[:-1]):
+        matches.append(name)
+    if len(matches) == 1:
+      return self.weights[matches[0]]
+    if len(matches) == 0 and not required:
+      return None
+    raise ValueError("{} weights match {}: {}".format(len(matches),
+                     "/".join(scopes), matches))
+
+class LSTM():
+  """ LSTMCell, LSTMBlockCell or LSTMBlockFusedCell, all with gates i, j, f, o
+  in the kernel and a forget bias of 1
+  """
+  def __init__(self, kernel, bias, forget_bias=1.):
+    self.units = bias.shape[0] // 4
+    input_size = kernel.shape[0] - self.units
+    self.w_input = kernel[:input_size]
+    self.w_hidden = kernel[input_size:]
+    self.bias = bias
+    self.forget_bias = forget_bias
+
+  def zero_state(self, batch_size):
+    zeros = np.zeros((batch_size, self.units), np.float32)
+    return (zeros, zeros)
+
+  def project(self, x, start=0):
+    """ Input part of the gates, for x the input features from column start.
+    Computed once for a whole sequence """
+    return np.matmul(x, self.w_input[start:start + x.shape[-1]])
+
+  def step(self, projected, state):
+    """ Returns output and new state """
+    c, h = state
+    z = projected + np.matmul(h, self.w_hidden) + self.bias
+    i, j, f, o = np.split(z, 4, axis=1)
+    c = sigmoid(f + self.forget_bias) * c + sigmoid(i) * np.tanh(j)
+    h = sigmoid(o) * np.tanh(c)
+    return h, (c, h)
+
+class GRU():
+  """ GRUCell, gates r, u """
+  def __init__(self, gate_kernel, gate_bias, candidate_kernel, candidate_bias):
+    self.units = candidate_bias.shape[0]
+    input_size = gate_kernel.shape[0] - self.units
+    # Input rows of both kernels, to project the inputs in a single product
+    self.w_input = np.concatenate([gate_kernel[:input_size],
+                                   candidate_kernel[:input_size]], axis=1)
+    self.w_gate_hidden = gate_kernel[input_size:]
+    self.w_candidate_hidden = candidate_kernel[input_size:]
+    self.gate_bias = gate_bias
+    self.candidate_bias = candidate_bias
+
+  def zero_state(self, batch_size):
+    return np.zeros((batch_size, self.units), np.float32)
+
+  def project(self, x, start=0):
+    """ See LSTM.project """
+    return np.matmul(x, self.w_input[start:start + x.shape[-1]])
+
+  def step(self, projected, h):
+    gate_x = projected[:, :2 * self.units]
+    candidate_x = projected[:, 2 * self.units:]
+    gates = sigmoid(gate_x + np.matmul(h, self.w_gate_hidden) + self.gate_bias)
+    r, u = np.split(gates, 2, axis=1)
+    c = np.tanh(candidate_x + np.matmul(r * h, self.w_candidate_hidden) \
+                + self.candidate_bias)
+    h = u * h + (1 - u) * c
+    return h, h
+
+def run_layer(cell, inputs, seq_len, reverse=False):
+  """ A cell over inputs [batch, time, features], as tf.nn.dynamic_rnn
+  Returns:
+    outputs [batch, time, units], zero past seq_len
+    state, the state at the last step of each sequence
+  """
+  if reverse:
+    inputs = reverse_sequence(inputs, seq_len)
+  batch, time = inputs.shape[:2]
+  projected = cell.project(inputs)
+  state = cell.zero_state(batch)
+  outputs = np.zeros((batch, time, cell.units), np.float32)
+  for t in range(time):
+    valid = (t < seq_len)[:, None]
+    output, new_state = cell.step(projected[:, t], state)
+    outputs[:, t] = np.where(valid, output, 0.)
+    state = map_state(lambda new, old: np.where(valid, new, old),
+                      new_state, state)
+  if reverse:
+    outputs = reverse_sequence(outputs, seq_len)
+  return outputs, state
+
+class Engine():
+  """ EncDecClass inference """
+  def __init__(self, hparams, weights, inv_vocab=None):
+    """
+    Args:
+      hparams: dictionary, as saved in model.json
+      weights: dictionary {variable name: array}, possibly quantized
+    """
+    self.hparams = hparams
+    self.inv_vocab = inv_vocab
+    self.cell_type = hparams["cell_type"]
+    if self.cell_type not in LSTM_CELLS + ["GRUCell"]:
+      raise ValueError("No numpy engine for cell type " + self.cell_type)
+    self.num_layers = hparams["num_layers"]
+    self.residual = hparams["residual"] == True
+    self.max_seq_len = hparams["max_seq_len"]
+
+    # An int8 embedding stays quantized, rows are converted after the lookup
+    self.emb_scale = None
+    if EMBEDDING_NAME + "_int8" in weights:
+      self.embedding = weights[EMBEDDING_NAME + "_int8"]
+      self.emb_scale = weights[EMBEDDING_NAME + "_scale"]
+    else:
+      self.embedding = weights[EMBEDDING_NAME]
+    w = Weights(dequantize_weights(weights, keep=[EMBEDDING_NAME]))
+
+    # Encoder, a list of layers per direction
+    if hparams["bidirectional"] == True:
+      self.encoder = [self.layers(w, ["bidirectional_dynamic_rnn", direction])\
+                                  for direction in ["fw", "bw"]]
+    else:
+      self.encoder = [self.layers(w, ["dynamic_rnn"])]
+
+    # Decoder and attention
+    self.decoder = self.layers(w, ["decoder"], exclude=ATTENTION_SCOPES)
+    self.memory_layer = w.find("memory_layer", "kernel")
+    self.query_layer = w.find("query_layer", "kernel")
+    self.attention_layer = w.find("attention_layer", "kernel")
+    v = w.find("attention_v")
+    self.attention_v = w.find("attention_g") * v / np.sqrt(np.sum(v**2))
+    self.attention_b = w.find("attention_b", required=False)
+    if self.attention_b is None:
+      self.attention_b = np.zeros_like(v)
+
+    # Head
+    if hparams["class_over_sequence"] == True:
+      self.fc = [(w.find("fc_{}".format(i+1), "weights"),
+                  w.find("fc_{}".format(i+1), "biases"))
+                 for i in range(hparams["fc_num_layers"])]
+      self.class_w = w.find("class_log", "weights")
+      self.class_b = w.find("class_log", "biases")
+    else:
+      self.class_w = w.find("class_softmax", "weights")
+      self.class_b = w.find("class_softmax", "biases")
+
+  @classmethod
+  def from_dir(cls, model_dir):
+    """ Engine for a model directory written by export.save_model """
+    hparams, inv_vocab, weights = load_model(model_dir)
+    return cls(hparams, weights, inv_vocab)
+
+  def layers(self, w, scopes, exclude=()):
+    """ Cells of each layer under scopes, with MultiRNNCell scopes if stacked
+    """
+    cells = []
+    for i in range(self.num_layers):
+      layer = scopes + ["cell_{}".format(i)] if self.num_layers > 1 else scopes
+      if self.cell_type == "GRUCell":
+        cell = GRU(w.find(*layer, "gates", "kernel", exclude=exclude),
+                   w.find(*layer, "gates", "bias", exclude=exclude),
+                   w.find(*layer, "candidate", "kernel", exclude=exclude),
+                   w.find(*layer, "candidate", "bias", exclude=exclude))
+      else:
+        cell = LSTM(w.find(*layer, "kernel", exclude=exclude),
+                    w.find(*layer, "bias", exclude=exclude))
+      cells.append(cell)
+    return cells
+
+  def lookup(self, word_ids):
+    """ Embedded word ids, [batch, time, emb_dim] float32 """
+    embedded = self.embedding[word_ids].astype(np.float32)
+    if self.emb_scale is not None:
+      embedded *= self.emb_scale[word_ids][..., None]
+    return embedded
+
+  def encode(self, embedded, seq_len):
+    """ Encoder outputs [batch, time, units] and final state, the directions
+    are concatenated if bidirectional """
+    directions = []
+    for d, cells in enumerate(self.encoder):
+      x = embedded
+      states = []
+      for i, cell in enumerate(cells):
+        outputs, state = run_layer(cell, x, seq_len, reverse=d == 1)
+        if self.residual and i > 0:
+          outputs = outputs + x
+        x = outputs
+        states.append(state)
+      directions.append((x, states))
+    if len(directions) == 1:
+      return directions[0]
+    (out_fw, states_fw), (out_bw, states_bw) = directions
+    states = [map_state(lambda fw, bw: np.concatenate([fw, bw], 1), fw, bw)
+              for fw, bw in zip(states_fw, states_bw)]
+    return np.concatenate([out_fw, out_bw], 2), states
+
+  def attend(self, query, keys, values, memory_mask):
+    """ Bahdanau attention with normalized energy, returns the attention
+    layer output """
+    processed_query = np.matmul(query, self.query_layer)
+    score = np.sum(self.attention_v * np.tanh(keys + processed_query[:, None] \
+                   + self.attention_b), axis=2)
+    alignments = softmax(np.where(memory_mask, score, -np.inf), axis=1)
+    context = np.einsum('bt,btd->bd', alignments, values)
+    return np.matmul(np.concatenate([query, context], 1), self.attention_layer)
+
+  def decode(self, memory, enc_len, embedded, dec_len, states):
+    """ Attention decoder fed the decoder input, as TrainingHelper
+    Args:
+      states: list of initial states, one per decoder layer
+    Returns:
+      outputs [batch, time, attention units], zero past dec_len
+      attention at the last step of each sequence
+    """
+    batch, time = embedded.shape[:2]
+    keys = np.matmul(memory, self.memory_layer)
+    memory_mask = np.arange(memory.shape[1])[None, :] < enc_len[:, None]
+    first = self.decoder[0]
+    # Cell inputs are the embedding concatenated with the previous attention
+    projected = first.project(embedded)
+    emb_dim = embedded.shape[2]
+    attention = np.zeros((batch, self.attention_layer.shape[1]), np.float32)
+    outputs = np.zeros((batch, time, attention.shape[1]), np.float32)
+    for t in range(time):
+      valid = (t < dec_len)[:, None]
+      x = projected[:, t] + first.project(attention, start=emb_dim)
+      new_states = []
+      for i, cell in enumerate(self.decoder):
+        if i > 0:
+          inputs = output
+          x = cell.project(inputs)
+        output, state = cell.step(x, states[i])
+        if self.residual and i > 0:
+          output = output + inputs
+        new_states.append(state)
+      new_attention = self.attend(output, keys, memory, memory_mask)
+      outputs[:, t] = np.where(valid, new_attention, 0.)
+      # Finished sequences keep their state, as with impute_finished
+      attention = np.where(valid, new_attention, attention)
+      states = [map_state(lambda new, old: np.where(valid, new, old), n, o)
+                for n, o in zip(new_states, states)]
+    return outputs, attention
+
+  def head(self, outputs, attention):
+    """ Class logits, see EncDecClass """
+    if self.hparams["class_over_sequence"] == True:
+      # Max pool over units at each step, padded to max_seq_len
+      pooled = np.max(outputs, axis=2)
+      x = np.zeros((len(pooled), self.max_seq_len), np.float32)
+      x[:, :pooled.shape[1]] = pooled
+      for weights, biases in self.fc:
+        x = np.maximum(np.matmul(x, weights) + biases, 0.)
+    else:
+      x = attention
+    return np.matmul(x, self.class_w) + self.class_b
+
+  def logits(self, enc_input, enc_len, dec_input, dec_len):
+    """ Class logits for a batch, inputs as fed to the EncDecClass graph """
+    enc_len = np.asarray(enc_len)
+    dec_len = np.asarray(dec_len)
+    # Steps past the longest sequence are masked, no need to compute them
+    enc_input = np.asarray(enc_input)[:, :enc_len.max()]
+    dec_input = np.asarray(dec_input)[:, :dec_len.max()]
+    memory, states = self.encode(self.lookup(enc_input), enc_len)
+    outputs, attention = self.decode(memory, enc_len, self.lookup(dec_input),
+                                     dec_len, states)
+    return self.head(outputs, attention)
+
+  def predict(self, enc_input, enc_len, dec_input, dec_len):
+    """ Class index for a batch """
+    return np.argmax(self.logits(enc_input, enc_len, dec_input, dec_len), 1)
+
+  def predict_data(self, data, batch_size=None):
+    """ Class index for each sample of a Data object, in order """
+    if batch_size is None:
+      batch_size = self.hparams["batch_size"]
+    predictions = []
+    for start in range(0, data.size(), batch_size):
+      batch = slice(start, start + batch_size)
+      predictions.append(self.predict(
+          data.encoder_input[batch], data.seq_len_encoder[batch],
+          data.decoder_input[batch], data.seq_len_decoder[batch]))
+    return np.concatenate(predictions)
@@ -8,24 +8,43 @@ import re
 import json
 import copy
 from random import shuffle
+from multiprocessing import Pool
 
-def scan_folder(directory, output_file):
-  """ Scan raw PDTB files and save as a single json """
+def scan_folder(directory, output_file, processes=None):
+  """ Scan raw PDTB files and save as a single json, output_file is replaced
+  Section directories are parsed in parallel by processes workers, all cpus
+  if None, and written in order of section then file name
+  Returns:
+    number of discourses written
+  """
   print("Scanning dir for pipe files: ", directory)
-  for walk in _walklevel(directory, level=1): # for each subdir in root
-    cur_dir = walk[0]
-    if cur_dir == directory: continue # skip root
-    for pipe_file in walk[2]: # for each file in subdir
-      # For each discourse in pipe file
-      try:
-        for disc in _dict_from_pipe_file(cur_dir, pipe_file):
-          # Append the discourse dictionary to json file
-          _append_json_file(disc, output_file)
-      except UnicodeDecodeError as e:
-        print("Error in file: ", pipe_file)
-        print(e)
-        print("*****Process terminated*****")
-        sys.exit()
+  sections = sorted(os.path.join(directory, d) for d in os.listdir(directory) \
+                    if os.path.isdir(os.path.join(directory, d)))
+  with codecs.open(output_file, mode='w', encoding='utf8',
+                   buffering=2**20) as pdtb:
+    if processes == 1:
+      return _write_lines(pdtb, map(_section_lines, sections))
+    # Results come in section order, each as soon as it is ready. The pool
+    # is terminated on leaving, once all are written or on an error
+    with Pool(processes) as pool:
+      return _write_lines(pdtb, pool.imap(_section_lines, sections))
+
+def _write_lines(f, results):
+  """ Write each list of lines of results to f, returns the line count """
+  count = 0
+  for lines in results:
+    f.writelines(lines)
+    count += len(lines)
+  return count
+
+def _section_lines(section_dir):
+  """ json lines of all discourses of a section directory, by file name """
+  lines = []
+  for pipe_file in sorted(os.listdir(section_dir)):
+    if not os.path.isfile(os.path.join(section_dir, pipe_file)): continue
+    for disc in _dict_from_pipe_file(section_dir, pipe_file):
+      lines.append(json.dumps(disc) + '\n')
+  return lines
 
 def make_data_set(pdtb, mapping, rng=None, sampling="down", equal_negative=True,
     types = ['Implicit', 'EntRel']):
@@ -266,13 +285,6 @@ def dict_to_json(disc_list, file_path):
       json.dump(disc, pdtb) # append to end of json file
       pdtb.write('\n') # new line
 
-def _append_json_file(data_dict, file_path):
-  """ Appends json file with data dictionary """
-
-  with codecs.open(file_path, mode='a', encoding='utf8') as pdtb:
-    json.dump(data_dict, pdtb) # append to end of json file
-    pdtb.write('\n') # new line
-
 def _dict_from_pipe_file(dirpath, filename):
   """ Yield dictionary for each discourse in file """
 
@@ -316,17 +328,6 @@ def _dict_from_pipe_file(dirpath, filename):
       yield data
       cnt += 1
 
-def _walklevel(some_dir, level=1):
-  """ Like os.walk but limit depth """
-  some_dir = some_dir.rstrip(os.path.sep)
-  assert os.path.isdir(some_dir)
-  num_sep = some_dir.count(os.path.sep)
-  for root, dirs, files in os.walk(some_dir):
-    yield root, dirs, files
-    num_sep_this = root.count(os.path.sep)
-    if num_sep + level <= num_sep_this:
-      del dirs[:]
-
 def _valid_list(*args):
   """ Returns list of non empty strings """
   new_list = []
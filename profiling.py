@@ -0,0 +1,147 @@
+"""
+Hierarchical timing of a run
+
+Stages nest: a stage opened inside another is recorded as its sub-stage. For
+each stage, the number of calls, total and longest wall time, CPU time and
+the process peak RSS when it ended are kept. Stages are meant to be coarse,
+such as data loading, graph construction, epochs and evaluation sets, so the
+cost of timing them is negligible.
+
+  from profiling import stage, timed
+  with stage("build_graph"):
+    model = Model(hparams, embedding, emb_dim)
+
+The profile of the module PROFILER is printed as a table, and saved as json,
+at exit once report_at_exit is called, see settings["profile"].
+"""
+import sys
+import json
+import time
+import atexit
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+  import resource
+except ImportError: # Windows
+  resource = None
+
+def peak_rss_mb():
+  """ Peak resident memory of the process so far, None if unsupported """
+  if resource is None:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Kilobytes on Linux, bytes on macOS
+  return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+class Stage():
+  """ Totals of a named stage, and of its sub-stages """
+  def __init__(self, name):
+    self.name = name
+    self.calls = 0
+    self.wall = 0.
+    self.cpu = 0.
+    self.max_wall = 0.
+    self.peak_rss = None
+    self.children = OrderedDict()
+
+  def child(self, name):
+    if name not in self.children:
+      self.children[name] = Stage(name)
+    return self.children[name]
+
+  def to_dict(self):
+    return {"calls": self.calls, "wall_sec": self.wall, "cpu_sec": self.cpu,
+            "max_wall_sec": self.max_wall, "peak_rss_mb": self.peak_rss,
+            "stages": {k: v.to_dict() for k, v in self.children.items()}}
+
+class Profiler():
+  """ Tree of stages, timed with stage() """
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.root = Stage("run")
+    self._stack = [self.root]
+    self._start = (time.perf_counter(), time.process_time())
+
+  @contextmanager
+  def stage(self, name):
+    """ Time the enclosed block as a sub-stage of the current stage """
+    if not self.enabled:
+      yield None
+      return
+    node = self._stack[-1].child(name)
+    self._stack.append(node)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield node
+    finally:
+      wall = time.perf_counter() - wall
+      node.calls += 1
+      node.wall += wall
+      node.cpu += time.process_time() - cpu
+      node.max_wall = max(node.max_wall, wall)
+      rss = peak_rss_mb()
+      if rss is not None:
+        node.peak_rss = max(node.peak_rss or 0, rss)
+      self._stack.pop()
+
+  def profile(self):
+    """ Dictionary of the whole run so far """
+    self.root.calls = 1
+    self.root.wall = time.perf_counter() - self._start[0]
+    self.root.cpu = time.process_time() - self._start[1]
+    self.root.max_wall = self.root.wall
+    self.root.peak_rss = peak_rss_mb()
+    return self.root.to_dict()
+
+  def table(self):
+    """ Compact console table of the stages, indented by depth """
+    self.profile()
+    total = max(self.root.wall, 1e-9)
+    lines = ['{:<36} {:>6} {:>9} {:>9} {:>6} {:>9} {:>9}'.format('stage',
+             'calls', 'wall s', 'cpu s', '%', 'max s', 'rss MB')]
+    def add(node, depth):
+      name = ('  ' * depth + node.name)[:36]
+      rss = '-' if node.peak_rss is None else '{:.0f}'.format(node.peak_rss)
+      lines.append('{:<36} {:>6} {:>9.2f} {:>9.2f} {:>6.1f} {:>9.2f} '
+                   '{:>9}'.format(name, node.calls, node.wall, node.cpu,
+                   100 * node.wall / total, node.max_wall, rss))
+      for child in node.children.values():
+        add(child, depth + 1)
+    add(self.root, 0)
+    return '\n'.join(lines)
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.profile(), f, indent=2)
+
+PROFILER = Profiler()
+
+def stage(name):
+  """ Stage of the module profiler, see Profiler.stage """
+  return PROFILER.stage(name)
+
+def timed(name):
+  """ Decorator timing each call of a function as a stage """
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      with PROFILER.stage(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def report_at_exit(path=None, profiler=PROFILER):
+  """ Print the profile table at exit, and save it as json to path if given
+  """
+  def report():
+    if not profiler.enabled:
+      return
+    print()
+    print(profiler.table())
+    if path is not None:
+      profiler.save(path)
+      print('Profile saved to {}'.format(path))
+  atexit.register(report)
@@ -0,0 +1,238 @@
+"""
+Post-training int8 quantization of a trained EncDecClass
+
+Weight matrices (cell kernels, attention and head layers, embedding) are
+quantized symmetrically to int8, with a scale per output unit, or per row for
+the embedding. The clipping percentile is calibrated on a sample of training
+relations: the candidate whose int8 model best matches the class
+probabilities of the float model is kept. Accuracy of both models is reported
+on the validation and test sets.
+
+The int8 model is saved as a checkpoint of the int8 inference graph, and as
+an exported model directory, see export.py
+
+python quantize.py --checkpoint_dir ckpt --output ckpt/int8
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+from export import restore, variable_name, model_weights, save_model, \
+                   channel_axis, channel_shape
+from training import call_model, classification_f1
+
+def quantize(w, axis=-1, percentile=100.):
+  """ Symmetric int8 quantization with a scale per channel along axis
+  Args:
+    percentile: of absolute values per channel, to clip outliers
+  Returns:
+    q: int8 array with the shape of w
+    scale: float32 array, one per channel, such that w ~ q * scale
+  """
+  axis = axis % w.ndim
+  other_axes = tuple(i for i in range(w.ndim) if i != axis)
+  if percentile >= 100.:
+    bound = np.max(np.abs(w), axis=other_axes)
+  else:
+    bound = np.percentile(np.abs(w), percentile, axis=other_axes)
+  scale = np.maximum(bound, 1e-8) / 127.
+  q = np.round(w / scale.reshape(channel_shape(w.shape, axis)))
+  q = np.clip(q, -127, 127).astype(np.int8)
+  return q, scale.astype(np.float32)
+
+def quantize_weights(weights, percentile=100., min_size=1024):
+  """ Quantize all matrices of at least min_size values, small variables
+  such as biases stay float32
+  Returns:
+    weights dictionary, where each quantized name is replaced by
+    name + "_int8" and name + "_scale"
+  """
+  quantized = {}
+  for name, w in weights.items():
+    if w.ndim == 2 and w.size >= min_size:
+      q, scale = quantize(w, channel_axis(name), percentile)
+      quantized[name + "_int8"] = q
+      quantized[name + "_scale"] = scale
+    else:
+      quantized[name] = w
+  return quantized
+
+def quantized_names(weights):
+  """ Names of the original variables in quantized weights """
+  return set(k[:-len("_int8")] for k in weights if k.endswith("_int8"))
+
+def int8_variable_getter(names):
+  """ Custom getter for the int8 inference graph. Variables in names are
+  stored as int8 with their scales, and dequantized where they are used
+  """
+  def getter_fn(getter, name, shape=None, dtype=None, *args, **kwargs):
+    if name not in names:
+      return getter(name, shape, dtype, *args, **kwargs)
+    if shape is None: # initialized from a tensor, such as the embedding
+      shape = kwargs["initializer"].get_shape()
+    shape = tf.TensorShape(shape).as_list()
+    axis = channel_axis(name) % len(shape)
+    kwargs.update(initializer=tf.zeros_initializer(), trainable=False)
+    q = getter(name + "_int8", shape, tf.int8, *args, **kwargs)
+    scale = getter(name + "_scale", [shape[axis]], tf.float32, *args, **kwargs)
+    w = tf.cast(q, tf.float32) * tf.reshape(scale, channel_shape(shape, axis))
+    if dtype is not None and dtype != tf.float32:
+      w = tf.cast(w, dtype)
+    return w
+  return getter_fn
+
+def load_weights(sess, weights):
+  """ Assign weights {name: array} to the variables of the same name
+  Returns:
+    the variables assigned
+  """
+  by_name = {variable_name(v): v for v in tf.global_variables()}
+  assigned = []
+  for name, value in weights.items():
+    if name in by_name:
+      by_name[name].load(value, sess)
+      assigned.append(by_name[name])
+  return assigned
+
+def class_logits(sess, model, data, batch_size):
+  """ Class logits for all samples of data, in order """
+  results = call_model(sess, model, data, model.class_logits, batch_size,
+                       data.num_batches(batch_size), keep_prob=1,
+                       shuffle=False, mode=0)
+  return np.concatenate(list(results))
+
+def softmax(logits):
+  e = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+  return e / np.sum(e, axis=1, keepdims=True)
+
+def compare(ref_logits, logits):
+  """ Mean KL divergence of the class probabilities, and prediction agreement """
+  p, q = softmax(ref_logits), softmax(logits)
+  kl = np.mean(np.sum(p * (np.log(p + 1e-12) - np.log(q + 1e-12)), axis=1))
+  agreement = np.mean(np.argmax(ref_logits, 1) == np.argmax(logits, 1))
+  return float(kl), float(agreement)
+
+def evaluate(sess, model, datasets, batch_size):
+  """ F1 and accuracy for each (name, Data) in datasets """
+  scores = {}
+  for name, data in datasets:
+    f1, _, acc, _ = classification_f1(sess, data, model, batch_size,
+                                      data.num_batches(batch_size), False)
+    scores[name] = {"f1": float(f1), "acc": float(acc)}
+  return scores
+
+def size_bytes(weights):
+  return int(sum(w.nbytes for w in weights.values()))
+
+def quantize_model(Model, hparams, embedding, emb_dim, dataset_dict, inv_vocab,
+                   checkpoint_dir, output_dir, percentiles=(100.,),
+                   calibration_size=500, min_size=1024, config=None):
+  """ Quantize the latest checkpoint in checkpoint_dir, calibrate, evaluate
+  and save the int8 model to output_dir
+  Returns:
+    report dictionary
+  """
+  batch_size = hparams.batch_size
+  datasets = [(name, dataset_dict[name]) for name in \
+              ['validation_set', 'test_set'] if name in dataset_dict]
+  calib_set = dataset_dict['training_set'].subsample(calibration_size)
+
+  # Float model
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
+    model = Model(hparams, embedding, emb_dim)
+    restore(sess, checkpoint_dir)
+    weights = model_weights(sess, model)
+    ref_logits = class_logits(sess, model, calib_set, batch_size)
+    float_scores = evaluate(sess, model, datasets, batch_size)
+
+  # Int8 model, same graph for each calibration candidate
+  names = quantized_names(quantize_weights(weights, min_size=min_size))
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
+    with tf.variable_scope(tf.get_variable_scope(),
+                           custom_getter=int8_variable_getter(names)):
+      model = Model(hparams, embedding, emb_dim)
+    sess.run(tf.global_variables_initializer(), model.init_feed)
+
+    calibration = []
+    best = None
+    for percentile in percentiles:
+      qweights = quantize_weights(weights, percentile, min_size)
+      load_weights(sess, qweights)
+      kl, agreement = compare(ref_logits,
+                              class_logits(sess, model, calib_set, batch_size))
+      calibration.append({"percentile": percentile, "kl": kl,
+                          "agreement": agreement})
+      if best is None or kl < best[0]:
+        best = (kl, percentile, qweights)
+    kl, percentile, qweights = best
+
+    saved = load_weights(sess, qweights)
+    int8_scores = evaluate(sess, model, datasets, batch_size)
+    if not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+    tf.train.Saver(var_list=saved).save(sess,
+                                    os.path.join(output_dir, 'model_int8.ckpt'))
+  save_model(output_dir, qweights, hparams, inv_vocab)
+
+  report = {
+    "percentile"    : percentile,
+    "calibration"   : calibration,
+    "quantized"     : sorted(names),
+    "float_bytes"   : size_bytes(weights),
+    "int8_bytes"    : size_bytes(qweights),
+    "float"         : float_scores,
+    "int8"          : int8_scores}
+  with open(os.path.join(output_dir, 'quantization.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+  return report
+
+def print_report(report):
+  print('Calibration, kept percentile {}'.format(report["percentile"]))
+  for c in report["calibration"]:
+    print('  percentile {:>7} kl {:.6f} agreement {:.4f}'.format(
+          c["percentile"], c["kl"], c["agreement"]))
+  print('Weights: {:.1f} MB float32, {:.1f} MB int8'.format(
+        report["float_bytes"] / 2**20, report["int8_bytes"] / 2**20))
+  print('{:>16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('dataset',
+        'f1', 'int8 f1', 'delta', 'acc', 'int8 acc', 'delta'))
+  for name, s in report["float"].items():
+    q = report["int8"][name]
+    print('{:>16} {:>8.4f} {:>8.4f} {:>+8.4f} {:>8.4f} {:>8.4f} {:>+8.4f}'.format(
+          name, s["f1"], q["f1"], q["f1"] - s["f1"], s["acc"], q["acc"],
+          q["acc"] - s["acc"]))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--settings', default='settings.json')
+  parser.add_argument('--checkpoint_dir',
+                      help='trained model, default settings checkpoint_dir')
+  parser.add_argument('--output', help='default checkpoint_dir/int8')
+  parser.add_argument('--percentiles', default="100,99.99,99.9",
+                      help='clipping candidates for calibration')
+  parser.add_argument('--calibration_size', type=int, default=500,
+                      help='training relations used to calibrate')
+  parser.add_argument('--min_size', type=int, default=1024,
+                      help='smaller matrices stay float32')
+  args = parser.parse_args()
+
+  from helper import settings, get_data_embeddings
+  from enc_dec import EncDecClass
+  from utils import session_config
+  hparams, s = settings(args.settings)
+  checkpoint_dir = args.checkpoint_dir or s['checkpoint_dir']
+  if checkpoint_dir is None:
+    parser.error('no checkpoint_dir given or in settings')
+  output_dir = args.output or os.path.join(checkpoint_dir, 'int8')
+
+  dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                        get_data_embeddings(hparams, s)
+  report = quantize_model(EncDecClass, hparams, embedding, emb_dim,
+                dataset_dict, inv_vocab, checkpoint_dir, output_dir,
+                percentiles=[float(p) for p in args.percentiles.split(',')],
+                calibration_size=args.calibration_size,
+                min_size=args.min_size, config=session_config(s))
+  print_report(report)
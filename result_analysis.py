@@ -1,46 +1,216 @@
 """
 python result_analysis.py trials/pdtb/cell_units one_v_all --metric val_f1
+python result_analysis.py trials/pdtb/cell_units one_v_all --top 5
+python result_analysis.py trials/pdtb/cell_units one_v_all --sweep cell_units --plot
+
+Results are indexed in a SQLite file next to the results (path + ".db"), only
+new lines are read on later calls. A results file replaced or rewritten since,
+as told by its inode and first line, is read again from the start
 """
 from pprint import pprint
+import os
 import json
-import codecs
+import hashlib
+import sqlite3
 import argparse
 
-def best(results, dataset, metric):
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+  path        TEXT PRIMARY KEY,
+  offset      INTEGER NOT NULL,
+  fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS trials (
+  id       INTEGER PRIMARY KEY,
+  source   TEXT,
+  dataset  TEXT,
+  relation TEXT,
+  record   TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+  trial_id INTEGER,
+  name     TEXT,
+  value    TEXT,
+  num      REAL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+  trial_id INTEGER,
+  name     TEXT,
+  value    REAL
+);
+CREATE INDEX IF NOT EXISTS trials_dataset ON trials (dataset, relation);
+CREATE INDEX IF NOT EXISTS params_name ON params (name, value, trial_id);
+CREATE INDEX IF NOT EXISTS params_trial ON params (trial_id, name);
+CREATE INDEX IF NOT EXISTS metrics_name ON metrics (name, value, trial_id);
+CREATE INDEX IF NOT EXISTS metrics_trial ON metrics (trial_id, name);
+"""
+
+class ResultStore():
+  """ Trial results indexed by dataset, relation, params and metrics """
+  def __init__(self, db_path=":memory:"):
+    self.conn = sqlite3.connect(db_path)
+    self.conn.executescript(SCHEMA)
+    columns = [c[1] for c in self.conn.execute("PRAGMA table_info(sources)")]
+    if "fingerprint" not in columns:
+      # Index of an earlier version, its sources are read again
+      self.conn.execute("ALTER TABLE sources ADD COLUMN fingerprint TEXT")
+
+  def close(self):
+    self.conn.close()
+
+  def ingest(self, filepath):
+    """ Add new lines of a JSON lines results file, returns number added """
+    path = os.path.abspath(filepath)
+    fingerprint = _fingerprint(path)
+    row = self.conn.execute("SELECT offset, fingerprint FROM sources "
+                            "WHERE path = ?", (path,)).fetchone()
+    offset = row[0] if row is not None else 0
+    if row is not None and (row[1] != fingerprint or \
+                            offset > os.path.getsize(path)):
+      # File was replaced or rewritten, start over
+      self._remove_source(path)
+      offset = 0
+
+    added = 0
+    with open(path, 'rb') as f, self.conn:
+      f.seek(offset)
+      for line in f:
+        if not line.endswith(b'\n'):
+          break # partially written, read on next call
+        offset += len(line)
+        line = line.strip()
+        if not line: continue
+        self._insert(path, json.loads(line.decode('utf8')))
+        added += 1
+      self.conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                        (path, offset, fingerprint))
+    if added > 0:
+      # Refresh statistics, or sqlite may join in the wrong order
+      self.conn.execute("ANALYZE")
+    return added
+
+  def _remove_source(self, path):
+    with self.conn:
+      ids = "SELECT id FROM trials WHERE source = ?"
+      self.conn.execute("DELETE FROM params WHERE trial_id IN (" + ids + ")",
+                        (path,))
+      self.conn.execute("DELETE FROM metrics WHERE trial_id IN (" + ids + ")",
+                        (path,))
+      self.conn.execute("DELETE FROM trials WHERE source = ?", (path,))
+      self.conn.execute("DELETE FROM sources WHERE path = ?", (path,))
+
+  def _insert(self, source, r):
+    """ Insert a single record, numbers parsed once here """
+    params = r.get("params", {})
+    cur = self.conn.execute(
+        "INSERT INTO trials (source, dataset, relation, record) VALUES (?,?,?,?)",
+        (source, params.get("dataset_name"), params.get("relation"),
+         json.dumps(r)))
+    trial_id = cur.lastrowid
+    param_rows = []
+    for name, value in params.items():
+      if type(value) in (list, dict): continue
+      num = None if type(value) is bool else _to_float(value)
+      param_rows.append((trial_id, name, str(value), num))
+    metric_rows = []
+    for name, value in r.get("metrics", {}).items():
+      value = _to_float(value)
+      if value is None: continue
+      metric_rows.append((trial_id, name, value))
+    self.conn.executemany("INSERT INTO params VALUES (?,?,?,?)", param_rows)
+    self.conn.executemany("INSERT INTO metrics VALUES (?,?,?)", metric_rows)
+
+  def best(self, dataset, metric):
+    """ Returns the best record for each relation type based on metric """
+    query = """
+      SELECT relation, record FROM (
+        SELECT t.relation, t.record, ROW_NUMBER() OVER (
+          PARTITION BY t.relation ORDER BY m.value DESC, t.id) AS rank
+        FROM trials t JOIN metrics m ON m.trial_id = t.id
+        WHERE t.dataset = ? AND m.name = ?)
+      WHERE rank = 1"""
+    rows = self.conn.execute(query, (dataset, metric))
+    return {relation: json.loads(record) for relation, record in rows}
+
+  def top_k(self, dataset, metric, k=10, relation=None):
+    """ Returns the k best records, optionally for a single relation """
+    query = """
+      SELECT t.record FROM trials t JOIN metrics m ON m.trial_id = t.id
+      WHERE t.dataset = ? AND m.name = ?"""
+    args = [dataset, metric]
+    if relation is not None:
+      query += " AND t.relation = ?"
+      args.append(relation)
+    query += " ORDER BY m.value DESC, t.id LIMIT ?"
+    args.append(k)
+    return [json.loads(r[0]) for r in self.conn.execute(query, args)]
+
+  def sweep(self, dataset, param, metric, relation=None):
+    """ Aggregate metric for each value of param
+    Returns:
+      dict {relation: list of (value, count, mean, max)}, sorted by value
+    """
+    query = """
+      SELECT t.relation, p.value, p.num, COUNT(*), AVG(m.value), MAX(m.value)
+      FROM trials t
+        JOIN params p ON p.trial_id = t.id AND p.name = ?
+        JOIN metrics m ON m.trial_id = t.id AND m.name = ?
+      WHERE t.dataset = ?"""
+    args = [param, metric, dataset]
+    if relation is not None:
+      query += " AND t.relation = ?"
+      args.append(relation)
+    query += " GROUP BY t.relation, p.value ORDER BY t.relation, p.num, p.value"
+    sweeps = {}
+    for rel, value, num, count, mean, best in self.conn.execute(query, args):
+      value = num if num is not None else value
+      sweeps.setdefault(rel, []).append((value, count, mean, best))
+    return sweeps
+
+def _fingerprint(path):
+  """ Inode and hash of the first line, appending lines keeps them """
+  with open(path, 'rb') as f:
+    first = f.readline()
+  return '{}:{}'.format(os.stat(path).st_ino, hashlib.sha1(first).hexdigest())
+
+def _to_float(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+def best(store, dataset, metric):
   """ Returns the best for each relation type based on metric """
-  best = {}
-  for r in results:
-    # Check task
-    if "dataset_name" not in r["params"]:
-      continue
-    if r["params"]["dataset_name"] != dataset:
-      continue
-
-    relation = r["params"]["relation"]
-
-    # Skip if line does not have metric
-    if metric not in r["metrics"]:
-      continue
-    score = float(r["metrics"][metric])
-    if relation in best:
-      if score > float(best[relation]["metrics"][metric]):
-        best[relation] = r
-    else:
-      best[relation] = r
-  return best
-
-def graph(results, param):
-  """ y as f1, x as varying parameter """
-  pass
-
-def load(filepath):
-  """ Returns list of dictionaries from file """
-  results = []
-  with open(filepath, encoding='utf8') as pdfile:
-    for line in pdfile:
-      j = json.loads(line)
-      results += [j]
-  return results
+  return store.best(dataset, metric)
+
+def graph(store, dataset, param, metric, path=None):
+  """ y as metric, x as varying parameter, one line per relation """
+  import matplotlib
+  if path is not None:
+    matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
+
+  for relation, points in sorted(store.sweep(dataset, param, metric).items()):
+    x = [p[0] for p in points]
+    plt.plot(x, [p[3] for p in points], marker='o', label='{} max'.format(relation))
+    plt.plot(x, [p[2] for p in points], linestyle='--',
+              label='{} mean'.format(relation))
+  plt.xlabel(param)
+  plt.ylabel(metric)
+  plt.legend()
+  if path is None:
+    plt.show()
+  else:
+    plt.savefig(path)
+    print('Saved plot to ', path)
+
+def load(filepath, db_path=None):
+  """ Returns a ResultStore with the results file indexed """
+  if db_path is None:
+    db_path = filepath + '.db'
+  store = ResultStore(db_path)
+  store.ingest(filepath)
+  return store
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="analyze results")
@@ -48,12 +218,30 @@ if __name__ == "__main__":
   parser.add_argument('dataset', help='"one_v_all" or "conll"')
   parser.add_argument('--metric', help='metric to check for best result',
       default='val_f1')
+  parser.add_argument('--db', help='index file, default is filepath + ".db"')
+  parser.add_argument('--top', type=int, help='print the k best results')
+  parser.add_argument('--relation', help='only this relation for --top/--sweep')
+  parser.add_argument('--sweep', help='aggregate metric over this parameter')
+  parser.add_argument('--plot', action='store_true', help='plot the sweep')
+  parser.add_argument('--plot_path', help='save plot instead of showing it')
   args = parser.parse_args()
-  results = load(args.filepath)
-  print('-' * 80)
-  print('Printing the best results based on metric: ', args.metric)
-  print('-' * 80)
-  pprint(best(results, args.dataset, args.metric))
-
-
-
+  results = load(args.filepath, args.db)
+  if args.sweep is not None:
+    print('-' * 80)
+    print('Sweep of {} over {}: value, count, mean, max'.format(
+                                                      args.metric, args.sweep))
+    print('-' * 80)
+    pprint(results.sweep(args.dataset, args.sweep, args.metric, args.relation))
+    if args.plot:
+      graph(results, args.dataset, args.sweep, args.metric, args.plot_path)
+  elif args.top is not None:
+    print('-' * 80)
+    print('Printing the {} best results based on metric: {}'.format(
+                                                      args.top, args.metric))
+    print('-' * 80)
+    pprint(results.top_k(args.dataset, args.metric, args.top, args.relation))
+  else:
+    print('-' * 80)
+    print('Printing the best results based on metric: ', args.metric)
+    print('-' * 80)
+    pprint(best(results, args.dataset, args.metric))
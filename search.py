@@ -0,0 +1,269 @@
+"""
+-----------
+Description
+-----------
+Parallel hyperparameter search. Trials run in a pool of processes, each
+limited to a number of threads, and results are appended as JSON lines with
+"params" and "metrics", as expected by result_analysis.py
+
+The search space is a json file mapping HParams fields to either a list of
+choices or a range, for example:
+
+{
+  "cell_units" : [32, 64, 128],
+  "l_rate"     : {"min": 0.0001, "max": 0.01, "log": true},
+  "keep_prob"  : {"min": 0.3, "max": 0.9},
+  "cell_type"  : ["LSTMCell", "GRUCell"]
+}
+
+Trials already in the results file are skipped, so an interrupted search
+resumes by calling the script again with the same arguments.
+
+With --task head, only the classification head is trained, on the features
+extracted from a trained model by features.py
+
+python search.py space.json trials/search.json --trials 40 --workers 4
+python search.py head_space.json trials/head.json --task head --features ckpt/features
+-----------
+"""
+import os
+import copy
+import json
+import codecs
+import hashlib
+import argparse
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+###############################################################################
+# Search space
+###############################################################################
+def sample_params(space, rng):
+  """ Sample a single trial from the search space """
+  params = {}
+  for name in sorted(space):
+    dim = space[name]
+    if type(dim) is list:
+      params[name] = dim[rng.randint(len(dim))]
+    elif dim.get("log", False):
+      low, high = np.log(dim["min"]), np.log(dim["max"])
+      params[name] = float(np.exp(rng.uniform(low, high)))
+    elif type(dim["min"]) is int and type(dim["max"]) is int:
+      params[name] = int(rng.randint(dim["min"], dim["max"] + 1))
+    else:
+      params[name] = float(rng.uniform(dim["min"], dim["max"]))
+  return params
+
+def sample_trials(space, num_trials, seed=1, max_draws=None):
+  """ Returns list of (trial_id, params), same list for same seed
+  Duplicate draws are skipped, so a small discrete space may give fewer
+  trials, once max_draws (100 * num_trials by default) draws are made
+  """
+  rng = np.random.RandomState(seed)
+  max_draws = max_draws or 100 * num_trials
+  trials = []
+  seen = set()
+  for _ in range(max_draws):
+    if len(trials) == num_trials:
+      break
+    params = sample_params(space, rng)
+    tid = trial_id(params)
+    if tid not in seen:
+      seen.add(tid)
+      trials.append((tid, params))
+  return trials
+
+def trial_id(params):
+  """ Unique id from the trial parameters """
+  dump = json.dumps(params, sort_keys=True)
+  return hashlib.sha1(dump.encode('utf8')).hexdigest()[:12]
+
+###############################################################################
+# Trial persistence
+###############################################################################
+def load_records(path):
+  """ Returns list of trial records from JSON lines file """
+  records = []
+  if not os.path.isfile(path):
+    return records
+  with codecs.open(path, encoding='utf8') as f:
+    for line in f:
+      line = line.strip()
+      if not line: continue
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        continue # partially written line from an interrupted search
+  return records
+
+def append_record(record, path):
+  """ Append a single trial record to the JSON lines file """
+  folder = os.path.dirname(path)
+  if folder and not os.path.exists(folder):
+    os.makedirs(folder)
+  with codecs.open(path, mode='a', encoding='utf8') as f:
+    f.write(json.dumps(record, default=float) + '\n')
+    f.flush()
+
+class MedianPruner():
+  """ Median stopping rule: a trial is pruned if its best validation score so
+  far is below the median of the other trials at the same epoch
+  """
+  def __init__(self, results_path, min_trials=3, warmup_epochs=2):
+    """
+    Args:
+      results_path : JSON lines file with a "curve" for each finished trial
+      min_trials : do not prune before this many trials reached the epoch
+      warmup_epochs : do not prune during the first epochs
+    """
+    self.results_path = results_path
+    self.min_trials = min_trials
+    self.warmup_epochs = warmup_epochs
+    self.curve = [] # per epoch validation score of this trial
+    self.pruned = False
+
+  def median_at(self, epoch):
+    """ Median of the other trials' best score up to epoch, or None """
+    best = []
+    for r in load_records(self.results_path):
+      curve = r.get("curve", [])
+      if len(curve) > epoch:
+        best.append(max(curve[:epoch+1]))
+    if len(best) < self.min_trials:
+      return None
+    return float(np.median(best))
+
+  def __call__(self, epoch, metrics):
+    """ Epoch hook for training.train, returns True to stop the trial """
+    self.curve.append(float(metrics.metric_current))
+    if epoch < self.warmup_epochs:
+      return False
+    median = self.median_at(epoch)
+    if median is not None and max(self.curve) < median:
+      self.pruned = True
+      print('\nTrial pruned, best {:.4f} < median {:.4f}'.format(
+                                                    max(self.curve), median))
+    return self.pruned
+
+###############################################################################
+# Workers
+###############################################################################
+_worker = {}
+
+def _init_worker(settings_path, task, threads, pin, features=None):
+  """ Limit threads, maybe pin to cpus, and load data once per process """
+  for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+    os.environ[var] = str(threads)
+
+  # Imported here so thread limits are set before tensorflow loads
+  from helper import settings, get_data_embeddings
+  from enc_dec import EncDecGen, EncDecClass
+  from utils import session_config, set_cpu_affinity
+
+  if pin:
+    # Worker i gets its own block of cpus
+    worker = multiprocessing.current_process()._identity[0] - 1
+    first = worker * threads % os.cpu_count()
+    set_cpu_affinity(set(range(first, min(first + threads, os.cpu_count()))))
+
+  hparams, s = settings(settings_path)
+  _worker.update(task=task, config=session_config(s, threads, threads))
+  if task == 'head':
+    # Memory mapped, the pages are shared by the workers
+    from features import load_features
+    _worker.update(hparams=hparams, settings=s, data=load_features(features))
+    return
+  dataset_dict, vocab, inv_vocab, embedding, emb_dim = \
+                                        get_data_embeddings(hparams, s)
+  _worker.update(
+    hparams = hparams,
+    settings = s,
+    model = EncDecGen if task == 'generation' else EncDecClass,
+    data = (embedding, emb_dim, dataset_dict, vocab, inv_vocab))
+
+def _run_trial(args):
+  """ Run a single trial in a worker, returns the trial record """
+  from training import train
+  tid, params, results_path, prune = args
+  # The worker hparams are the base of every trial it runs
+  hparams = copy.copy(_worker['hparams'])
+  s = _worker['settings']
+  hparams.update(**params)
+  if s['checkpoint_dir'] is not None:
+    # Trials must not overwrite each other's checkpoints
+    s = dict(s, checkpoint_dir=os.path.join(_worker['settings']['checkpoint_dir'], tid))
+  pruner = MedianPruner(results_path) if prune else None
+
+  start = datetime.now()
+  if _worker['task'] == 'head':
+    from features import train_head
+    met = train_head(hparams, s, _worker['data'], config=_worker['config'],
+                     epoch_hook=pruner)
+  else:
+    met = train(hparams, s, _worker['model'], *_worker['data'],
+                config=_worker['config'], epoch_hook=pruner)
+  dataset_name = s['use_dataset']
+  record = {
+    "trial"   : tid,
+    "status"  : "pruned" if pruner is not None and pruner.pruned else "complete",
+    "params"  : dict(vars(hparams), dataset_name=dataset_name,
+                     relation=s[dataset_name]['this_relation']),
+    "metrics" : met.metric_dict if met is not None else {},
+    "curve"   : pruner.curve if pruner is not None else [],
+    "minutes" : (datetime.now() - start).total_seconds() / 60
+  }
+  return record
+
+def search(space, results_path, num_trials, workers=1, threads=1,
+          settings_path='settings.json', task='classification', prune=True,
+          seed=1, pin=False, features=None):
+  """ Run all trials not already in results_path """
+  done = set(r["trial"] for r in load_records(results_path) if "trial" in r)
+  todo = [(tid, params, results_path, prune) for tid, params in \
+              sample_trials(space, num_trials, seed) if tid not in done]
+  print('Trials done: {}, to run: {}'.format(len(done), len(todo)))
+  if len(todo) == 0:
+    return
+
+  # Spawn so each worker starts with a fresh tensorflow
+  ctx = multiprocessing.get_context('spawn')
+  pool = ctx.Pool(workers, initializer=_init_worker,
+                  initargs=(settings_path, task, threads, pin, features))
+  try:
+    for record in pool.imap_unordered(_run_trial, todo):
+      append_record(record, results_path)
+      print('Trial {} {}: {}'.format(record["trial"], record["status"],
+            record["metrics"].get("val_f1")))
+  finally:
+    pool.close()
+    pool.join()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('space', help='json file of the search space')
+  parser.add_argument('results', help='json lines file of trial results')
+  parser.add_argument('--trials', type=int, default=20, help='number of trials')
+  parser.add_argument('--workers', type=int, default=1, help='parallel trials')
+  parser.add_argument('--threads', type=int, default=1, help='threads per trial')
+  parser.add_argument('--settings', default='settings.json')
+  parser.add_argument('--task', default="classification",
+                      help='generation, classification or head')
+  parser.add_argument('--no_prune', action='store_true',
+                      help='disable median stopping')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--pin', action='store_true',
+                      help='pin each worker to its own block of cpus')
+  parser.add_argument('--features',
+                      help='features directory of features.py, for --task head')
+  args = parser.parse_args()
+  if args.task == 'head' and args.features is None:
+    parser.error('--task head needs --features')
+
+  with codecs.open(args.space, encoding='utf-8') as f:
+    space = json.load(f)
+  search(space, args.results, args.trials, args.workers, args.threads,
+        args.settings, args.task, not args.no_prune, args.seed, args.pin,
+        args.features)
@@ -0,0 +1,196 @@
+"""
+Relation classifier for serving, with a prediction cache
+
+Relations are normalized with clean_str and mapped to token ids as in
+training. The class probabilities of each relation are cached by a hash of
+its Arg1 and Arg2 token ids and of the model version. The cache is an LRU
+bounded in entries, with an optional sqlite file as a persistent tier, so
+repeated relations skip the numpy engine.
+
+  classifier = Classifier.from_dir("checkpoints/export", cache_path="preds.db")
+  probs = classifier.probabilities([("arg1 text", "arg2 text")])
+  print(classifier.cache.stats())
+"""
+import os
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+from helper import clean_str
+from numpy_engine import Engine, softmax
+
+class PredictionCache():
+  """ LRU of class probabilities by key, in front of an optional sqlite file
+  """
+  def __init__(self, max_entries=100000, path=None):
+    """
+    Args:
+      max_entries: entries kept in memory, least recently used are evicted
+      path: sqlite file for the disk tier, entries are never evicted from it
+    """
+    self.max_entries = max_entries
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._db = None
+    if path is not None:
+      self._db = sqlite3.connect(path)
+      self._db.execute("CREATE TABLE IF NOT EXISTS predictions "
+                       "(key TEXT PRIMARY KEY, probs BLOB)")
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """ Probabilities of key, or None """
+    probs = self._entries.get(key)
+    if probs is not None:
+      self.hits += 1
+      self._entries.move_to_end(key)
+      return probs
+    if self._db is not None:
+      row = self._db.execute("SELECT probs FROM predictions WHERE key = ?",
+                             (key,)).fetchone()
+      if row is not None:
+        self.disk_hits += 1
+        probs = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, probs)
+        return probs
+    self.misses += 1
+    return None
+
+  def put_many(self, items):
+    """ Store [(key, probabilities)], one disk transaction for all """
+    items = [(key, np.asarray(probs, dtype=np.float32)) for key, probs in items]
+    for key, probs in items:
+      self._remember(key, probs)
+    if self._db is not None and len(items) > 0:
+      with self._db:
+        self._db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?)",
+                             [(key, probs.tobytes()) for key, probs in items])
+
+  def _remember(self, key, probs):
+    self._entries[key] = probs
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  def stats(self):
+    lookups = self.hits + self.disk_hits + self.misses
+    return {"entries": len(self), "hits": self.hits,
+            "disk_hits": self.disk_hits, "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.disk_hits) / max(lookups, 1)}
+
+  def close(self):
+    if self._db is not None:
+      self._db.close()
+      self._db = None
+
+def model_version(model_dir):
+  """ Hash of the files of an exported model """
+  digest = hashlib.sha1()
+  for name in ['model.json', 'weights.npz']:
+    with open(os.path.join(model_dir, name), 'rb') as f:
+      for block in iter(lambda: f.read(2**20), b''):
+        digest.update(block)
+  return digest.hexdigest()
+
+def relation_key(arg1_ids, arg2_ids, version):
+  """ Cache key of a relation, from its token ids and the model version """
+  digest = hashlib.blake2b(digest_size=16)
+  digest.update(version.encode('utf-8'))
+  digest.update(np.asarray(arg1_ids, dtype=np.int32).tobytes())
+  digest.update(b'|') # arguments boundary
+  digest.update(np.asarray(arg2_ids, dtype=np.int32).tobytes())
+  return digest.hexdigest()
+
+class Classifier():
+  """ Class probabilities of raw relations, cached """
+  def __init__(self, engine, version, cache=None, batch_size=None):
+    """
+    Args:
+      engine: numpy_engine.Engine, with its inv_vocab
+      version: model version, part of the cache keys
+      cache: PredictionCache, or None to always run the engine
+    """
+    self.engine = engine
+    self.version = version
+    self.cache = cache
+    h = engine.hparams
+    self.batch_size = batch_size or h["batch_size"]
+    self.max_arg_len = h["max_arg_len"]
+    self.vocab = {w: i for i, w in enumerate(engine.inv_vocab)}
+    self.unk = self.vocab[h["unknown_tag"]]
+    self.pad = self.vocab[h["pad_tag"]]
+    self.bos = self.vocab[h["bos_tag"]] if h["bos_tag"] else None
+
+  @classmethod
+  def from_dir(cls, model_dir, max_entries=100000, cache_path=None):
+    """ Classifier of an exported model directory, see export.py """
+    return cls(Engine.from_dir(model_dir), model_version(model_dir),
+               PredictionCache(max_entries, cache_path))
+
+  def token_ids(self, arg1, arg2):
+    """ Token ids of the encoder and decoder inputs, as get_data. Words
+    outside the vocab are dropped, as load_from_file drops them """
+    arg1 = [self.vocab[w] for w in clean_str(arg1) if w in self.vocab]
+    arg2 = [self.vocab[w] for w in clean_str(arg2) if w in self.vocab]
+    if self.bos is not None:
+      arg2.insert(0, self.bos)
+    # An empty argument is read as an unknown word, the model needs a step
+    return arg1[:self.max_arg_len] or [self.unk], \
+           arg2[:self.max_arg_len] or [self.unk]
+
+  def run_engine(self, ids):
+    """ Probabilities of [(arg1 ids, arg2 ids)] """
+    probs = []
+    for start in range(0, len(ids), self.batch_size):
+      batch = ids[start:start + self.batch_size]
+      enc_len = np.array([len(a1) for a1, _ in batch])
+      dec_len = np.array([len(a2) for _, a2 in batch])
+      enc_input = np.full((len(batch), enc_len.max()), self.pad, np.int32)
+      dec_input = np.full((len(batch), dec_len.max()), self.pad, np.int32)
+      for i, (a1, a2) in enumerate(batch):
+        enc_input[i, :len(a1)] = a1
+        dec_input[i, :len(a2)] = a2
+      probs.append(softmax(self.engine.logits(enc_input, enc_len, dec_input,
+                                              dec_len), axis=1))
+    return np.concatenate(probs).astype(np.float32)
+
+  def probabilities(self, relations):
+    """ Class probabilities [len(relations), num_classes]
+    Args:
+      relations: list of (arg1 text, arg2 text)
+    """
+    ids = [self.token_ids(arg1, arg2) for arg1, arg2 in relations]
+    if self.cache is None:
+      return self.run_engine(ids)
+
+    keys = [relation_key(a1, a2, self.version) for a1, a2 in ids]
+    results = [self.cache.get(k) for k in keys]
+    # Each distinct missing relation runs once
+    missing = OrderedDict()
+    for i, probs in enumerate(results):
+      if probs is None:
+        missing.setdefault(keys[i], ids[i])
+    if len(missing) > 0:
+      computed = dict(zip(missing, self.run_engine(list(missing.values()))))
+      self.cache.put_many(computed.items())
+      results = [computed[k] if probs is None else probs \
+                 for k, probs in zip(keys, results)]
+    return np.stack(results)
+
+  def predict(self, relations):
+    """ Class index of each relation """
+    return np.argmax(self.probabilities(relations), axis=1)
+
+  def predict_json(self, discourse):
+    """ Class index of CoNLL json relations, dicts with Arg1 and Arg2 """
+    return self.predict([(d['Arg1']['RawText'], d['Arg2']['RawText']) \
+                         for d in discourse])
@@ -0,0 +1,119 @@
+"""
+Small classifier to distill a trained EncDecClass, see distill.py
+
+The student takes the same inputs as EncDecClass, so it is fed and evaluated
+by the functions of training.py. Both arguments are encoded by the same
+layers, then classified from [arg1, arg2, arg1 * arg2, |arg1 - arg2|]
+"""
+import tensorflow as tf
+
+from pydoc import locate
+from utils import dense
+
+class Student():
+  """ Convolution or mean of embeddings classifier, trained on soft labels """
+  def __init__(self, hparams, embedding, emb_dim):
+    """
+    Args:
+      hparams: hyper param instance, with the student values of
+        settings["distill"]
+      embedding : embedding matrix as numpy array
+      emb_dim : size of an embedding
+    """
+    self.hparams = hparams
+    self.model_type = "classification"
+    self.floatX = tf.float32
+    self.intX = tf.int32
+    self.sync_optimizer = None
+
+    self.global_step = tf.Variable(0, name='global_step', trainable=False)
+    self.l_rate = tf.Variable(hparams.l_rate, name='l_rate', trainable=False,
+                              dtype=tf.float32)
+    self.new_l_rate = tf.placeholder(tf.float32, shape=[], name="new_l_rate")
+    self.l_rate_update = tf.assign(self.l_rate, self.new_l_rate)
+
+    ############################
+    # Inputs, as EncDecClass
+    ############################
+    self.keep_prob = tf.placeholder(self.floatX)
+    self.mode = tf.placeholder(tf.bool, name="mode")
+    self.embedding_init = tf.placeholder(tf.float32, shape=embedding.shape,
+                                         name="embedding_init")
+    self.init_feed = {self.embedding_init: embedding}
+    self.embedding_tensor = tf.get_variable(name="embedding_matrix",
+                                   initializer=self.embedding_init,
+                                   trainable=hparams.emb_trainable == True)
+    self.enc_input = tf.placeholder(self.intX, shape=[None, None])
+    self.enc_input_len = tf.placeholder(self.intX, shape=[None,])
+    self.dec_input = tf.placeholder(self.intX, shape=[None, None])
+    self.dec_input_len = tf.placeholder(self.intX, shape=[None,])
+    self.dec_targets = tf.placeholder(self.intX, shape=[None, None]) # unused
+    # Class probabilities, one-hot for gold labels or soft from a teacher
+    self.classes = tf.placeholder(self.floatX,
+                                  shape=[None, hparams.num_classes])
+    self.batch_size = tf.shape(self.enc_input)[0]
+
+    ############################
+    # Build Model
+    ############################
+    with tf.variable_scope("student"):
+      arg1 = self.encode(self.enc_input, self.enc_input_len)
+      arg2 = self.encode(self.dec_input, self.dec_input_len)
+      x = tf.concat([arg1, arg2, arg1 * arg2, tf.abs(arg1 - arg2)], 1)
+      x = tf.nn.dropout(x, self.keep_prob)
+      in_dim = x.get_shape().as_list()[1]
+      x = dense(x, in_dim, hparams.student_units, act=tf.nn.relu,
+                scope="hidden")
+      x = tf.nn.dropout(x, self.keep_prob)
+      self.class_logits = dense(x, hparams.student_units, hparams.num_classes,
+                                scope="class_softmax")
+
+    # Soft cross entropy at the distillation temperature, scaled by T^2 so
+    # the gradients keep their size when the temperature changes
+    t = hparams.temperature
+    self.loss = tf.nn.softmax_cross_entropy_with_logits_v2(
+        labels=self.classes, logits=self.class_logits / t) * t**2
+    self.cost = tf.reduce_mean(self.loss)
+    tf.summary.scalar("class_cost", self.cost)
+
+    self.y_pred = tf.argmax(self.class_logits, axis=1)
+    self.y_true = tf.argmax(self.classes, axis=1)
+
+    self.optimize = self.optimize_step(self.cost, self.global_step)
+    self.merged_summary_ops = tf.summary.merge_all()
+
+  def encode(self, word_ids, seq_len):
+    """ Fixed size vector of an argument, [batch_size, units] """
+    with tf.variable_scope("argument", reuse=tf.AUTO_REUSE):
+      with tf.device("/cpu:0"):
+        x = tf.nn.embedding_lookup(self.embedding_tensor, word_ids)
+      mask = tf.sequence_mask(seq_len, tf.shape(word_ids)[1], dtype=self.floatX)
+      mask = tf.expand_dims(mask, -1)
+      if self.hparams.student_type == "mean":
+        length = tf.maximum(tf.reduce_sum(mask, 1), 1.)
+        return tf.reduce_sum(x * mask, 1) / length
+      elif self.hparams.student_type == "cnn":
+        x = tf.layers.conv1d(x, self.hparams.student_filters,
+                             self.hparams.student_kernel, padding='same',
+                             activation=tf.nn.relu, name="conv")
+        # Max over the steps of the argument only, relu outputs are >= 0
+        return tf.reduce_max(x * mask, 1)
+      raise ValueError("Invalid student_type: " + self.hparams.student_type)
+
+  def optimize_step(self, loss, glbl_step):
+    """ Locate optimizer from hparams, take a step """
+    Opt = locate("tensorflow.train." + self.hparams.optimizer)
+    if Opt is None:
+      raise ValueError("Invalid optimizer: " + self.hparams.optimizer)
+    optimizer = Opt(self.l_rate)
+    grads_vars = optimizer.compute_gradients(loss)
+    capped_grads = [(None if grad is None else \
+                      tf.clip_by_value(grad, -1., 1.), var)\
+                                                  for grad, var in grads_vars]
+    return optimizer.apply_gradients(capped_grads, global_step=glbl_step)
+
+  def decay_l_rate(self, sess, factor, min_l_rate=0.):
+    """ Multiply the learning rate by factor, returns the new learning rate """
+    l_rate = max(sess.run(self.l_rate) * factor, min_l_rate)
+    sess.run(self.l_rate_update, feed_dict={self.new_l_rate: l_rate})
+    return l_rate
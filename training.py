@@ -1,8 +1,13 @@
 import tensorflow as tf
-from helper import make_batches, MiniData
-from utils import Progress, Metrics, Callback
+from helper import make_batches, epoch_rng, MiniData
+from utils import Progress, Metrics, Callback, StepMonitor, session_config, \
+                  step_stats
+from cache import EncoderCache, encoder_feed
+from profiling import stage
 import numpy as np
 import sys
+import os
+import time
 from pprint import pprint
 from sklearn.metrics import f1_score, accuracy_score
 from six.moves import cPickle as pickle
@@ -10,24 +15,59 @@ from six.moves import cPickle as pickle
 ###############################################################################
 # Training/Testing functions
 ###############################################################################
+def feed_dict(model, batch, keep_prob, mode):
+  """ Feed dictionary of a batch for the model placeholders. Sequences are
+  trimmed to the longest of the batch, the steps past it are only padding
+  """
+  enc_len = batch.seq_len_encoder
+  dec_len = batch.seq_len_decoder
+  feed = {
+           model.enc_input       : batch.encoder_input[:, :max(enc_len)],
+           model.enc_input_len   : enc_len,
+           model.dec_targets     : batch.decoder_target[:, :max(dec_len)],
+           model.dec_input       : batch.decoder_input[:, :max(dec_len)],
+           model.dec_input_len   : dec_len,
+           model.keep_prob       : keep_prob,
+           model.mode            : mode # 1 for train, 0 for testing
+         }
+  # Multi-head models have a class placeholder per head
+  if type(model.classes) is list:
+    feed.update(zip(model.classes, batch.classes))
+  else:
+    feed[model.classes] = batch.classes
+  return feed
+
 def call_model(sess, model, data, fetch, batch_size, num_batches, keep_prob,
-              shuffle, mode):
-  """ Calls models and yields results per batch """
-  batches = make_batches(data, batch_size, num_batches, shuffle=shuffle)
+              shuffle, mode, shard_index=0, num_shards=1, bucket=False,
+              cache=None, stats=None, rng=None):
+  """ Calls models and yields results per batch
+  Args:
+    rng: RandomState of the shuffles, see make_batches
+    cache: if given, an EncoderCache. The encoder outputs are fed from it,
+      see cache.encoder_feed. Only for a frozen encoder
+    stats: if given, a StepStats recording the time to build each batch and
+      its feed, and the time in sess.run
+  """
+  batches = make_batches(data, batch_size, num_batches, shuffle=shuffle,
+                         shard_index=shard_index, num_shards=num_shards,
+                         bucket=bucket, rng=rng)
+  start = time.perf_counter()
   for batch in batches:
-    feed = {
-             model.enc_input       : batch.encoder_input,
-             model.enc_input_len   : batch.seq_len_encoder,
-             model.classes         : batch.classes,
-             model.dec_targets     : batch.decoder_target,
-             model.dec_input       : batch.decoder_input,
-             model.dec_input_len   : batch.seq_len_decoder,
-             model.keep_prob       : keep_prob,
-             model.mode            : mode # 1 for train, 0 for testing
-           }
-
-    result = sess.run(fetch,feed)
+    feed = feed_dict(model, batch, keep_prob, mode)
+    if cache is not None:
+      feed.update(encoder_feed(sess, model, batch, cache,
+                               name=data.short_name))
+    if stats is None:
+      yield sess.run(fetch,feed)
+      continue
+    options, run_metadata = stats.run_options()
+    run_start = time.perf_counter()
+    result = sess.run(fetch, feed, options=options, run_metadata=run_metadata)
+    end = time.perf_counter()
+    stats.record(batch, run_start - start, end - run_start, run_metadata)
     yield result
+    # The consumer time is not part of the next step
+    start = time.perf_counter()
 
 def generate_text(sess, model, data, index, vocab, inv_vocab):
   """
@@ -39,6 +79,7 @@ def generate_text(sess, model, data, index, vocab, inv_vocab):
   feed = {
            model.enc_input       : sample.encoder_input,
            model.enc_input_len   : sample.seq_len_encoder,
+           model.classes         : sample.classes,
            model.dec_targets     : sample.decoder_target,
            model.dec_input       : sample.decoder_input,
            model.dec_input_len   : sample.seq_len_decoder,
@@ -57,15 +98,34 @@ def generate_text(sess, model, data, index, vocab, inv_vocab):
   return relation, encoded, decoded, target
 
 def train_one_epoch(sess, data, model, keep_prob, batch_size, num_batches,
-                    prog, writer=None):
-  """ Train 'model' using 'data' for a single epoch """
+                    prog, writer=None, step_hook=None, shard_index=0,
+                    num_shards=1, bucket=False, cache=None, stats=None,
+                    rng=None):
+  """ Train 'model' using 'data' for a single epoch
+  Args:
+    step_hook: if given, called with the global step after each batch. If it
+      returns True, the epoch is interrupted
+    shard_index, num_shards: train only on this shard of the data
+    rng: RandomState of the shuffles, the same on all shards, see epoch_rng
+    bucket: batch samples of similar length, see make_batches
+    cache: EncoderCache for a frozen encoder, see call_model
+    stats: StepStats for step throughput and traces, see call_model
+  Returns:
+    True if the epoch was interrupted by step_hook
+  """
   fetch = [model.optimize, model.cost, model.global_step]
 
   if writer is not None:
     fetch.append(model.merged_summary_ops)
 
+  # Steps are counted from the global step, other workers may increment it
+  if stats is not None:
+    stats.step = int(sess.run(model.global_step))
+
   batch_results = call_model(sess, model, data, fetch, batch_size, num_batches,
-                             keep_prob, shuffle=True, mode=1)
+                             keep_prob, shuffle=True, mode=1,
+                             shard_index=shard_index, num_shards=num_shards,
+                             bucket=bucket, cache=cache, stats=stats, rng=rng)
   for result in batch_results:
     loss = result[1]
     global_step = result[2]
@@ -73,13 +133,17 @@ def train_one_epoch(sess, data, model, keep_prob, batch_size, num_batches,
     if writer is not None and global_step % 10 == 0:
       summary = result[-1]
       writer.add_summary(summary, global_step)
-    # break
+    if step_hook is not None and step_hook(global_step) == True:
+      return True
+  return False
 
-def classification_f1(sess, data, model, batch_size, num_batches_test, save_align):
+def classification_f1(sess, data, model, batch_size, num_batches_test, save_align,
+                      cache=None):
   """
   Get the total loss for the entire batch
   Args:
     save_align: if true, will save alignment history to disk, from hparams
+    cache: EncoderCache for a frozen encoder, see call_model
   """
   fetch = [model.batch_size, model.cost, model.y_pred, model.y_true]
 
@@ -92,7 +156,8 @@ def classification_f1(sess, data, model, batch_size, num_batches_test, save_alig
   y_pred = np.zeros(data.size())
   y_true = np.zeros(data.size())
   batch_results = call_model(sess, model, data, fetch, batch_size,
-               num_batches_test, keep_prob=1, shuffle=False, mode=0)
+               num_batches_test, keep_prob=1, shuffle=False, mode=0,
+               cache=cache)
   start_id = 0
   for i, result in enumerate(batch_results):
     batch_size                           = result[0]
@@ -107,25 +172,50 @@ def classification_f1(sess, data, model, batch_size, num_batches_test, save_alig
       al_ls = alignment(enc_in, dec_in, align, data_class.inv_vocab)
       alignment_ls.extend(al_ls)
 
-  # Metrics
+  f1_micro, acc = class_scores(y_true, y_pred, data.sense_to_one_hot)
+  # f1_conll = data_class.conll_f1_score(y_pred, data.orig_disc, data.path_source)
+  f1_conll =f1_micro
+  return f1_micro, f1_conll, acc, alignment_ls
+
+def class_scores(y_true, y_pred, sense_to_one_hot):
+  """ f1 and accuracy of integer labels """
   # f1 score depending on number of classes
-  if data.num_classes == 2:
+  if len(sense_to_one_hot) == 2:
     # If only 2 classes, then one is positive, and average is binary
-    pos_label = np.argmax(data.sense_to_one_hot['positive'])
-    average = 'binary'
+    pos_label = np.argmax(sense_to_one_hot['positive'])
     f1_micro = f1_score(y_true, y_pred, pos_label=pos_label, average='binary')
   else:
     # If multiclass, no positive labels
     f1_micro = f1_score(y_true, y_pred, average='micro')
-
   acc = accuracy_score(y_true, y_pred)
-  # f1_conll = data_class.conll_f1_score(y_pred, data.orig_disc, data.path_source)
-  f1_conll =f1_micro
-  return f1_micro, f1_conll, acc, alignment_ls
+  return f1_micro, acc
+
+def multi_class_f1(sess, data, model, batch_size, num_batches_test,
+                   cache=None):
+  """ f1 and accuracy of each head of a multi-head model, lists in head order
+  """
+  fetch = [model.batch_size, model.y_pred, model.y_true]
+  y_pred = np.zeros((model.num_heads, data.size()))
+  y_true = np.zeros((model.num_heads, data.size()))
+  batch_results = call_model(sess, model, data, fetch, batch_size,
+               num_batches_test, keep_prob=1, shuffle=False, mode=0,
+               cache=cache)
+  start_id = 0
+  for result in batch_results:
+    batch_size = result[0]
+    y_pred[:, start_id:start_id+batch_size] = result[1]
+    y_true[:, start_id:start_id+batch_size] = result[2]
+    start_id += batch_size
+
+  scores = [class_scores(y_true[i], y_pred[i], data.sense_to_one_hot[i]) \
+            for i in range(model.num_heads)]
+  f1s, accs = zip(*scores)
+  return list(f1s), list(accs)
 
 def test_set_decoder_loss(sess, data, model, batch_size, num_batches):
-  """ Get the total loss for the entire batch """
-  fetch = [model.batch_size, model.cost]
+  """ Get the total loss for the entire batch, exact if the model trains on
+  an approximate loss """
+  fetch = [model.batch_size, model.eval_cost]
   losses = np.zeros(num_batches) # to average the losses
   batch_w = np.zeros(num_batches) # batch weight
   batch_results = call_model(sess, model, data, fetch, batch_size, num_batches,
@@ -134,57 +224,50 @@ def test_set_decoder_loss(sess, data, model, batch_size, num_batches):
     # Keep track of losses to average later
     cur_b_size = result[0]
     losses[i] = result[1]
-    batch_w[i] = cur_b_size / len(x_test_enc)
+    batch_w[i] = cur_b_size / data.size()
 
   # Average across batches
   av = np.average(losses, weights=batch_w)
   return av
 
-def language_model_class_loss():
+def language_model_class_loss(sess, model, data, batch_size, num_batches,
+                               cache=None, version=0):
   """ Try all label conditioning for eval dataset
-  For each sample, get the perplexity when conditioning on all classes and set
-  the label with argmin. Check accuracy and f1 score of classification
+  For each sample, get the loss of Arg2 when conditioning on all classes and
+  set the label with argmin. Needs a class conditioned EncDecGen. Arg1 is
+  encoded once per sample, or taken from cache, and fed for every class
+  Returns:
+    f1 and accuracy of the classification
   """
-  # To average the losses
-  log_prob = np.zeros((len(classes_test), data_class.num_classes), dtype=np.float32)
-  for k, v in data_class.sense_to_one_hot.items(): # loop over all classes
-    class_id = np.argmax(v)
-    classes = np.array([v])
-    classes = np.repeat(classes, len(classes_test), axis=0)
-    assert classes_test.shape == classes.shape
-
-    data = [x_test_enc, x_test_dec, classes, enc_len_test,
-          dec_len_test, dec_test]
-    fetch = [model.batch_size, model.generator_loss, model.softmax_logits,
-              model.dec_targets]
-    batch_results = call_model(sess, model, data, fetch, batch_size,
-                 num_batches_test, keep_prob=1, shuffle=False, mode_train=False)
-    j = 0
-    for result in batch_results:
-      cur_b_size = result[0]
-      # loss = result[1]
-
-      # Get the probability of the words we want
-      targets = result[3]
-      probs = result[2] # [batch_size, time step, vocab_size]
-      targets = targets[:,0:probs.shape[1]] # ignore zero pads
-      I,J=np.ix_(np.arange(probs.shape[0]),np.arange(probs.shape[1]))
-      prob_vocab = probs[I,J,targets]
-      # Get the sum log across all words per sample
-      sum_log_prob = np.sum(np.log(prob_vocab), axis=1) # [batch_size,]
-      # Assign the sum log prob to the correct class column
-      log_prob[j:j+cur_b_size, class_id] = sum_log_prob
-      j += cur_b_size
-
-  predictions = np.argmax(log_prob, axis=1) # get index of most probable
-  gold = np.argmax(classes_test, axis=1) # get index of one hot class
-  correct = predictions == gold # compare how many match
-  accuracy = np.sum(correct)/len(correct)
-  prog.print_class_eval(accuracy)
+  # Classes in the order of their one-hot index
+  one_hots = sorted(data.sense_to_one_hot.values(), key=np.argmax)
+  loss = np.zeros((data.size(), len(one_hots)), dtype=np.float32)
+  start_id = 0
+  for batch in make_batches(data, batch_size, num_batches, shuffle=False):
+    feed = feed_dict(model, batch, 1, 0)
+    feed.update(encoder_feed(sess, model, batch, cache, version,
+                             data.short_name))
+    size = len(batch.seq_len_encoder)
+    for class_id, one_hot in enumerate(one_hots):
+      feed[model.classes] = np.repeat([one_hot], size, axis=0)
+      loss[start_id:start_id+size, class_id] = sess.run(model.eval_loss, feed)
+    start_id += size
+
+  y_pred = np.argmin(loss, axis=1) # most probable Arg2
+  y_true = np.argmax(data.classes, axis=1)
+  return class_scores(y_true, y_pred, data.sense_to_one_hot)
 
 current_trial = 0
 # Launch training
-def train(params, settings, Model, embedding, emb_dim, dataset_dict, vocab, inv_vocab):
+def train(params, settings, Model, embedding, emb_dim, dataset_dict, vocab,
+          inv_vocab, config=None, epoch_hook=None):
+  """ Train a single trial
+  Args:
+    config: tf.ConfigProto for the session, default from settings["session"]
+    epoch_hook: optional, see train_classification
+  Returns:
+    Metrics object for classification, None for generation
+  """
   global hparams
   hparams=params
   global current_trial
@@ -196,7 +279,7 @@ def train(params, settings, Model, embedding, emb_dim, dataset_dict, vocab, inv_
   train_set = dataset_dict['training_set']
   val_set = dataset_dict['validation_set']
   prog = Progress(batches=train_set.num_batches(hparams.batch_size), progress_bar=True,
-                  bar_length=10)
+                  bar_length=10, batch_size=hparams.batch_size)
 
   # Print some info
   pprint(hparams)
@@ -208,9 +291,13 @@ def train(params, settings, Model, embedding, emb_dim, dataset_dict, vocab, inv_
   # pickle.dump(trials, open("trials.p","wb"))
 
   # Declare model with hyperhparams
-  with tf.Graph().as_default(), tf.Session() as sess:
+  met = None
+  if config is None:
+    config = session_config(settings)
+  with tf.Graph().as_default(), tf.Session(config=config) as sess:
     tf.set_random_seed(1)
-    model = Model(hparams, embedding, emb_dim)
+    with stage("build_graph"):
+      model = Model(hparams, embedding, emb_dim)
 
     # Save info for tensorboard
     if settings['tensorboard_write'] == True:
@@ -218,16 +305,34 @@ def train(params, settings, Model, embedding, emb_dim, dataset_dict, vocab, inv_
     else:
       writer = None
 
+    stats = step_stats(settings, writer)
+
     # Initialize variables
-    tf.global_variables_initializer().run()
+    with stage("initialize"):
+      sess.run(tf.global_variables_initializer(), model.init_feed)
+
+    # Save model when the full validation improves
+    checkpoint = None
+    if settings['checkpoint_dir'] is not None:
+      if not os.path.exists(settings['checkpoint_dir']):
+        os.makedirs(settings['checkpoint_dir'])
+      saver = tf.train.Saver(max_to_keep=1)
+      ckpt_path = os.path.join(settings['checkpoint_dir'], 'model.ckpt')
+      checkpoint = lambda: saver.save(sess, ckpt_path, global_step=model.global_step)
 
     # trask specific training
     if model.model_type == "generative":
-      train_generative(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab)
+      train_generative(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab,
+                       stats)
     if model.model_type == "classification":
-      train_classification(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab)
-
-def train_generative(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab):
+      met = train_classification(sess, hparams, prog, model,dataset_dict, vocab,
+                                 inv_vocab, checkpoint, epoch_hook, stats=stats)
+    if stats is not None:
+      stats.close()
+  return met
+
+def train_generative(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab,
+                     stats=None):
   train_set = dataset_dict['training_set']
   val_set = dataset_dict['validation_set']
   met = Metrics(monitor="loss")
@@ -242,8 +347,10 @@ def train_generative(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab):
     prog.epoch_start()
 
     # Training set
-    train_one_epoch(sess, train_set, model, hparams.keep_prob,
-                hparams.batch_size, train_set.num_batches(hparams.batch_size), prog)
+    with stage("train_epoch"):
+      train_one_epoch(sess, train_set, model, hparams.keep_prob,
+                  hparams.batch_size, train_set.num_batches(hparams.batch_size),
+                  prog, bucket=hparams.bucket, stats=stats)
 
     # Test an output! See how it evolves!
     _, _, decoded, _ = generate_text(sess, model, val_set, 9, vocab, inv_vocab)
@@ -275,29 +382,85 @@ def train_generative(sess, hparams, prog, model,dataset_dict, vocab, inv_vocab):
   pass
 
 def train_classification(sess, hparams, prog, model, dataset_dict, vocab,
-                                                                    inv_vocab):
+                                inv_vocab, checkpoint=None, epoch_hook=None,
+                                shard_index=0, num_shards=1, stats=None):
+  """
+  Args:
+    checkpoint: if given, called without arguments when the full validation
+      pass improves
+    epoch_hook: if given, called with (epoch, Metrics) after each epoch. If it
+      returns True, training stops
+    shard_index, num_shards: train only on this shard of the training set
+    stats: StepStats of the training steps, see train_one_epoch
+  """
   train_set = dataset_dict['training_set']
   val_set = dataset_dict['validation_set']
   met = Metrics(monitor="val_f1")
   cb = Callback(hparams.early_stop_epoch, met, prog)
   align = False
 
+  # Encoder outputs do not change if the encoder is frozen, keep them
+  cache = None
+  if hparams.freeze_encoder == True and hparams.encoder_cache_mb is not None:
+    cache = EncoderCache(hparams.encoder_cache_mb * 2**20)
+
+  def evaluate(data, align):
+    """ f1, accuracy, f1 per head {name: f1} and alignments. The f1 and
+    accuracy of a multi-head model are averaged over its heads """
+    num_batches = data.num_batches(hparams.batch_size)
+    with stage("eval_" + data.short_name):
+      if type(model.classes) is list:
+        f1s, accs = multi_class_f1(sess, data, model, hparams.batch_size,
+                                   num_batches, cache)
+        names = hparams.head_names or [str(i) for i in range(len(f1s))]
+        return np.mean(f1s), np.mean(accs), dict(zip(names, f1s)), []
+      _, f1, accuracy, alignment = classification_f1(sess, data, model,
+                              hparams.batch_size, num_batches, align, cache)
+    return f1, accuracy, {}, alignment
+
+  def update(data, f1, accuracy, head_f1):
+    met.update(data.short_name + '_f1', f1)
+    met.update(data.short_name + '_acc', accuracy)
+    for name, score in head_f1.items():
+      met.update('{}_f1_{}'.format(data.short_name, name), score)
+      prog.print_eval(name, score)
+    prog.print_eval('acc', accuracy)
+    prog.print_eval('f1', f1)
+
+  # Optional intra-epoch evaluation on a fixed validation subsample
+  step_hook = None
+  if hparams.eval_every_steps is not None:
+    val_sub = val_set.subsample(hparams.eval_subsample)
+    mon = StepMonitor(hparams.eval_every_steps, hparams.early_stop_steps,
+                      prog, plateau_patience=hparams.lr_plateau_evals)
+    def decay():
+      l_rate = model.decay_l_rate(sess, hparams.lr_decay, hparams.min_l_rate)
+      prog.print_cust('\nValidation plateau, learning rate: {:.2e}\n'.format(l_rate))
+    mon.add_plateau_hook(decay)
+
+    def step_hook(step):
+      if not mon.due(step): return False
+      f1, _, _, _ = evaluate(val_sub, False)
+      mon.update(step, f1)
+      return mon.early_stop(step)
+
   for epoch in range(hparams.nb_epochs):
     prog.epoch_start()
 
-    # Training set
-    train_one_epoch(sess, train_set, model, hparams.keep_prob,
-          hparams.batch_size, train_set.num_batches(hparams.batch_size), prog)
+    # Training set, may stop early within the epoch
+    with stage("train_epoch"):
+      stop = train_one_epoch(sess, train_set, model, hparams.keep_prob,
+            hparams.batch_size, train_set.num_batches(hparams.batch_size,
+            num_shards), prog, step_hook=step_hook, shard_index=shard_index,
+            num_shards=num_shards, bucket=hparams.bucket, cache=cache,
+            stats=stats, rng=epoch_rng(epoch) if num_shards > 1 else None)
 
-    # Validation Set
+    # Validation Set, full pass at each checkpoint
     prog.print_cust('|| {} '.format(val_set.short_name))
-    _, f1, accuracy, alignment = classification_f1(
-        sess, val_set, model, hparams.batch_size,
-        val_set.num_batches(hparams.batch_size), align)
-    met.update(val_set.short_name + '_f1', f1)
-    met.update(val_set.short_name + '_acc', accuracy)
-    prog.print_eval('acc', accuracy)
-    prog.print_eval('f1', f1)
+    f1, accuracy, head_f1, alignment = evaluate(val_set, align)
+    update(val_set, f1, accuracy, head_f1)
+    if checkpoint is not None and met.improved:
+      checkpoint()
 
     # Previous best f1 on test -> for alignment
     prev_best = met.metric_dict["test_f1"]
@@ -308,13 +471,8 @@ def train_classification(sess, hparams, prog, model, dataset_dict, vocab,
 
       # Other sets
       prog.print_cust('|| {} '.format(dataset.short_name))
-      _, f1, accuracy, alignment = classification_f1(
-          sess, dataset, model, hparams.batch_size,
-          dataset.num_batches(hparams.batch_size), align)
-      met.update(dataset.short_name + '_f1', f1)
-      met.update(dataset.short_name + '_acc', accuracy)
-      prog.print_eval('acc', accuracy)
-      prog.print_eval('f1', f1)
+      f1, accuracy, head_f1, alignment = evaluate(dataset, align)
+      update(dataset, f1, accuracy, head_f1)
 
       # if test set better, save alignment
       if align == True and k == "test_set":
@@ -323,6 +481,7 @@ def train_classification(sess, hparams, prog, model, dataset_dict, vocab,
           pickle.dump(alignment, open("tmp.p", "wb"))
           print("dumped test alignments to tmp.p file")
 
-    if cb.early_stop() == True: break
+    if stop == True or cb.early_stop() == True: break
+    if epoch_hook is not None and epoch_hook(epoch, met) == True: break
     prog.epoch_end()
-
+  return met
@@ -1,51 +1,91 @@
-from datetime import datetime
+from collections import deque
+import sys
 import pprint
+import json
+import time
+import os
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.layers import xavier_initializer as glorot
+from tensorflow.python.client import timeline
 from sklearn.utils import shuffle as group_shuffle
 
 class Progress():
-  """ Pretty print progress for neural net training """
-  def __init__(self, batches, progress_bar=True, bar_length=30):
+  """ Pretty print progress for neural net training. On a terminal the status
+  line is redrawn at most refresh_per_sec times per second. Otherwise, such as
+  when redirected to a log file, a line is printed every log_every_sec """
+  def __init__(self, batches, progress_bar=True, bar_length=30, batch_size=None,
+               refresh_per_sec=4, log_every_sec=30, stream=None):
+    """
+    Args:
+      batches : batches per epoch
+      batch_size : if given, throughput is also shown in examples per second
+      stream : output file, default stdout
+    """
     self.progress_bar = progress_bar # boolean
     self.bar_length = bar_length
-    self.t1 = datetime.now()
+    self.batch_size = batch_size
+    self.stream = stream or sys.stdout
+    self.tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+    self.interval = 1. / refresh_per_sec if self.tty else log_every_sec
+    self.t1 = time.perf_counter()
     self.train_start_time = self.t1
+    self.last_render = -np.inf
     self.batches = batches
     self.current_batch = 0
+    self.loss_sum = 0.
     self.epoch = 0
 
   def epoch_start(self):
-    self.t1 = datetime.now()
+    self.t1 = time.perf_counter()
+    self.last_render = -np.inf if self.tty else self.t1
     self.epoch += 1
     self.current_batch = 0 # reset batch
+    self.loss_sum = 0.
 
   def epoch_end(self):
-    print()
+    print(file=self.stream)
 
   def print_train(self, loss):
-    t2 = datetime.now()
-    epoch_time = (t2 - self.t1).total_seconds()
-    total_time = (t2 - self.train_start_time).total_seconds()/60
-    print('{:2.0f}: sec: {:>5.1f} | total min: {:>5.1f} | train loss: {:>3.4f} '.format(
-        self.epoch, epoch_time, total_time, loss), end='')
-    self.print_bar()
+    """ Record the loss of a batch, the status is printed if due """
+    self.current_batch += 1
+    self.loss_sum += loss
+    now = time.perf_counter()
+    last = self.current_batch == self.batches
+    if not last and now - self.last_render < self.interval:
+      return
+    self.last_render = now
+    epoch_time = now - self.t1
+    total_time = (now - self.train_start_time)/60
+    rate = self.current_batch / max(epoch_time, 1e-9)
+    eta = max(self.batches - self.current_batch, 0) / rate
+    throughput = '{:>6.1f} b/s'.format(rate)
+    if self.batch_size is not None:
+      throughput = '{:>7.0f} ex/s'.format(rate * self.batch_size)
+    line = '{:2.0f}: sec: {:>5.1f} | total min: {:>5.1f} | train loss: ' \
+           '{:>3.4f} | {} | eta: {:>5.0f}s '.format(self.epoch, epoch_time,
+           total_time, self.loss_sum / self.current_batch, throughput, eta)
+    # The last batch of an epoch stays on its line, evaluations follow it
+    if self.tty:
+      print('\r' + line + self.bar(), end='', file=self.stream, flush=True)
+    else:
+      line += '| batch {}/{} '.format(self.current_batch, self.batches)
+      print(line, end='' if last else '\n', file=self.stream, flush=True)
 
   def print_cust(self, msg):
     """ Print anything, append previous """
-    print(msg, end='')
+    print(msg, end='', file=self.stream)
 
   def print_eval(self, msg, value):
-    print('| {}: {:>3.4f} '.format(msg, value), end='')
+    print('| {}: {:>3.4f} '.format(msg, value), end='', file=self.stream)
 
-  def print_bar(self):
-    self.current_batch += 1
-    end = '' if self.current_batch == self.batches else '\r'
-    bars_full = int(self.current_batch/self.batches*self.bar_length)
+  def bar(self):
+    if not self.progress_bar:
+      return ''
+    bars_full = int(min(self.current_batch/self.batches, 1)*self.bar_length)
     bars_empty = self.bar_length - bars_full
-    print("| [{}{}] ".format(u"\u2586"*bars_full, '-'*bars_empty),end=end)
+    return "| [{}{}] ".format(u"\u2586"*bars_full, '-'*bars_empty)
 
 def make_batches_legacy(data, batch_size, num_batches,shuffle=True):
   """ Batches the passed data
@@ -106,6 +146,11 @@ class Metrics():
     """ Get the dictionary of metrics """
     return self._metric_dict
 
+  @property
+  def improved(self):
+    """ True if the last monitored update was the best so far """
+    return self.epoch_current > 0 and self.epoch_current == self.epoch_best
+
 class Callback():
   """ Monitor training """
   def __init__(self, early_stop_epoch, metrics, prog_bar):
@@ -132,6 +177,150 @@ class Callback():
     else:
       return False
 
+class StepMonitor():
+  """ Monitor a metric every few training steps, within an epoch """
+  def __init__(self, eval_every, patience, prog_bar, plateau_patience=None):
+    """
+    Args:
+      eval_every : evaluate every this many steps
+      patience : stop if not improved for these steps, None to never stop
+      plateau_patience : evaluations without improvement before calling the
+        plateau hooks, None to never call them
+    """
+    self.eval_every = eval_every
+    self.patience = patience
+    self.plateau_patience = plateau_patience
+    self.prog = prog_bar
+    self.metric_best = 0
+    self.step_best = 0
+    self.last_eval_step = 0
+    self.plateau_count = 0
+    self._plateau_hooks = []
+
+  def add_plateau_hook(self, hook):
+    """ hook is called without arguments when the metric plateaus """
+    self._plateau_hooks.append(hook)
+
+  def due(self, step):
+    """ Check if the metric should be evaluated at this step. The global
+    step can advance by more than one between calls, with several workers
+    """
+    return step - self.last_eval_step >= self.eval_every
+
+  def update(self, step, value):
+    """ Record metric at step, returns True if best so far """
+    self.last_eval_step = step
+    if value >= self.metric_best:
+      self.metric_best = value
+      self.step_best = step
+      self.plateau_count = 0
+      return True
+
+    self.plateau_count += 1
+    if self.plateau_patience is not None and \
+                                  self.plateau_count >= self.plateau_patience:
+      self.plateau_count = 0
+      for hook in self._plateau_hooks:
+        hook()
+    return False
+
+  def early_stop(self, step):
+    """ Check if metric has not improved for patience steps """
+    if self.patience is None:
+      return False
+    if step - self.step_best >= self.patience:
+      self.prog.print_cust("\nEarly stopping at step {}".format(step))
+      return True
+    return False
+
+class StepStats():
+  """ Throughput and latency of training steps, see training.call_model.
+  Aggregates over the last window steps are written every few steps to a
+  json lines log and to TensorBoard. Chosen steps can be run with a full
+  trace, saved as Chrome timelines (chrome://tracing) """
+  def __init__(self, every=10, window=100, log_path=None, writer=None,
+               trace_steps=None, trace_dir=None):
+    """
+    Args:
+      every : write the aggregates every this many steps
+      window : steps of the rolling aggregates and latency percentiles
+      log_path : json lines file, None to not write one
+      writer : tf.summary.FileWriter, None to not write summaries
+      trace_steps : global steps to trace, trace_dir is then required
+    """
+    self.every = every
+    self.writer = writer
+    self.trace_steps = set(trace_steps or [])
+    self.trace_dir = trace_dir
+    self.step = 0
+    self._steps = deque(maxlen=window)
+    self._log = None
+    if log_path is not None:
+      log_dir = os.path.dirname(log_path)
+      if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+      self._log = open(log_path, 'a')
+    if self.trace_steps and not os.path.exists(trace_dir):
+      os.makedirs(trace_dir)
+
+  def run_options(self):
+    """ RunOptions and RunMetadata for the next step, None if not traced """
+    if self.step + 1 not in self.trace_steps:
+      return None, None
+    return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), \
+           tf.RunMetadata()
+
+  def record(self, batch, input_sec, run_sec, run_metadata=None):
+    """ Record a step
+    Args:
+      batch : the batch of make_batches that was run
+      input_sec : seconds to build the batch and its feed
+      run_sec : seconds in sess.run
+    """
+    self.step += 1
+    tokens = int(np.sum(batch.seq_len_encoder) + np.sum(batch.seq_len_decoder))
+    self._steps.append((len(batch.seq_len_encoder), tokens, input_sec, run_sec))
+    if run_metadata is not None:
+      self.save_trace(run_metadata)
+    if self.step % self.every == 0:
+      self.write(self.summary())
+
+  def summary(self):
+    """ Aggregates over the window """
+    examples, tokens, input_sec, run_sec = np.sum(self._steps, axis=0)
+    latency = [i + r for _, _, i, r in self._steps]
+    seconds = max(input_sec + run_sec, 1e-9)
+    return {"step": self.step, "time": time.time(),
+            "examples_per_sec": examples / seconds,
+            "tokens_per_sec": tokens / seconds,
+            "input_sec": input_sec / len(self._steps),
+            "run_sec": run_sec / len(self._steps),
+            "input_fraction": input_sec / seconds,
+            "p50_sec": float(np.percentile(latency, 50)),
+            "p95_sec": float(np.percentile(latency, 95))}
+
+  def write(self, summary):
+    if self._log is not None:
+      self._log.write(json.dumps(summary) + '\n')
+    if self.writer is not None:
+      values = [tf.Summary.Value(tag='steps/' + k, simple_value=v) \
+                for k, v in summary.items() if k not in ('step', 'time')]
+      self.writer.add_summary(tf.Summary(value=values), self.step)
+
+  def save_trace(self, run_metadata):
+    trace = timeline.Timeline(run_metadata.step_stats)
+    path = os.path.join(self.trace_dir, 'timeline_{}.json'.format(self.step))
+    with open(path, 'w') as f:
+      f.write(trace.generate_chrome_trace_format())
+    if self.writer is not None:
+      self.writer.add_run_metadata(run_metadata, 'step_{}'.format(self.step),
+                                   self.step)
+
+  def close(self):
+    if self._log is not None:
+      self._log.close()
+      self._log = None
+
 class TrainEmbeddings():
   """ Retrain embeddings on dataset for x epochs """
   def __init__(self):
@@ -143,6 +332,51 @@ class TrainEmbeddings():
   def train():
     pass
 
+def session_config(settings, intra_op_threads=None, inter_op_threads=None):
+  """ ConfigProto from settings["session"], thread counts can be overridden """
+  sess_settings = settings['session']
+  if intra_op_threads is None:
+    intra_op_threads = sess_settings['intra_op_threads']
+  if inter_op_threads is None:
+    inter_op_threads = sess_settings['inter_op_threads']
+  return tf.ConfigProto(
+      intra_op_parallelism_threads=intra_op_threads,
+      inter_op_parallelism_threads=inter_op_threads,
+      allow_soft_placement=sess_settings['allow_soft_placement'])
+
+def step_stats(settings, writer=None):
+  """ StepStats from settings["step_stats"], None if nothing is written """
+  stats_settings = settings['step_stats']
+  if stats_settings['log_path'] is None and writer is None and \
+                                      stats_settings['trace_steps'] is None:
+    return None
+  return StepStats(stats_settings['every'], stats_settings['window'],
+                   stats_settings['log_path'], writer,
+                   stats_settings['trace_steps'], stats_settings['trace_dir'])
+
+def parse_cpu_list(cpus):
+  """ Set of cpu ids from a string such as "0-3,8" """
+  cpu_set = set()
+  for part in cpus.split(','):
+    if '-' in part:
+      first, last = part.split('-')
+      cpu_set.update(range(int(first), int(last) + 1))
+    else:
+      cpu_set.add(int(part))
+  return cpu_set
+
+def set_cpu_affinity(cpus):
+  """ Pin this process to cpus, a set of ids or a string such as "0-3,8"
+  Returns:
+    True if pinned, False if not supported on this platform
+  """
+  if not hasattr(os, "sched_setaffinity"):
+    return False
+  if type(cpus) is str:
+    cpus = parse_cpu_list(cpus)
+  os.sched_setaffinity(0, cpus)
+  return True
+
 def dense(x, in_dim, out_dim, scope, act=None):
   """ Fully connected layer builder"""
   with tf.variable_scope(scope):